@@ -1,6 +1,10 @@
 from numpy import zeros, zeros_like, pad, copy, stack, min, max, ndarray, uint8, uint16, uint32, float32, float64
-from multiprocessing import Pool
-from functools import partial
+from numpy import maximum, prod, clip, copyto
+from multiprocessing import Pool, Process, Queue
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty
+from builtins import min as builtin_min, max as builtin_max
+from math import ceil
 
 from pathlib import Path
 
@@ -14,6 +18,9 @@ from os.path import exists, isdir, join
 from os import listdir, system
 
 from supplements.tifstack import TifStack
+from supplements.registration import phase_correlation_nd
+from parallel_image_processor import prefetched
+from pystripe.core import imsave_tif, progress_manager
 from argparse import ArgumentParser, Namespace, RawDescriptionHelpFormatter
 
 from tqdm import tqdm
@@ -267,81 +274,140 @@ def write_alignments(channels: list[list], input_files: list[str], residuals: li
     print(f"Alignments saved in file: {output_file}")
 
 
-# helper function for process_big_images
-def process_single_big_image(n_ref: int,  # the only non-constant var between iterations
-                             file_paths: list[str],
-                             reference_index: int,
-                             pad_to_max: list[list[list[int]]],
-                             offsets: list[list[int]],
-                             image_shapes: list[list[int]],
-                             operation_shape: list[int],
-                             file_path_output: Path,
-                             data_type,  # dtype
-                             save_singles: bool,
-                             file_path_inputs: list[Path],
-                             missing_channel: str):
-    n_orig = []
-    for i in range(len(file_paths)):
-        if file_paths[i] is None:
-            n_orig.append(None)
-            continue
-        if i == reference_index:
-            n_orig.append(n_ref)
-            continue
-        n_orig.append(n_ref + pad_to_max[reference_index][0][0] - pad_to_max[i][0][0] - offsets[i][0])
-
-    # print("n_ref: ", n_ref)
-    # print("n_orig: ", n_orig)
-    combined_image = []
-    for count, n_img in enumerate(n_orig):
-        if n_img is None:
-            combined_image.append(zeros(image_shapes[reference_index][1:]))
-        elif 0 <= n_img < image_shapes[count][0]:
-            file = imread(file_paths[count][n_img])
-            # pad image to operation dimensions
-            file = pad_to_shape(operation_shape[1:], file)
-
-            # shift image in x and y directions
-            roll_pad(file, offsets[count][1], axis=0)
-            roll_pad(file, offsets[count][2], axis=1)
-
-            # reshape image to reference dimensions
-            file = trim_to_shape(image_shapes[reference_index][1:], file)
-            combined_image.append(file)
-        else:
-            # save zeroes for that layer if out of bounds
-            combined_image.append(zeros(image_shapes[reference_index][1:]))
-
-    # if missing_channel == 'r':
-    #     combined_image.insert(0, zeros(image_shapes[reference_index][1:]))
-    # elif missing_channel == 'g':
-    #     combined_image.insert(1, zeros(image_shapes[reference_index][1:]))
-    # elif missing_channel == 'b':
-    #     combined_image.insert(2, zeros(image_shapes[reference_index][1:]))
-
-    # save RGB image
-    local = file_path_output / 'RGB'
-    local.mkdir(parents=True, exist_ok=True)
-    composite = stack(combined_image, axis=-1)
+# copies src into out shifted by (dy, dx): out[y, x] = src[y - dy, x - dx], pixels outside src stay untouched.
+# it is the same as pad_to_shape, roll_pad and trim_to_shape without the intermediate arrays.
+def shifted_copy(src: ndarray, out: ndarray, dy: int, dx: int):
+    y0, y1 = builtin_max(0, dy), builtin_min(out.shape[0], src.shape[0] + dy)
+    x0, x1 = builtin_max(0, dx), builtin_min(out.shape[1], src.shape[1] + dx)
+    if y1 > y0 and x1 > x0:
+        copyto(out[y0:y1, x0:x1], src[y0 - dy:y1 - dy, x0 - dx:x1 - dx], casting="unsafe")
+
+
+# worker of process_big_images. The file tables and offsets are sent once, the queue only carries reference indices.
+# channels are read concurrently, the reads of the next plane overlap the current one, and writes are asynchronous.
+class MultiProcessBigImageAligner(Process):
+    def __init__(self, progress_queue: Queue, args_queue: Queue, file_paths: list, reference_index: int,
+                 pad_to_max: list, offsets: list[list[int]], image_shapes: list, operation_shape: list[int],
+                 file_path_output: Path, data_type, save_singles: bool, file_path_inputs: list[Path],
+                 compression=("ADOBE_DEFLATE", 1)):
+        Process.__init__(self)
+        self.daemon = False
+        self.progress_queue = progress_queue
+        self.args_queue = args_queue
+        self.file_paths = file_paths
+        self.reference_index = reference_index
+        self.pad_to_max = pad_to_max
+        self.offsets = offsets
+        self.image_shapes = image_shapes
+        self.operation_shape = operation_shape
+        self.file_path_output = file_path_output
+        self.data_type = data_type
+        self.save_singles = save_singles
+        self.file_path_inputs = file_path_inputs
+        self.compression = compression
+
+    # z index of each channel for a z index of the reference, or None if the channel is missing or out of bounds
+    def channel_indices(self, n_ref: int):
+        n_orig = []
+        for i in range(len(self.file_paths)):
+            if self.file_paths[i] is None:
+                n_orig.append(None)
+            elif i == self.reference_index:
+                n_orig.append(n_ref)
+            else:
+                n_img = n_ref + self.pad_to_max[self.reference_index][0][0] - self.pad_to_max[i][0][0] - \
+                        self.offsets[i][0]
+                n_orig.append(n_img if 0 <= n_img < self.image_shapes[i][0] else None)
+        return n_orig
 
-    path = local.absolute() / Path(file_paths[reference_index][n_ref]).name
-    imwrite(path, composite.astype(data_type), dtype=data_type)
+    def next_index(self):
+        while self.args_queue.qsize() > 0:
+            try:
+                return self.args_queue.get(block=True, timeout=1)
+            except Empty:
+                return None
+        return None
 
-    # save individual images
-    if save_singles:
-        for n, channel_img in enumerate(combined_image):
-            # print(n)
-            local = file_path_output / file_path_inputs[n].name
-            local.mkdir(parents=True, exist_ok=True)
-            path = local.absolute() / Path(file_paths[reference_index][n_ref]).name
-            # print(path)
-            imwrite(path, channel_img.astype(data_type), dtype=data_type)
+    def save(self, path: Path, img: ndarray):
+        imsave_tif(path, img, compression=self.compression)
+
+    # waits for an asynchronous write and logs its error like the read errors are logged
+    @staticmethod
+    def finish_write(write):
+        try:
+            write.result()
+        except Exception as inst:
+            print(f"Saving an aligned image failed: {type(inst)} {inst}")
+
+    def run(self):
+        try:
+            self.align_all()
+        finally:
+            self.progress_queue.put(False)
+
+    def align_all(self):
+        reference_shape = self.image_shapes[self.reference_index][1:]
+        # shift of each channel from its own origin to the origin of the reference, after centering all of them
+        # in the operation shape and trimming back to the reference shape
+        trim = [(self.operation_shape[axis + 1] - reference_shape[axis]) // 2 for axis in range(2)]
+        shifts = [None if pads is None else
+                  [pads[axis + 1][0] + self.offsets[i][axis + 1] - trim[axis] for axis in range(2)]
+                  for i, pads in enumerate(self.pad_to_max)]
+        rgb_path = self.file_path_output / 'RGB'
+        rgb_path.mkdir(parents=True, exist_ok=True)
+        if self.save_singles:
+            for path in self.file_path_inputs:
+                if path is not None:
+                    (self.file_path_output / path.name).mkdir(parents=True, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=2 * len(self.file_paths)) as readers, \
+                ThreadPoolExecutor(max_workers=2) as writers:
+            def submit_reads(n_ref: int):
+                return n_ref, [None if n_img is None else readers.submit(imread, self.file_paths[count][n_img])
+                               for count, n_img in enumerate(self.channel_indices(n_ref))]
+
+            writes = []
+            try:
+                n_ref = self.next_index()
+                pending = None if n_ref is None else submit_reads(n_ref)
+                while pending is not None:
+                    n_ref, futures = pending
+                    n_next = self.next_index()
+                    pending = None if n_next is None else submit_reads(n_next)
+                    try:
+                        composite = zeros(tuple(reference_shape) + (len(futures),), dtype=self.data_type)
+                        for count, future in enumerate(futures):
+                            if future is not None:
+                                shifted_copy(future.result(), composite[:, :, count], *shifts[count])
+                        name = Path(self.file_paths[self.reference_index][n_ref]).name
+                        done = [write for write in writes if write.done()]
+                        for write in done:
+                            self.finish_write(write)
+                        writes = [write for write in writes if write not in done]
+                        while len(writes) > 2:
+                            self.finish_write(writes.pop(0))
+                        writes.append(writers.submit(self.save, rgb_path / name, composite))
+                        if self.save_singles:
+                            for count, path in enumerate(self.file_path_inputs):
+                                if path is not None:
+                                    writes.append(writers.submit(
+                                        self.save, self.file_path_output / path.name / name,
+                                        composite[:, :, count]))
+                    except KeyboardInterrupt:
+                        break
+                    except Exception as inst:
+                        print(f"Aligning image {n_ref} failed: {type(inst)} {inst}")
+                    self.progress_queue.put(True)
+            finally:
+                for write in writes:
+                    self.finish_write(write)
 
 
 # offsets must have shape (D, 3), where D is the number of file path inputs
-# offsets[reference_index] = [0, 0, 0], x-y-z order (NOT z-y-x)
+# offsets[reference_index] = [0, 0, 0], z-y-x order
 def process_big_images(file_path_inputs: list[Path], file_path_output: Path, reference_index: int,
-                       offsets: list[list[int]], num_threads=8, save_singles=False, missing_channel=None):
+                       offsets: list[list[int]], num_threads=8, save_singles=False, missing_channel=None,
+                       data_type=None, compression=("ADOBE_DEFLATE", 1)):
     # load image paths
     file_paths = []
     for input_path in file_path_inputs:
@@ -353,7 +419,8 @@ def process_big_images(file_path_inputs: list[Path], file_path_output: Path, ref
             file_paths.append(None)
 
     image_shapes = []  # list[tuple]
-    data_type = imread(file_paths[reference_index][0]).dtype
+    if data_type is None:
+        data_type = imread(file_paths[reference_index][0]).dtype
     for image in file_paths:
         if image is None:
             image_shapes.append(None)
@@ -375,49 +442,30 @@ def process_big_images(file_path_inputs: list[Path], file_path_output: Path, ref
 
     # process layers
     print("Aligning large images...")
-
-    # print("file_paths ", len(file_paths))
-    # print("reference_index ", reference_index)
-    # print("pad_to_max ", pad_to_max)
-    # print("offsets ", offsets)
-    # print("image_shapes ", image_shapes)
-
-    # fill in constant variables for partial function
-    partial_func = partial(process_single_big_image,
-                           file_paths=file_paths,
-                           reference_index=reference_index,
-                           pad_to_max=pad_to_max,
-                           offsets=offsets,
-                           image_shapes=image_shapes,
-                           operation_shape=operation_shape,
-                           file_path_output=file_path_output,
-                           data_type=data_type,
-                           save_singles=save_singles,
-                           file_path_inputs=file_path_inputs,
-                           missing_channel=missing_channel)
-
-    if num_threads <= 1:
-        for i in tqdm(range(len(file_paths[reference_index]))):
-            partial_func(i)
-    else:
-        pool = Pool(processes=num_threads)
-        try:
-            # need to convert to list so the tqdm iterator is consumed; otherwise progress bar doesn't update.
-            list(tqdm(
-                pool.imap_unordered(partial_func, range(len(file_paths[reference_index]))),
-                total=len(file_paths[reference_index])))
-        except KeyboardInterrupt:
-            print("KeyboardInterrupt detected, terminating thread pool...")
-            pool.terminate()
-            pool.join()
-        except Exception as e:  # this one ideally should never occur...
-            print("Thread pool for aligning large images encountered an error, terminating...")
-            print(e)
-            pool.terminate()
-            pool.join()
-        else:
-            pool.close()
-            pool.join()
+    num_images = len(file_paths[reference_index])
+    args_queue = Queue(maxsize=num_images)
+    for n_ref in range(num_images):
+        args_queue.put(n_ref)
+
+    workers = builtin_min(builtin_max(1, num_threads), num_images)
+    progress_queue = Queue()
+    worker_processes = []
+    for _ in range(workers):
+        worker = MultiProcessBigImageAligner(
+            progress_queue, args_queue, file_paths, reference_index, pad_to_max, offsets, image_shapes,
+            operation_shape, file_path_output, data_type, save_singles, file_path_inputs, compression=compression)
+        worker.start()
+        worker_processes.append(worker)
+
+    return_code = progress_manager(progress_queue, workers, num_images, desc="Align", unit=" images")
+    args_queue.cancel_join_thread()
+    args_queue.close()
+    progress_queue.cancel_join_thread()
+    progress_queue.close()
+    for worker in worker_processes:
+        worker.join()
+    if return_code != 0:
+        print("Aligning large images was interrupted.")
 
 
 # aligns images in 3d, using 2d alignment algorithm as a blackbox
@@ -523,6 +571,85 @@ def align_all_images(
     return moves, residuals
 
 
+# bins a tif stack by an integer factor on every axis while its planes are streamed, so only the binned proxy volume
+# is kept in memory. If mips is true, only the xy, xz and yz maximum intensity projections of the proxy are kept.
+def load_proxy(tif_stack: TifStack, factor: int, num_threads: int = 8, mips: bool = False):
+    nz, ny, nx = tif_stack.nz // factor, tif_stack.nyx[0] // factor, tif_stack.nyx[1] // factor
+    volume = None if mips else zeros((nz, ny, nx), dtype=float32)
+    mip_xy, mip_xz, mip_yz = zeros((ny, nx), dtype=float32), zeros((nz, nx), dtype=float32), zeros((nz, ny), dtype=float32)
+    accumulator = zeros((ny, nx), dtype=float32)
+
+    def read_binned(z: int):
+        img = tif_stack[z][:ny * factor, :nx * factor].astype(float32)
+        return img.reshape(ny, factor, nx, factor).mean(axis=(1, 3))
+
+    for z, plane in enumerate(prefetched(read_binned, range(nz * factor), num_threads)):
+        accumulator += plane
+        if z % factor == factor - 1:
+            accumulator /= factor
+            z_binned = z // factor
+            if mips:
+                maximum(mip_xy, accumulator, out=mip_xy)
+                mip_xz[z_binned] = accumulator.max(axis=0)
+                mip_yz[z_binned] = accumulator.max(axis=1)
+            else:
+                volume[z_binned] = accumulator
+            accumulator.fill(0)
+    return (mip_xy, mip_xz, mip_yz) if mips else volume
+
+
+# zero pads arrays at the end (not centered) to the largest shape
+def pad_to_common_shape(arrays: list[ndarray]):
+    shape = [max(dim) for dim in zip(*(a.shape for a in arrays))]
+    return [pad(a, [(0, s - n) for s, n in zip(shape, a.shape)]) for a in arrays]
+
+
+# aligns tif stacks in one shot on binned proxy volumes loaded in streaming fashion, without shifting any volume.
+# method "phase" uses 3D phase correlation and "mip" uses 2D phase correlation of the xy, xz and yz projections.
+# returns moves and residuals in the same x-y-z order and centered frame as align_all_images
+def align_all_stacks(
+        stacks: list[TifStack],
+        reference: int = 0,
+        method: str = "phase",
+        max_voxels: int = 2 ** 25,
+        num_threads: int = 8,
+        verbose: bool = False
+):
+    shapes = [s.shape for s in stacks if s is not None]
+    operation_shape = [max(dim) for dim in zip(*shapes)]
+    # min and max are the numpy functions in this module
+    factor = ceil((prod(operation_shape, dtype=float64) / max_voxels) ** (1 / 3))
+    factor = int(clip(factor, 1, min([min(shape) for shape in shapes])))
+    if verbose:
+        print(f"proxy binning factor: {factor}")
+    proxies = [None if s is None else load_proxy(s, factor, num_threads, mips=method == "mip") for s in stacks]
+
+    moves = []
+    residuals = []
+    for n, proxy in enumerate(proxies):
+        if proxy is None or n == reference:
+            moves.append([None, None, None])
+            residuals.append(None)
+            continue
+        # t in z-y-x order: reference(p) ~ channel(p + t) when both volumes start at the origin
+        if method == "mip":
+            (ty_xy, tx_xy), _ = phase_correlation_nd(*pad_to_common_shape([proxies[reference][0], proxy[0]]))
+            (tz_xz, tx_xz), _ = phase_correlation_nd(*pad_to_common_shape([proxies[reference][1], proxy[1]]))
+            (tz_yz, ty_yz), _ = phase_correlation_nd(*pad_to_common_shape([proxies[reference][2], proxy[2]]))
+            shift = ((tz_xz + tz_yz) / 2, (ty_xy + ty_yz) / 2, (tx_xy + tx_xz) / 2)
+        else:
+            shift, _ = phase_correlation_nd(*pad_to_common_shape([proxies[reference], proxy]))
+        # the same frame as resize_arrays and process_big_images, which center the stacks in the operation shape
+        shift = [t * factor + (o - s) // 2 - (o - r) // 2
+                 for t, o, s, r in zip(shift, operation_shape, stacks[n].shape, stacks[reference].shape)]
+        move = [-int(round(t)) for t in shift]
+        if verbose:
+            print(f"channel {n} shift (z, y, x): {[round(t, 2) for t in shift]}")
+        moves.append(move[::-1])
+        residuals.append(tuple(-t - m for t, m in zip(shift[::-1], move[::-1])))
+    return moves, residuals
+
+
 # entrance if run in terminal
 def main(args: Namespace):
     # input_file = args.input
@@ -543,6 +670,7 @@ def main(args: Namespace):
     dx = args.dx
     dy = args.dy
     dz = args.dz
+    alignment_method = getattr(args, "alignment_method", "phase")
 
     # Ensure there are 2 or 3 channels
     if sum(map(lambda x: bool(x[0]), [red_paths, green_paths, blue_paths])) < 2:
@@ -597,65 +725,82 @@ def main(args: Namespace):
     #     print(f"Error: Input directory '{input_file}' contains a different number of channels than the number specified.  Found: {num_dirs}.  Expected: {num_channels}")
     #     exit(1)
 
-    # Image Processing --------------------------------------------------------------------
-    print("Loading images...")
-    count = 0
-    raw_channels = []
-    try:
-        while count < num_channels:
-            if downsampled_input[count]:
-                raw_channels.append(TifStack(downsampled_input[count]).as_3d_numpy())
-            else:
-                raw_channels.append(None)
-            count += 1
-        print("Images loaded")
-    except Exception:
-        print(f"Error: Invalid TifStack found at {downsampled_input[count]}")
-        exit(1)
-
     output_path = Path(output_file)
     output_path.mkdir(parents=True, exist_ok=True)
 
-    print(downsampled_input)
+    # Image Processing --------------------------------------------------------------------
+    if alignment_method == "iterative":
+        print("Loading images...")
+        count = 0
+        raw_channels = []
+        try:
+            while count < num_channels:
+                if downsampled_input[count]:
+                    raw_channels.append(TifStack(downsampled_input[count]).as_3d_numpy())
+                else:
+                    raw_channels.append(None)
+                count += 1
+            print("Images loaded")
+        except Exception:
+            print(f"Error: Invalid TifStack found at {downsampled_input[count]}")
+            exit(1)
 
-    print("Resizing images...")
-    original_downsampled_reference_shape = raw_channels[reference].shape
+        print(downsampled_input)
 
-    channels = resize_arrays(raw_channels)
-    print("Images resized")
+        print("Resizing images...")
+        original_downsampled_reference_shape = raw_channels[reference].shape
 
-    copy_channels = [deepcopy(img) for img in channels]
+        channels = resize_arrays(raw_channels)
+        print("Images resized")
 
+        copy_channels = [deepcopy(img) for img in channels]
 
-    print("Finding alignments... (this may take a while)")
-    # for i in range(len(channels)):
-    #     if edge_detection:
-    #         if edge_detection.lower() == 'sobel':
-    #             if i == 0: print("Running Sobel Operator")
-    #             copy_channels[i] = sobel(copy_channels[i])
-    #         elif edge_detection.lower() == 'canny':
-    #             if i == 0: print("Running Canny Operator")
-    #             apply_canny(copy_channels[i])
 
-    # align images
-    alignments, residuals = align_all_images(copy_channels, max_iter=max_iterations, reference=reference, verbose=True, make_copy=False)
+        print("Finding alignments... (this may take a while)")
+        # for i in range(len(channels)):
+        #     if edge_detection:
+        #         if edge_detection.lower() == 'sobel':
+        #             if i == 0: print("Running Sobel Operator")
+        #             copy_channels[i] = sobel(copy_channels[i])
+        #         elif edge_detection.lower() == 'canny':
+        #             if i == 0: print("Running Canny Operator")
+        #             apply_canny(copy_channels[i])
 
-    # apply transformations to actual images
-    print("Aligning downsampled images...")
-    for n, img in tqdm(enumerate(channels)):
-        if not n or n == reference:
-            continue
-        roll_pad(img, alignments[n][0], axis=2)
-        roll_pad(img, alignments[n][1], axis=1)
-        roll_pad(img, alignments[n][2], axis=0)
+        # align images
+        alignments, residuals = align_all_images(copy_channels, max_iter=max_iterations, reference=reference, verbose=True, make_copy=False)
+
+        # apply transformations to actual images
+        print("Aligning downsampled images...")
+        for n, img in tqdm(enumerate(channels)):
+            if not n or n == reference:
+                continue
+            roll_pad(img, alignments[n][0], axis=2)
+            roll_pad(img, alignments[n][1], axis=1)
+            roll_pad(img, alignments[n][2], axis=0)
+
+        # reshape downsampled to reference
+            for n, img in enumerate(channels):
+                channels[n] = trim_to_shape(original_downsampled_reference_shape, img)
 
-    # reshape downsampled to reference
-        for n, img in enumerate(channels):
-            channels[n] = trim_to_shape(original_downsampled_reference_shape, img)
+        # write downsampled to file
+        print("Writing downsampled images to file...")
+        write_to_file(channels, downsampled_input, reference, output_path / "downsampled", data_type, save_singles=save_singles)
+    else:
+        print("Loading downsampled proxy volumes and finding alignments...")
+        try:
+            stacks = [TifStack(path) if path else None for path in downsampled_input]
+        except Exception:
+            print(f"Error: Invalid TifStack found in {downsampled_input}")
+            exit(1)
+        alignments, residuals = align_all_stacks(
+            stacks, reference=reference, method=alignment_method, num_threads=num_threads, verbose=True)
 
-    # write downsampled to file
-    print("Writing downsampled images to file...")
-    write_to_file(channels, downsampled_input, reference, output_path / "downsampled", data_type, save_singles=save_singles)
+        # the shift is applied only while the downsampled images are written
+        print("Writing downsampled images to file...")
+        process_big_images(
+            [Path(path) if path else None for path in downsampled_input], output_path / "downsampled", reference,
+            [[0, 0, 0] if alignments[n][0] is None else alignments[n][::-1] for n in range(len(alignments))],
+            num_threads=num_threads, save_singles=save_singles, missing_channel=missing_channel, data_type=data_type)
 
     if write_alignments_bool:
         write_alignments(alignments, downsampled_input, residuals, reference, output_path)
@@ -694,11 +839,11 @@ def main(args: Namespace):
         system(f'python convert.py -i "{output_path}/downsampled/RGB" -o "{output_path}/downsampled/RGB.ims" -dx {dx[1]} -dy {dy[1]} -dz {dz[1]}')
         system(f'python convert.py -i "{output_path}/original/RGB" -o "{output_path}/original/RGB.ims" -dx {dx[0]} -dy {dy[0]} -dz {dz[0]}')
         if save_singles:
-            for i in range(len(channels)):
+            for i in range(num_channels):
                 if not downsampled_input[i]: continue
                 temp = Path(downsampled_input[i]).name
                 system(f'python convert.py -i "{output_path}/downsampled/{temp}" -o "{output_path}/downsampled/{temp}.ims" -dx {dx[1]} -dy {dy[1]} -dz {dz[1]}')
-            for i in range(len(channels)):
+            for i in range(num_channels):
                 if not original_input[i]: continue
                 temp = Path(original_input[i]).name
                 system(f'python convert.py -i "{output_path}/original/{temp}" -o "{output_path}/original/{temp}.ims" -dx {dx[0]} -dy {dy[0]} -dz {dz[0]}')
@@ -734,8 +879,12 @@ if __name__ == '__main__':
                         help="If present, write alignments to a .txt file.")
     parser.add_argument('--generate_ims', action='store_true',
                         help="If present, generate .ims files along with output.")
+    parser.add_argument('--alignment_method', type=str, default='phase', choices=['phase', 'mip', 'iterative'],
+                        help="'phase': one-shot 3D phase correlation of streamed proxy volumes, "
+                             "'mip': phase correlation of their xy, xz and yz projections, "
+                             "'iterative': the in-memory iterative search.  Default phase.")
     parser.add_argument('--max_iterations', type=int, default=10,
-                        help="Maximum iterations allowed for image alignment.")
+                        help="Maximum iterations allowed for image alignment.  Only used by the iterative method.")
     parser.add_argument('--reference', type=str, default='red',
                         help="The channel to use as the reference image.  Default red.")
     parser.add_argument('--num_threads', type=int, default=8,
@@ -5,12 +5,13 @@ import psutil
 import numpy as np
 import pandas as pd
 from pathlib import Path
-from pystripe.core import imread_tif_raw_png, imsave_tif
-from scipy import stats
+from pystripe.core import imread_tif_raw_png, imsave_tif, progress_manager
+from supplements.cli_interface import PrintColors
 from sklearn.model_selection import train_test_split
 from skimage.restoration import denoise_bilateral
-from multiprocessing import freeze_support, Process, Queue, Manager
-from queue import Empty
+from multiprocessing import freeze_support, Process, Queue, Value
+from queue import Empty, Full
+from threading import Thread, Event
 from math import isnan
 
 # How to generate flat images
@@ -23,63 +24,135 @@ os.environ["OPENBLAS_MAIN_FREE"] = "1"
 def get_img_stats(img_mem_map):
     if img_mem_map is None:
         return ['mean', 'min', 'max', 'cv', 'variance', 'std', 'skewness', 'kurtosis', 'n']
-    img_mem_map = img_mem_map.flatten()
-    img_nobs, (img_min, img_max), img_mean, img_variance, img_skewness, img_kurtosis = stats.describe(img_mem_map)
+    # same definitions as scipy.stats.describe, computed from the central moments of a float64 copy
+    img = img_mem_map.astype(np.float64).ravel()
+    img_nobs = img.size
+    img_min, img_max = img.min(), img.max()
+    img_mean = img.mean()
+    img -= img_mean
+    img_squared = img * img
+    img_m2 = img_squared.sum() / img_nobs
+    img_m3 = np.dot(img_squared, img) / img_nobs
+    img_m4 = np.dot(img_squared, img_squared) / img_nobs
+    img_variance = img_m2 * img_nobs / max(img_nobs - 1, 1)
     img_std = np.sqrt(img_variance)
-    img_cv = img_std / img_mean
+    img_cv = img_std / img_mean if img_mean != 0 else 0
+    img_skewness = img_m3 / img_m2 ** 1.5 if img_m2 > 0 else 0
+    img_kurtosis = img_m4 / img_m2 ** 2 - 3 if img_m2 > 0 else 0
     return [img_mean, img_min, img_max, img_cv, img_variance, img_std, img_skewness, img_kurtosis, img_nobs]
 
 
-class MultiProcessGetImgStats(Process):
-    def __init__(self, queue, img_path, tile_size):
-        Process.__init__(self)
-        self.daemon = True
-        self.queue = queue
-        self.img_path = img_path
-        self.tile_size = tile_size
+class MedianOfMeans:
+    def __init__(self, groups=1):
+        """
+        Streaming median-of-means of equally shaped images: every image is summed into one of the groups and the
+        estimate is the pixel-wise median of the group means. Memory is one float64 image per used group
+        regardless of the number of images.
+        """
+        self.sums = [None] * groups
+        self.counts = [0] * groups
 
-    def run(self):
-        img_mem_map, img_stats = None, None
-        try:
-            img_mem_map = imread_tif_raw_png(self.img_path)
-            if img_mem_map is not None and img_mem_map.shape == self.tile_size:
-                # ['mean', 'min', 'max', 'cv', 'variance', 'std', 'skewness', 'kurtosis', 'n']
-                img_stats = get_img_stats(img_mem_map)
-                img_stats = img_stats[0:-1]
-                img_stats = [0 if isnan(x) else x for x in img_stats]
-                img_stats = np.array(img_stats, dtype=float)
-                # is_flat = self.classifier_model.predict([img_stats[0:-1]])
-            elif img_mem_map.shape != self.tile_size:
-                print(f"tile size mismatch for file:\n{self.img_path}")
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def add(self, img, group=0):
+        if self.sums[group] is None:
+            self.sums[group] = img.astype(np.float64)
+        else:
+            self.sums[group] += img
+        self.counts[group] += 1
+
+    def merge(self, other):
+        for group, (img_sum, count) in enumerate(zip(other.sums, other.counts)):
+            if img_sum is None:
+                continue
+            if self.sums[group] is None:
+                self.sums[group] = img_sum
             else:
-                print(f"problem reading file:\n{self.img_path}")
-        except Exception as inst:
-            print(f'Process failed for {self.img_path}.')
-            print(type(inst))    # the exception instance
-            print(inst.args)     # arguments stored in .args
-            print(inst)
-        self.queue.put([img_mem_map, img_stats])
+                self.sums[group] += img_sum
+            self.counts[group] += count
+        return self
+
+    def estimate(self):
+        means = [img_sum / count for img_sum, count in zip(self.sums, self.counts) if count > 0]
+        if len(means) == 1:
+            return means[0]
+        return np.median(np.stack(means), axis=0)
 
 
-class MultiProcessDenoiseImg(Process):
-    def __init__(self, queue, img_list, img_idx, sigma_spatial=1):
+class MultiProcessFlatAccumulator(Process):
+    def __init__(self, progress_queue, args_queue, accepted, feeding_done, tile_size, classifier_model=None,
+                 max_images=1024, group=0, groups=1, patience_before_skipping=None, skips=256):
         Process.__init__(self)
         self.daemon = True
-        self.queue = queue
-        self.img_list = img_list
-        self.img_idx = img_idx
-        self.sigma_spatial = sigma_spatial
+        self.progress_queue = progress_queue
+        self.args_queue = args_queue
+        self.accepted = accepted
+        self.feeding_done = feeding_done
+        self.tile_size = tile_size
+        self.classifier_model = classifier_model
+        self.max_images = max_images
+        self.group = group
+        self.groups = groups
+        self.patience_before_skipping = patience_before_skipping
+        self.skips = skips
+
+    # waits for the next path until max_images are accepted or all paths are consumed
+    def next_path(self):
+        while self.accepted.value < self.max_images:
+            feeding_done = self.feeding_done.value
+            try:
+                return self.args_queue.get(block=True, timeout=1)
+            except Empty:
+                if feeding_done:
+                    return None
+        return None
+
+    # reserves one of the max_images slots, returns False if all of them are taken
+    def reserve(self):
+        with self.accepted.get_lock():
+            if self.accepted.value >= self.max_images:
+                return False
+            self.accepted.value += 1
+            return True
 
     def run(self):
-        img_denoised = None
-        try:
-            img_denoised = denoise_bilateral(self.img_list[self.img_idx], sigma_spatial=self.sigma_spatial, mode="edge")
-        except Exception as inst:
-            print(f'Denoise process failed.')
-            print(type(inst))    # the exception instance
-            print(inst.args)     # arguments stored in .args
-            print(inst)
-        self.queue.put(img_denoised)
+        accumulator = MedianOfMeans(groups=self.groups)
+        img_mean_list = []
+        non_flat_count = 0
+        img_path = self.next_path()
+        while img_path is not None and self.accepted.value < self.max_images:
+            try:
+                img_mem_map = imread_tif_raw_png(img_path)
+                if img_mem_map is None:
+                    print(f"problem reading file:\n{img_path}")
+                elif img_mem_map.shape != self.tile_size:
+                    print(f"tile size mismatch for file:\n{img_path}")
+                else:
+                    # ['mean', 'min', 'max', 'cv', 'variance', 'std', 'skewness', 'kurtosis']
+                    img_stats = [0 if isnan(x) else x for x in get_img_stats(img_mem_map)[0:-1]]
+                    is_flat = self.classifier_model is None or self.classifier_model.predict([img_stats])[0]
+                    if is_flat and self.reserve():
+                        accumulator.add(img_mem_map, group=self.group)
+                        img_mean_list += [img_stats[0]]
+                        non_flat_count = 0
+                        self.progress_queue.put(True)
+                    elif not is_flat:
+                        non_flat_count += 1
+            except Exception as inst:
+                print(f'Process failed for {img_path}.')
+                print(type(inst))    # the exception instance
+                print(inst.args)     # arguments stored in .args
+                print(inst)
+            if self.patience_before_skipping and self.patience_before_skipping < non_flat_count:
+                print(f"\nskipping {self.skips} files because non-flat images were more than "
+                      f"{self.patience_before_skipping}.\n")
+                for _ in range(self.skips):
+                    self.next_path()
+                non_flat_count = 0
+            img_path = self.next_path()
+        self.progress_queue.put((accumulator, img_mean_list))
 
 
 def img_path_generator(path):
@@ -91,14 +164,6 @@ def img_path_generator(path):
                     yield Path(os.path.join(root, name))
 
 
-def update_progress(percent, prefix='progress', posix=''):
-    percent = int(percent)
-    hash_count = percent // 10
-    space_count = 10 - hash_count
-    sys.stdout.write(f"\r{prefix}: [{'#' * hash_count}{' ' * space_count}] {percent}% {posix}")
-    sys.stdout.flush()
-
-
 def save_csv(path, list_2d):
     with open(path, 'w') as file:
         write = csv.writer(file)
@@ -139,6 +204,20 @@ def get_flat_classifier(training_data_path, train_test=False):
     return model
 
 
+def feed_paths(args_queue, img_path_gen, accepted, max_images, feeding_done, stop):
+    """puts paths on the bounded queue as the workers consume them and stops walking once max_images are found"""
+    for img_path in img_path_gen:
+        while not stop.is_set() and accepted.value < max_images:
+            try:
+                args_queue.put(img_path, block=True, timeout=1)
+                break
+            except Full:
+                pass
+        if stop.is_set() or accepted.value >= max_images:
+            break
+    feeding_done.value = 1
+
+
 def create_flat_img(
         img_source_path, flat_training_data_path, tile_size,
         max_images=1024,
@@ -146,119 +225,59 @@ def create_flat_img(
         patience_before_skipping=None,
         skips=256,
         sigma_spatial=1,
-        save_as_tiff=True):
-
+        save_as_tiff=True,
+        groups=5):
+    """
+    batch_size: int
+        number of worker processes. Each worker keeps a single float64 tile in memory.
+    groups: int
+        number of groups of the median-of-means estimate. Workers are assigned to the groups in turn.
+    """
     print()
-    img_path_gen = iter(img_path_generator(img_source_path))
-    img_flat_count = 0
-    queue_stats = Queue()
-    queue_denoise = Queue()
-    manager = Manager()
-    running_processes = 0
-    img_flat_list, img_mean_list = [], []
     if flat_training_data_path is None:
         classifier_model = None
     else:
         classifier_model = get_flat_classifier(flat_training_data_path)
 
-    there_is_img_to_process, first_run = True, True
-    while img_flat_count < max_images and (there_is_img_to_process or running_processes > 0):
-        for run in range(batch_size - running_processes):
-            img_path = next(img_path_gen, None)
-            if img_path is None:
-                there_is_img_to_process = False
-                break
-            MultiProcessGetImgStats(queue_stats, img_path, tile_size).start()
-            running_processes += 1
-
-        update_progress(
-            img_flat_count / max_images * 100,
-            prefix=img_source_path.name,
-            posix=f'flat: {img_flat_count}, reading {running_processes} images.'
-        )
-
-        img_mem_map_list = manager.list()  # a shared list to avoid copying images to the worker
-        img_stats_list = []
-        img_non_flat_count = 0
-        future_running_processes = 0
-        while running_processes > 0:
-            try:  # check the queue for the optimization results then show result
-                [img_mem_map, img_stats] = queue_stats.get(block=False)
-                running_processes -= 1
-                update_progress(
-                    img_flat_count / max_images * 100,
-                    prefix=img_source_path.name,
-                    posix=f'flat: {img_flat_count}, images in the queue: {running_processes}                           '
-                )
-                if img_mem_map is not None and img_stats is not None:
-                    img_mem_map_list += [img_mem_map]
-                    img_stats_list += [img_stats]
-                else:
-                    img_non_flat_count += 1
-                    if img_mem_map is None:
-                        print('an image could not be loaded.')
-                    else:
-                        print('image stats could not be calculated for one of the images.')
-
-                img_path = next(img_path_gen, None)
-                if img_path is None:
-                    there_is_img_to_process = False
-                else:
-                    MultiProcessGetImgStats(queue_stats, img_path, tile_size).start()
-                    future_running_processes += 1
-            except Empty:
-                pass
-
-        if len(img_stats_list) > 0:
-            if classifier_model is not None:
-                is_flat_list = classifier_model.predict(img_stats_list)
-            else:
-                is_flat_list = [True] * len(img_stats_list)
-            for img_idx, (is_flat, img_stats) in enumerate(zip(is_flat_list, img_stats_list), start=0):
-                if is_flat:
-                    MultiProcessDenoiseImg(
-                        queue_denoise, img_mem_map_list, img_idx, sigma_spatial=sigma_spatial,
-                    ).start()
-                    running_processes += 1
-                    img_mean_list += [img_stats[0]]
-                else:
-                    img_non_flat_count += 1
-
-            update_progress(
-                img_flat_count / max_images * 100,
-                prefix=img_source_path.name,
-                posix=f'flat: {img_flat_count}, non-flat: {img_non_flat_count}/{batch_size}                            '
-            )
-
-            if patience_before_skipping and patience_before_skipping < img_non_flat_count:
-                print(f"\nskipping {skips} files because non-flat images were more than {patience_before_skipping}.\n")
-                for skip in range(skips):
-                    next(img_path_gen, None)
-        else:
-            print("\ncould not read any images in this batch.\n")
-
-        while running_processes > 0:
-            try:  # check the queue for the optimization results then show result
-                img_mem_map_denoised = queue_denoise.get(block=False)
-                running_processes -= 1
-                if img_mem_map_denoised is not None:
-                    img_flat_list += [img_mem_map_denoised]
-                    img_flat_count += 1
-                    update_progress(
-                        img_flat_count / max_images * 100,
-                        prefix=img_source_path.name,
-                        posix=f'flat: {img_flat_count}, non-flat: {img_non_flat_count}/{batch_size}                    '
-                    )
-            except Empty:
-                pass
-        running_processes = future_running_processes
+    workers = max(1, batch_size)
+    groups = max(1, min(groups, workers))
+    args_queue = Queue(maxsize=4 * workers)
+    accepted = Value('i', 0)
+    feeding_done = Value('b', 0)
+    stop = Event()
+    feeder = Thread(target=feed_paths, daemon=True, args=(
+        args_queue, img_path_generator(img_source_path), accepted, max_images, feeding_done, stop))
+    feeder.start()
+    progress_queue = Queue()
+    for worker in range(workers):
+        MultiProcessFlatAccumulator(
+            progress_queue, args_queue, accepted, feeding_done, tile_size,
+            classifier_model=classifier_model,
+            max_images=max_images,
+            group=worker % groups,
+            groups=groups,
+            patience_before_skipping=patience_before_skipping,
+            skips=skips
+        ).start()
+    results = progress_manager(progress_queue, workers, max_images, desc=img_source_path.name, unit=" flat images")
+    stop.set()
+    feeder.join()
+    # paths that were never consumed should not keep the interpreter from exiting
+    args_queue.cancel_join_thread()
+    args_queue.close()
+    progress_queue.cancel_join_thread()
+    progress_queue.close()
+    if not isinstance(results, list):
+        results = []
+
+    accumulator, img_mean_list = MedianOfMeans(groups=groups), []
+    for worker_accumulator, worker_img_mean_list in results:
+        accumulator.merge(worker_accumulator)
+        img_mean_list += worker_img_mean_list
+    img_flat_count = accumulator.count
 
     if img_flat_count > 0:
-        # img_flat_median = np.median(img_flat_list, axis=0)
-        # img_flat_median = denoise_bilateral(img_flat_median, sigma_spatial=sigma_spatial, mode="edge")
-        # img_flat_median = img_flat_median / img_flat_median.max()
-        img_flat_mean = stats.trim_mean(img_flat_list, 0.1, axis=0)
-        img_flat_mean = denoise_bilateral(img_flat_mean, sigma_spatial=sigma_spatial, mode="edge")
+        img_flat_mean = denoise_bilateral(accumulator.estimate(), sigma_spatial=sigma_spatial, mode="edge")
         img_flat_mean = img_flat_mean / img_flat_mean.max()
         dark = int(round(float(np.median(img_mean_list)/np.median(img_flat_mean)), 0))
         if save_as_tiff:
@@ -266,16 +285,12 @@ def create_flat_img(
                 img_source_path.parent / (img_source_path.name + '_flat.tif'),
                 img_flat_mean,
             )
-            # imsave_tif(
-            #     img_source_path.parent / (img_source_path.name + '_flat_mean.tif'),
-            #     img_flat_mean,
-            # )
             with open(img_source_path.parent / (img_source_path.name + '_dark.txt'), "w") as f:
                 f.write(str(dark))
-        update_progress(100, prefix=img_source_path.name, posix=f'found: {img_flat_count}\n')
+        print(f"{img_source_path.name}: found {img_flat_count} flat images.")
         return img_flat_mean, dark
     else:
-        print("no flat image found!")
+        print(f"{PrintColors.FAIL}no flat image found!{PrintColors.ENDC}")
         raise RuntimeError
 
 
@@ -1,71 +1,150 @@
+import abc
 import os
-import sys
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
 from concurrent.futures.process import BrokenProcessPool
-from imaris_ims_file_reader.ims import ims
+from collections import deque
+from datetime import datetime
+from io import BytesIO
 from math import ceil, floor, sqrt
-from multiprocessing import Queue, Process, Manager, freeze_support
+from multiprocessing import Queue, Process, Value, Array, Lock, Condition, Semaphore, freeze_support
 from pathlib import Path
 from queue import Empty
-from time import time, sleep
+from struct import pack
+from threading import Thread
+from time import time
 from typing import List, Tuple, Union, Callable
+from zlib import compressobj, crc32, DEFLATED, MAX_WBITS, Z_SYNC_FLUSH, Z_FINISH
 
-from contextlib import contextmanager
-# import h5py
-# import hdf5plugin
+from h5py import File
 from numpy import floor as np_floor
 from numpy import max as np_max
 from numpy import mean as np_mean
 from numpy import round as np_round
 from numpy import sqrt as np_sqrt
-from numpy import (zeros, float32, dstack, rollaxis, savez_compressed, array, maximum, rot90, arange, uint8, uint16, flip,
-                   stack)
-from psutil import cpu_count, virtual_memory
-from skimage.measure import block_reduce
+from numpy import dtype as np_d_type
+from numpy import (zeros, empty, float32, array, maximum, add, multiply, copyto, rot90,
+                   arange, uint8, uint16, flip, stack, exp, ndarray, ascontiguousarray)
+from numpy.lib.format import write_array_header_1_0, write_array, dtype_to_descr
+from psutil import cpu_count, virtual_memory, NoSuchProcess, STATUS_ZOMBIE, Process as psutil_process
+from scipy.ndimage import gaussian_filter, zoom
 from skimage.transform import resize, resize_local_mean
 from tifffile import natural_sorted
 from tqdm import tqdm
 
 from pystripe.core import (imread_tif_raw_png, imsave_tif, progress_manager, is_uniform_2d, is_uniform_3d,
-                           convert_to_8bit_fun, convert_to_16bit_fun)
+                           convert_to_8bit_fun, convert_to_16bit_fun, IntensityHistogram)
 from supplements.cli_interface import PrintColors, date_time_now
 from tsv.volume import TSVVolume, VExtent
 
+try:
+    import hdf5plugin  # registers the compression filters that Imaris files may use
+except ImportError:
+    hdf5plugin = None
+
 def imread_tsv(tsv_volume: TSVVolume, extent: VExtent, d_type: str):
     return tsv_volume.imread(extent, d_type)[0]
 
 
-class ImarisZWrapper:
-    @staticmethod
-    @contextmanager
-    def _suppress_stdout():
-        with open(os.devnull, "w") as devnull:
-            old_stdout = sys.stdout
-            sys.stdout = devnull
+def ims_attribute(attrs, name: str) -> str:
+    """Imaris stores attributes as arrays of single characters"""
+    value = attrs[name]
+    if isinstance(value, bytes):
+        return value.decode()
+    return b"".join(value).decode()
+
+
+def ims_channel_group_path(resolution_level: int = 0, timepoint: int = 0, channel: int = 0) -> str:
+    return f"DataSet/ResolutionLevel {resolution_level}/TimePoint {timepoint}/Channel {channel}"
+
+
+def ims_resolution_shapes(ims_path: Union[Path, str], timepoint: int = 0, channel: int = 0) -> List[Tuple[int, ...]]:
+    """zyx shapes of all resolution levels of an Imaris file"""
+    shapes = []
+    with File(ims_path, mode="r") as ims_file:
+        resolution_level = 0
+        while ims_channel_group_path(resolution_level, timepoint, channel) in ims_file:
+            group = ims_file[ims_channel_group_path(resolution_level, timepoint, channel)]
             try:
-                yield
-            finally:
-                sys.stdout = old_stdout
+                shapes += [tuple(int(ims_attribute(group.attrs, f"ImageSize{axis}")) for axis in "ZYX")]
+            except KeyError:
+                shapes += [tuple(group["Data"].shape)]
+            resolution_level += 1
+    return shapes
+
+
+def select_ims_resolution_level(
+        ims_path: Union[Path, str],
+        source_voxel: Tuple[float, float, float],
+        target_voxel: Union[int, float],
+        timepoint: int = 0,
+        channel: int = 0
+) -> Tuple[int, Tuple[float, float, float]]:
+    """
+    Find the coarsest resolution level that still has to be down-sampled to reach the target voxel size.
+
+    source_voxel: tuple
+        voxel sizes of resolution level 0 in um and zyx order.
+    target_voxel: float
+        down-sampled isotropic voxel size in um.
+
+    returns: the resolution level and its voxel sizes in um and zyx order.
+    """
+    shapes = ims_resolution_shapes(ims_path, timepoint=timepoint, channel=channel)
+    resolution_level, level_voxel = 0, tuple(source_voxel)
+    for level, shape in enumerate(shapes[1:], start=1):
+        voxel = tuple(v * s0 / s for v, s0, s in zip(source_voxel, shapes[0], shape))
+        # an axis may only be coarser than the target if it was already coarser at level 0
+        if all(v <= max(target_voxel, v0) * 1.0001 for v, v0 in zip(voxel, source_voxel)):
+            resolution_level, level_voxel = level, voxel
+    return resolution_level, level_voxel
+
+
+class ImarisZWrapper:
+    """
+    z-plane access to one channel of an Imaris file.
 
-    def __init__(self, ims_path, timepoint=0, channel=0):
-        with self._suppress_stdout():
-            self.imaris_data = ims(ims_path)
+    Planes are served from whole z-slabs aligned to the HDF5 chunks,
+    so each chunk is decompressed once no matter how its planes are requested.
+    """
+    def __init__(self, ims_path, timepoint=0, channel=0, resolution_level=0):
+        self.ims_file = File(ims_path, mode="r")
+        group = self.ims_file[ims_channel_group_path(resolution_level, timepoint, channel)]
+        self.imaris_data = group["Data"]
         self.timepoint = timepoint
         self.channel = channel
-        self.num_z = self.imaris_data.shape[2]
+        self.resolution_level = resolution_level
+        # the Data array is padded to a multiple of the chunk shape
+        try:
+            self.shape = tuple(int(ims_attribute(group.attrs, f"ImageSize{axis}")) for axis in "ZYX")
+        except KeyError:
+            self.shape = tuple(self.imaris_data.shape)
+        self.num_z = self.shape[0]
+        self.dtype = self.imaris_data.dtype
+        self.slab_depth = self.imaris_data.chunks[0] if self.imaris_data.chunks else 1
+        self.slab_z0 = None
+        self.slab = None
+
+    def read_slab(self, z: int) -> ndarray:
+        z0 = z - z % self.slab_depth
+        if self.slab_z0 != z0:
+            self.slab = self.imaris_data[z0:min(z0 + self.slab_depth, self.num_z), :self.shape[1], :self.shape[2]]
+            self.slab_z0 = z0
+        return self.slab
 
     def __getitem__(self, z):
         if isinstance(z, slice):
             indices = range(*z.indices(self.num_z))
-            return stack([self.imaris_data[self.timepoint, self.channel, zi, :, :] for zi in indices])
-        return self.imaris_data[self.timepoint, self.channel, z, :, :]
+            return stack([self[zi] for zi in indices])
+        if z < 0:
+            z += self.num_z
+        return self.read_slab(z)[z - self.slab_z0]
 
     def __len__(self):
         return self.num_z
 
     def close(self):
-        with self._suppress_stdout():
-            self.imaris_data.close()
+        self.slab = None
+        self.ims_file.close()
 
     def __enter__(self):
         return self
@@ -80,14 +159,407 @@ class ImarisZWrapper:
             pass
 
 
+class MemoryBudget:
+    """
+    Memory shared by the worker processes.
+
+    Workers reserve the bytes they need before reading an image and release them after saving it.
+    Reservations are served in ticket order, so large requests are not starved by small ones, and waiting workers
+    sleep on their own semaphore instead of polling the free memory. A semaphore, unlike a condition, is not left
+    blocked by a waiter that was killed.
+    Waiting workers wake up every check_interval seconds to take back the reservations and tickets of workers that
+    died, so a killed worker does not block the others forever.
+    """
+    def __init__(self, budget: int, workers: int, check_interval: float = 30):
+        self.budget = budget
+        self.check_interval = check_interval
+        self.reserved = Value('q', 0, lock=False)
+        self.next_ticket = Value('q', 0, lock=False)
+        self.now_serving = Value('q', 0, lock=False)
+        self.pids = Array('q', workers, lock=False)
+        self.reserved_by = Array('q', workers, lock=False)  # bytes reserved by each worker
+        self.waiting_ticket = Array('q', [-1] * workers, lock=False)  # ticket each worker is waiting with
+        self.lock = Lock()
+        self.wake_ups = [Semaphore(0) for _ in range(workers)]
+
+    def acquire(self, worker_id: int, needed: int):
+        wake_up = self.wake_ups[worker_id]
+        with self.lock:
+            self.pids[worker_id] = os.getpid()
+            ticket = self.next_ticket.value
+            self.next_ticket.value += 1
+            self.waiting_ticket[worker_id] = ticket
+        while True:
+            with self.lock:
+                # a request larger than the whole budget is served alone
+                if self.now_serving.value == ticket and (
+                        self.reserved.value == 0 or self.reserved.value + needed <= self.budget):
+                    self.waiting_ticket[worker_id] = -1
+                    self.reserved.value += needed
+                    self.reserved_by[worker_id] += needed
+                    self.now_serving.value += 1
+                    self.wake_waiting()
+                    return
+                while wake_up.acquire(False):
+                    pass
+            if not wake_up.acquire(timeout=self.check_interval):
+                with self.lock:
+                    self.reclaim_dead_workers()
+
+    def release(self, worker_id: int, needed: int):
+        with self.lock:
+            self.reserved.value -= needed
+            self.reserved_by[worker_id] -= needed
+            self.wake_waiting()
+
+    def wake_waiting(self):
+        """the lock must be held"""
+        for worker_id, ticket in enumerate(self.waiting_ticket):
+            if ticket >= 0:
+                self.wake_ups[worker_id].release()
+
+    def reclaim_dead_workers(self):
+        """release the reservations and skip the tickets of dead workers. The lock must be held."""
+        live_tickets = set()
+        for worker_id, pid in enumerate(self.pids):
+            if pid == 0:
+                continue
+            if is_alive(pid):
+                if self.waiting_ticket[worker_id] >= 0:
+                    live_tickets.add(self.waiting_ticket[worker_id])
+                continue
+            if self.reserved_by[worker_id] > 0:
+                print(f"{PrintColors.WARNING}worker {worker_id} died, its {self.reserved_by[worker_id]} reserved "
+                      f"bytes are released{PrintColors.ENDC}")
+                self.reserved.value -= self.reserved_by[worker_id]
+                self.reserved_by[worker_id] = 0
+            self.waiting_ticket[worker_id] = -1
+            self.pids[worker_id] = 0
+        # every ticket that is not served yet belongs to a waiting worker, so tickets without one were dead workers'
+        while self.now_serving.value < self.next_ticket.value and self.now_serving.value not in live_tickets:
+            self.now_serving.value += 1
+        self.wake_waiting()
+
+
+def is_alive(pid: int) -> bool:
+    try:
+        return psutil_process(pid).status() != STATUS_ZOMBIE
+    except NoSuchProcess:
+        return False
+
+
+class PlaneSink(abc.ABC):
+    """
+    Receives every processed plane of parallel_image_processor, so one read of a plane feeds several outputs.
+
+    A sink is copied into every worker, where consume is called for each plane in the worker's order.
+    worker_result returns the partial result of a worker at its end and reduce merges them in the parent.
+    start is called in the parent once the workers are running, for sinks that consume in the parent.
+    """
+    def start(self, first_idx: int, num_images: int):
+        pass
+
+    @abc.abstractmethod
+    def consume(self, idx: int, img: ndarray):
+        pass
+
+    def worker_result(self):
+        return None
+
+    def reduce(self, results: list, success: bool):
+        pass
+
+
+class MaxIntensityProjectionSink(PlaneSink):
+    def __init__(self, save_path: Path = None):
+        """Maximum intensity projection along z, saved as tif if save_path is given"""
+        self.save_path = save_path
+        self.mip = None
+
+    def consume(self, idx: int, img: ndarray):
+        if self.mip is None:
+            self.mip = img.copy()
+        elif self.mip.shape == img.shape:
+            maximum(self.mip, img, out=self.mip)
+
+    def worker_result(self):
+        return self.mip
+
+    def reduce(self, results: list, success: bool):
+        for mip in results:
+            if mip is not None:
+                self.consume(0, mip)
+        if success and self.save_path is not None and self.mip is not None:
+            imsave_tif(self.save_path, self.mip)
+
+
+class HistogramSink(PlaneSink):
+    def __init__(self, bins: int = 65536, save_path: Path = None):
+        """IntensityHistogram of the processed planes, saved as npy if save_path is given"""
+        self.save_path = save_path
+        self.histogram = IntensityHistogram(bins)
+
+    def consume(self, idx: int, img: ndarray):
+        self.histogram.add(img)
+
+    def worker_result(self):
+        return self.histogram
+
+    def reduce(self, results: list, success: bool):
+        for histogram in results:
+            self.histogram.merge(histogram)
+        if success and self.save_path is not None:
+            self.histogram.save(self.save_path)
+
+
+class OrderedPlaneSink(PlaneSink):
+    """
+    Base of sinks that need the planes in z order, like pyramid writers, and write them in the parent.
+
+    Workers send the planes through a bounded queue, so they block when the writer falls behind,
+    and a thread of the parent reorders and writes them.
+    A worker also blocks before sending a plane that is max_lag or more planes ahead of the next plane to write,
+    so the reorder buffer never holds more than max_lag planes. parallel_image_processor hands out the planes in
+    increasing z order when such a sink is given, so the next plane to write is never held by a blocked worker.
+    """
+    def __init__(self, queue_size: int = 32, max_lag: int = None):
+        self.queue = Queue(maxsize=queue_size)
+        self.max_lag = queue_size if max_lag is None else max(1, max_lag)
+        self.next_idx = Value('q', -1, lock=False)  # -1 until start is called in the parent
+        self.progressed = Condition()
+        self.thread = None
+        self.stop = False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["thread"] = None
+        return state
+
+    def start(self, first_idx: int, num_images: int):
+        self.set_next_idx(first_idx)
+        self.thread = Thread(target=self.drain, args=(first_idx, num_images), daemon=True)
+        self.thread.start()
+
+    def set_next_idx(self, next_idx: int):
+        with self.progressed:
+            self.next_idx.value = next_idx
+            self.progressed.notify_all()
+
+    def consume(self, idx: int, img: ndarray):
+        with self.progressed:
+            self.progressed.wait_for(lambda: 0 <= self.next_idx.value and idx < self.next_idx.value + self.max_lag)
+        # the queue pickles in a feeder thread and the plane may be a reused buffer of the worker
+        self.queue.put((idx, img.copy()))
+
+    def drain(self, first_idx: int, num_images: int):
+        pending = {}
+        next_idx = first_idx
+        while next_idx < first_idx + num_images and not self.stop:
+            try:
+                idx, img = self.queue.get(timeout=1)
+            except Empty:
+                continue
+            pending[idx] = img
+            if next_idx in pending:
+                while next_idx in pending:
+                    self.write(pending.pop(next_idx))
+                    next_idx += 1
+                self.set_next_idx(next_idx)
+
+    @abc.abstractmethod
+    def write(self, img: ndarray):
+        pass
+
+    def reduce(self, results: list, success: bool):
+        if not success:
+            self.stop = True
+        if self.thread is not None:
+            self.thread.join()
+        self.close()
+
+    def close(self):
+        pass
+
+
+class ZBlockScheduler:
+    """
+    Tasks are handed out in contiguous blocks, one block per worker, so each worker reads neighbouring z planes.
+    A worker that finishes its block steals the upper half of the largest remaining block.
+    The tasks of the preview lane are handed out before the blocks to get a sparse sample of the whole volume early,
+    and are skipped when the blocks reach them.
+    """
+    def __init__(self, tasks: list, workers: int, preview: List[int] = ()):
+        self.tasks = tasks
+        self.preview = tuple(preview)
+        self.skip = frozenset(preview)
+        self.lock = Lock()
+        bounds = [len(tasks) * worker // workers for worker in range(workers + 1)]
+        self.next = Array('q', bounds[:-1], lock=False)
+        self.end = Array('q', bounds[1:], lock=False)
+        self.preview_next = Value('q', 0, lock=False)
+
+    def get(self, worker: int):
+        """The next task of the worker, or None if no task is left"""
+        with self.lock:
+            if self.preview_next.value < len(self.preview):
+                self.preview_next.value += 1
+                return self.tasks[self.preview[self.preview_next.value - 1]]
+            while True:
+                if self.next[worker] < self.end[worker]:
+                    position = self.next[worker]
+                    self.next[worker] += 1
+                    if position in self.skip:
+                        continue
+                    return self.tasks[position]
+                victim = max(range(len(self.next)), key=lambda v: self.end[v] - self.next[v])
+                remaining = self.end[victim] - self.next[victim]
+                if remaining <= 0:
+                    return None
+                split = self.next[victim] + remaining // 2
+                self.next[worker], self.end[worker] = split, self.end[victim]
+                self.end[victim] = split
+
+
+def orient_plane(img: ndarray, rotation: int = 0, flip_y: bool = False, flip_x: bool = False) -> ndarray:
+    """strided view of the plane after rotation and flips"""
+    if rotation in (90, 180, 270):
+        img = rot90(img, rotation // 90)
+    if flip_x:
+        img = flip(img, axis=1)
+    if flip_y:
+        img = flip(img, axis=0)
+    return img
+
+
+def unorient_plane(img: ndarray, rotation: int = 0, flip_y: bool = False, flip_x: bool = False) -> ndarray:
+    """strided view of an oriented plane in the source orientation"""
+    if flip_y:
+        img = flip(img, axis=0)
+    if flip_x:
+        img = flip(img, axis=1)
+    if rotation in (90, 180, 270):
+        img = rot90(img, -(rotation // 90))
+    return img
+
+
+class DownsamplingArena:
+    """
+    Reusable float32 buffers of one worker for down-sampling planes and z-groups.
+
+    The buffers are allocated once per combination of shapes, so down-sampling a plane in the steady state
+    does not allocate: reductions are strided in-place ufuncs and the final resize writes into the z-stack.
+    """
+    def __init__(self):
+        self.key = None
+        self.source = None
+        self.steps = []
+        self.sigma = None
+        self.filtered = None
+        self.zoom_factors = None
+        self.z_stack = None
+        self.oriented = None
+
+    def orient(self, img: ndarray, rotation: int = 0, flip_y: bool = False, flip_x: bool = False) -> ndarray:
+        """Write the rotated and flipped plane into a reused contiguous buffer, or return the plane if unchanged"""
+        view = orient_plane(img, rotation=rotation, flip_y=flip_y, flip_x=flip_x)
+        if view is img:
+            return img
+        if self.oriented is None or self.oriented.shape != view.shape or self.oriented.dtype != view.dtype:
+            self.oriented = empty(view.shape, dtype=view.dtype)
+        copyto(self.oriented, view)
+        return self.oriented
+
+    def configure(self, source_shape: Tuple[int, int], target_shape: Tuple[int, int],
+                  methods: Union[list, tuple], z_depth: int):
+        """Allocate the buffers unless they already fit the given shapes"""
+        target_shape = tuple(target_shape)
+        key = (tuple(source_shape), target_shape, tuple(methods))
+        if key != self.key:
+            self.key = key
+            self.source = empty(source_shape, dtype=float32)
+            self.steps = []
+            shape = list(source_shape)
+            for y_method, x_method in methods:
+                if y_method is not None and ceil(shape[0] / 2) >= target_shape[0]:
+                    shape[0] = ceil(shape[0] / 2)
+                    self.steps += [(0, y_method, empty(shape, dtype=float32))]
+                if x_method is not None and ceil(shape[1] / 2) >= target_shape[1]:
+                    shape[1] = ceil(shape[1] / 2)
+                    self.steps += [(1, x_method, empty(shape, dtype=float32))]
+            self.zoom_factors = None
+            self.filtered = None
+            if tuple(shape) != target_shape:
+                # the same anti-aliasing and interpolation as skimage.transform.resize
+                factors = array(shape) / array(target_shape)
+                self.zoom_factors = tuple(1 / factors)
+                self.sigma = tuple(maximum(0, (factors - 1) / 2))
+                if any(sigma > 0 for sigma in self.sigma):
+                    self.filtered = empty(shape, dtype=float32)
+        if self.z_stack is None or self.z_stack.shape[1:] != target_shape or self.z_stack.shape[0] < z_depth:
+            self.z_stack = zeros((z_depth,) + target_shape, dtype=float32)
+
+    @staticmethod
+    def reduce_pair(a: ndarray, b: ndarray, out: ndarray, method: Callable):
+        if method is np_max:
+            maximum(a, b, out=out)
+        else:
+            add(a, b, out=out)
+            multiply(out, 0.5, out=out)
+
+    @staticmethod
+    def reduce_tail(a: ndarray, out: ndarray, method: Callable):
+        """the last block of an odd axis is padded with zeros, the same as block_reduce"""
+        if method is np_max:
+            maximum(a, 0, out=out)
+        else:
+            multiply(a, 0.5, out=out)
+
+    def downsample(self, img: ndarray, out: ndarray):
+        """Down-sample a 2D image into out, which has the target shape"""
+        copyto(self.source, img, casting="unsafe")
+        src = self.source
+        for axis, method, buffer in self.steps:
+            half = src.shape[axis] // 2
+            if axis == 0:
+                self.reduce_pair(src[0:2 * half:2], src[1:2 * half:2], buffer[:half], method)
+                if src.shape[0] % 2:
+                    self.reduce_tail(src[-1], buffer[-1], method)
+            else:
+                self.reduce_pair(src[:, 0:2 * half:2], src[:, 1:2 * half:2], buffer[:, :half], method)
+                if src.shape[1] % 2:
+                    self.reduce_tail(src[:, -1], buffer[:, -1], method)
+            src = buffer
+        if self.zoom_factors is None:
+            copyto(out, src)
+            return
+        if self.filtered is not None:
+            gaussian_filter(src, self.sigma, output=self.filtered, mode="mirror")
+            src = self.filtered
+        zoom(src, self.zoom_factors, output=out, order=1, mode="mirror", grid_mode=True)
+
+    def reduce_z(self, depth: int, methods: Union[list, tuple]) -> ndarray:
+        """Reduce the first depth planes of the z-stack in place and return the remaining planes"""
+        z_stack = self.z_stack
+        for method in methods:
+            if method is None or depth <= 1:
+                continue
+            half = depth // 2
+            for idx in range(half):
+                self.reduce_pair(z_stack[2 * idx], z_stack[2 * idx + 1], z_stack[idx], method)
+            if depth % 2:
+                self.reduce_tail(z_stack[depth - 1], z_stack[half], method)
+            depth = ceil(depth / 2)
+        return z_stack[:depth]
+
+
 class MultiProcess(Process):
     def __init__(
             self,
             progress_queue: Queue,
             args_queue: Queue,
-            semaphore: Queue,
+            memory_budget: Union[MemoryBudget, None],
             function: Callable,
-            images: Union[List[str], str],
+            images: Union[Tuple[str, ...], List[str], str, TSVVolume],
             save_path: Path,
             args: tuple,
             kwargs: dict,
@@ -107,12 +579,21 @@ class MultiProcess(Process):
             save_images: bool = True,
             alternating_downsampling_method: bool = True,
             down_sampled_dtype: str = "float32",
+            resolution_level: int = 0,
+            z_scheduler: ZBlockScheduler = None,
+            worker_id: int = 0,
+            sinks: List[PlaneSink] = None,
+            sink_queue: Queue = None,
     ):
         Process.__init__(self)
         self.daemon = False
         self.progress_queue = progress_queue
         self.args_queue = args_queue
-        self.semaphore = semaphore
+        self.z_scheduler = z_scheduler
+        self.worker_id = worker_id
+        self.sinks = sinks or []
+        self.sink_queue = sink_queue
+        self.memory_budget = memory_budget
         self.needed_memory = needed_memory
         self.function = function
         self.is_ims = False
@@ -126,6 +607,7 @@ class MultiProcess(Process):
         else:
             assert Path(images[0]).suffix.lower() in (".tif", ".tiff", ".raw", ".png")
         self.channel = channel
+        self.resolution_level = resolution_level
         self.images = images
         self.save_path = save_path
         self.save_images = save_images
@@ -186,6 +668,22 @@ class MultiProcess(Process):
 
         self.down_sampling_methods = down_sampling_methods
 
+    def configure_arena(self, arena: DownsamplingArena, oriented_shape: Tuple[int, int], z_depth: int) -> ndarray:
+        """
+        Planes are down-sampled in the source orientation and only the small result is rotated,
+        so for 90 and 270 degrees the target shape and the per-axis methods are swapped.
+        Returns the z-stack in the source orientation.
+        """
+        if self.rotation in (90, 270):
+            arena.configure(
+                tuple(oriented_shape[1::-1]), tuple(self.target_shape[::-1]),
+                [methods[::-1] for methods in self.down_sampling_methods], z_depth)
+        else:
+            arena.configure(oriented_shape, self.target_shape, self.down_sampling_methods, z_depth)
+        z_stack = arena.z_stack[:z_depth]
+        z_stack.fill(0)
+        return z_stack
+
     def imsave_tif(self, path, img, compression=None):
         die = imsave_tif(path, img, compression=compression)
         if die:
@@ -207,14 +705,25 @@ class MultiProcess(Process):
             else:
                 return self.save_path / file.name
 
-    def free_ram_is_not_enough(self):
-        self.semaphore.get(block=True)
-        free_ram_is_not_enough = False
-        if self.needed_memory is not None and virtual_memory().available < self.needed_memory:
-            free_ram_is_not_enough = True
-            sleep(1)
-        self.semaphore.put(1)
-        return free_ram_is_not_enough
+    def next_task(self, timeout: float) -> Tuple[int, List[int]]:
+        if self.z_scheduler is not None:
+            task = self.z_scheduler.get(self.worker_id)
+            if task is None:
+                raise Empty
+            return task
+        return self.args_queue.get(block=True, timeout=timeout)
+
+    def feed_sinks(self, idx: int, img: ndarray):
+        for sink in self.sinks:
+            sink.consume(idx, img)
+
+    def reserve_memory(self):
+        if self.memory_budget is not None and self.needed_memory is not None:
+            self.memory_budget.acquire(self.worker_id, self.needed_memory)
+
+    def release_memory(self):
+        if self.memory_budget is not None and self.needed_memory is not None:
+            self.memory_budget.release(self.worker_id, self.needed_memory)
 
     def run(self):
         running_next: bool = True
@@ -260,16 +769,16 @@ class MultiProcess(Process):
         if is_tsv:
             x0, x1, y0, y1 = images.volume.x0, images.volume.x1, images.volume.y0, images.volume.y1
         if is_ims:
-            images = ImarisZWrapper(images, timepoint=0, channel=channel)
+            images = ImarisZWrapper(images, timepoint=0, channel=channel, resolution_level=self.resolution_level)
             num_images = len(images)
 
+        sinks = self.sinks
+        arena = DownsamplingArena()
         queue_time_out = 20
-        while not self.die and self.args_queue.qsize() > 0:
-            if self.free_ram_is_not_enough():
-                continue
+        while not self.die and (self.z_scheduler is not None or self.args_queue.qsize() > 0):
             try:
                 queue_start_time = time()
-                idx_down_sampled, indices = self.args_queue.get(block=True, timeout=queue_time_out)
+                idx_down_sampled, indices = self.next_task(queue_time_out)
                 queue_time_out = max(queue_time_out, 0.9 * queue_time_out + 0.3 * (time() - queue_start_time))
                 z_stack = None
                 down_sampled_tif_path = Path()
@@ -283,31 +792,30 @@ class MultiProcess(Process):
                         for idx_z, idx in enumerate(indices):
                             if self.tif_save_path(idx, images, flip_z=flip_z).exists():
                                 exist_count += 1
-                        if len(indices) == exist_count:
+                        if len(indices) == exist_count and not sinks:
                             for _ in range(exist_count):
                                 self.progress_queue.put(running_next)
                             continue
-                    z_stack = zeros((len(indices),) + self.target_shape, dtype=float32)
+                    z_stack = self.configure_arena(arena, post_processed_shape, len(indices))
                 #print(f"Debug: dsp: {down_sampled_tif_path}")
                 # print(f"Debug: z-stack: {z_stack}")
                 #sys.exit()
                 for idx_z, idx in enumerate(indices):
-                    if self.die:
-                        break
-                    while self.free_ram_is_not_enough():
-                        continue
                     if self.die:
                         break
                     tif_save_path = self.tif_save_path(idx, images, flip_z=flip_z)
                     # print(tif_save_path)
-                    if resume and tif_save_path.exists() and not need_down_sampling:  # function is not None and
+                    if resume and tif_save_path.exists() and not need_down_sampling and not sinks:
                         self.progress_queue.put(running_next)
                         continue
+                    self.reserve_memory()
+                    delivered = False
                     try:
                         if resume and tif_save_path.exists():
-                            img = None
-                            if need_down_sampling:
-                                img = imread_tif_raw_png(tif_save_path)
+                            img, oriented = None, None
+                            if need_down_sampling or sinks:
+                                oriented = imread_tif_raw_png(tif_save_path)
+                                img = unorient_plane(oriented, rotation=rotation, flip_y=flip_y, flip_x=flip_x)
                         else:
                             if is_ims:
                                 img = images[idx]
@@ -337,51 +845,41 @@ class MultiProcess(Process):
                                 else:
                                     img = function(img)
 
-                            # apply rotations
-                            if rotation == 90:
-                                img = rot90(img, 1)
-                            elif rotation == 180:
-                                img = rot90(img, 2)
-                            elif rotation == 270:
-                                img = rot90(img, 3)
-
-                            # apply flips
-                            if flip_x:
-                                img = flip(img, axis=1)
-                            if flip_y:
-                                img = flip(img, axis=0)
+                            # apply rotations and flips: one write into a reused buffer and only if the plane is used
+                            # at full resolution, since down-sampling works on the source orientation
+                            oriented = None
+                            need_saving = save_images and (
+                                    is_tsv or is_ims or function is not None or rotation in (90, 180, 270))
+                            if need_saving or sinks:
+                                oriented = arena.orient(img, rotation=rotation, flip_y=flip_y, flip_x=flip_x)
 
                             # save image
-                            if save_images and (is_tsv or is_ims or function is not None or rotation in (90, 180, 270)):
-                                #print(f"debug: {tif_save_path}")
-                                #print(f"debug: {img}")
-                                #sys.exit()
-                                self.imsave_tif(tif_save_path, img, compression=compression)
+                            if need_saving:
+                                self.imsave_tif(tif_save_path, oriented, compression=compression)
                             if img.dtype != post_processed_d_type:
                                 post_processed_d_type = img.dtype
 
-                            if rotation in (90, 270) or img.shape != post_processed_shape:
-                                post_processed_shape = img.shape
+                            oriented_shape = orient_plane(img, rotation=rotation).shape
+                            if oriented_shape != post_processed_shape:
+                                post_processed_shape = oriented_shape
                                 if need_down_sampling:
                                     self.calculate_down_sampling_target(post_processed_shape, rotation in (90, 270),
                                                                         self.alternating_downsampling_method)
-                                    z_stack = zeros((len(indices),) + self.target_shape, dtype=float32)
+                                    z_stack = self.configure_arena(arena, post_processed_shape, len(indices))
+
+                        if sinks and oriented is not None:
+                            self.feed_sinks(idx, oriented)
+                            delivered = True
 
                         # down-sampling on xy
                         if need_down_sampling and self.target_shape is not None and \
                                 self.down_sampling_methods is not None and img is not None:
                             if is_uniform_2d(img):
-                                z_stack[idx_z] = zeros(self.target_shape, dtype=float32)
+                                z_stack[idx_z].fill(0)
                             else:
-                                img = img.astype(float32)
-                                for y_method, x_method in self.down_sampling_methods:
-                                    if y_method is not None and ceil(img.shape[0] / 2) >= self.target_shape[0]:
-                                        img = block_reduce(img, block_size=(2, 1), func=y_method)
-                                    if x_method is not None and ceil(img.shape[1] / 2) >= self.target_shape[1]:
-                                        img = block_reduce(img, block_size=(1, 2), func=x_method)
-                                # print(img.shape, end='')
-                                img = resize(img, self.target_shape, preserve_range=True, anti_aliasing=True)
-                                z_stack[idx_z] = img.astype(float32)
+                                if img.shape != arena.source.shape:
+                                    self.configure_arena(arena, orient_plane(img, rotation=rotation).shape, 0)
+                                arena.downsample(img, z_stack[idx_z])
 
                     except (BrokenProcessPool, TimeoutError):
                         message = f"\nwarning: {timeout}s timeout reached for processing input file number: {idx}\n"
@@ -405,7 +903,12 @@ class MultiProcess(Process):
                             f"\n\texception arguments: {inst.args}"
                             f"\n\texception: {inst}"
                             f"{PrintColors.ENDC}")
+                    finally:
+                        # also released when an except clause raises, otherwise the reservation blocks the others
+                        self.release_memory()
 
+                    if sinks and not delivered:
+                        self.feed_sinks(idx, zeros(post_processed_shape, dtype=post_processed_d_type))
                     self.progress_queue.put(running_next)
 
                 # approximate down-sampling on the z-axis
@@ -414,11 +917,9 @@ class MultiProcess(Process):
                         self.imsave_tif(down_sampled_tif_path, zeros(self.target_shape, dtype=float32),
                                         compression=compression)
                     else:
-                        for z_method in down_sampling_method_z:
-                            if z_method is not None and z_stack.shape[0] > 1:
-                                z_stack = block_reduce(z_stack, block_size=(2, 1, 1), func=z_method)
+                        z_stack = arena.reduce_z(len(z_stack), down_sampling_method_z)
                         assert z_stack.shape[0] == 1
-                        img = z_stack[0]
+                        img = orient_plane(z_stack[0], rotation=rotation, flip_y=flip_y, flip_x=flip_x)
                         if self.down_sampled_dtype not in (float32, "float32"):
                             if self.down_sampled_dtype in (uint16, "uint16"):
                                 img = convert_to_16bit_fun(img)
@@ -442,6 +943,8 @@ class MultiProcess(Process):
             images.close()
         if isinstance(pool, ProcessPoolExecutor):
             pool.shutdown()
+        if sinks:
+            self.sink_queue.put([sink.worker_result() for sink in sinks])
         self.progress_queue.put(not running_next)
 
 
@@ -472,6 +975,244 @@ def generate_voxel_spacing(
     return axis_spacing
 
 
+def gaussian_kernel_1d(sigma: float) -> Tuple[array, int]:
+    """Normalized gaussian weights truncated at 4 sigma, the same as scipy.ndimage.gaussian_filter1d"""
+    if sigma <= 0:
+        return array([1], dtype=float32), 0
+    radius = int(4 * sigma + 0.5)
+    offsets = arange(-radius, radius + 1)
+    weights = exp(-0.5 * (offsets / sigma) ** 2)
+    return (weights / weights.sum()).astype(float32), radius
+
+
+def mirror_index(idx: int, size: int) -> int:
+    """Index of a sample outside [0, size) in scipy.ndimage's mirror mode (d c b | a b c d | c b a)"""
+    if size == 1:
+        return 0
+    period = 2 * (size - 1)
+    idx = abs(idx) % period
+    return period - idx if idx >= size else idx
+
+
+def prefetched(function: Callable, items: list, lookahead: int):
+    """Yield function(item) in order while the next lookahead items are being computed in threads"""
+    with ThreadPoolExecutor(max(1, lookahead)) as pool:
+        futures = deque()
+        for item in items:
+            futures.append(pool.submit(function, item))
+            if len(futures) > lookahead:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def deflate_chunk(chunk, level: int, final: bool = False) -> bytes:
+    """Raw deflate of one chunk, byte aligned with a sync flush so that independently compressed chunks can be
+    concatenated into a single deflate stream, the same way pigz does."""
+    compressor = compressobj(level, DEFLATED, -MAX_WBITS)
+    return compressor.compress(chunk) + compressor.flush(Z_FINISH if final else Z_SYNC_FLUSH)
+
+
+class ParallelDeflateNpz:
+    def __init__(self, path: Path, workers: int = cpu_count(logical=False), level: int = 6,
+                 chunk_size: int = 2 ** 24):
+        """
+        npz (zip64) writer that compresses the members in chunks on parallel threads.
+        Members are written from an iterable of buffers, so an array does not need to be in memory at once.
+        The result is a regular npz file that numpy.load can read.
+
+        path: Path
+            path of the npz file.
+        workers: int
+            number of compressing threads.
+        level: int
+            zlib compression level.
+        chunk_size: int
+            bytes compressed by each task. Larger buffers are split.
+        """
+        self.file = open(path, "wb")
+        self.workers = max(1, workers)
+        self.level = level
+        self.chunk_size = chunk_size
+        self.entries = []
+        now = datetime.now()
+        self.dos_time = now.hour << 11 | now.minute << 5 | now.second // 2
+        self.dos_date = (now.year - 1980) << 9 | now.month << 5 | now.day
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write_member(self, name: str, buffers):
+        name = name.encode("ascii")
+        offset = self.file.tell()
+        # sizes are in the zip64 extra field and patched after compression
+        self.file.write(pack("<IHHHHHIIIHH", 0x04034b50, 45, 0, 8, self.dos_time, self.dos_date, 0,
+                             0xFFFFFFFF, 0xFFFFFFFF, len(name), 20))
+        self.file.write(name)
+        self.file.write(pack("<HHQQ", 1, 16, 0, 0))
+        crc, size, compressed_size = 0, 0, 0
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = deque()
+            for buffer in buffers:
+                buffer = memoryview(buffer).cast("B")
+                for start in range(0, len(buffer), self.chunk_size):
+                    chunk = buffer[start:start + self.chunk_size]
+                    crc = crc32(chunk, crc)
+                    size += len(chunk)
+                    futures.append(pool.submit(deflate_chunk, chunk, self.level))
+                    while len(futures) > 2 * self.workers:
+                        compressed_size += self.file.write(futures.popleft().result())
+            while futures:
+                compressed_size += self.file.write(futures.popleft().result())
+        compressed_size += self.file.write(deflate_chunk(b"", self.level, final=True))
+        end = self.file.tell()
+        self.file.seek(offset + 14)
+        self.file.write(pack("<I", crc))
+        self.file.seek(offset + 30 + len(name) + 4)
+        self.file.write(pack("<QQ", size, compressed_size))
+        self.file.seek(end)
+        self.entries += [(name, crc, size, compressed_size, offset)]
+
+    def write_array(self, name: str, img: ndarray):
+        """write an array that is already in memory, object arrays are pickled like numpy.savez does"""
+        if img.dtype.hasobject:
+            buffer = BytesIO()
+            write_array(buffer, img, allow_pickle=True)
+            self.write_member(name, [buffer.getbuffer()])
+        else:
+            self.write_planes(name, img.shape, img.dtype, [img.reshape(-1)] if img.size else [])
+
+    def write_planes(self, name: str, shape: Tuple[int, ...], d_type, planes):
+        """write a C-ordered array of the given shape and dtype from an iterable of its consecutive planes"""
+        header = BytesIO()
+        write_array_header_1_0(header, {
+            "descr": dtype_to_descr(np_d_type(d_type)), "fortran_order": False, "shape": tuple(shape)})
+
+        def buffers():
+            yield header.getbuffer()
+            for plane in planes:
+                yield ascontiguousarray(plane, dtype=d_type)
+
+        self.write_member(name, buffers())
+
+    def close(self):
+        if self.file.closed:
+            return
+        cd_offset = self.file.tell()
+        for name, crc, size, compressed_size, offset in self.entries:
+            self.file.write(pack("<IHHHHHHIIIHHHHHII", 0x02014b50, 45, 45, 0, 8, self.dos_time, self.dos_date, crc,
+                                 0xFFFFFFFF, 0xFFFFFFFF, len(name), 28, 0, 0, 0, 0, 0xFFFFFFFF))
+            self.file.write(name)
+            self.file.write(pack("<HHQQQ", 1, 24, size, compressed_size, offset))
+        cd_size = self.file.tell() - cd_offset
+        zip64_offset = self.file.tell()
+        num_entries = len(self.entries)
+        self.file.write(pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, num_entries, num_entries, cd_size,
+                             cd_offset))
+        self.file.write(pack("<IIQI", 0x07064b50, 0, zip64_offset, 1))
+        self.file.write(pack("<IHHHHIIH", 0x06054b50, 0, 0, num_entries, num_entries, 0xFFFFFFFF, 0xFFFFFFFF, 0))
+        self.file.close()
+
+
+def resized_z_planes(
+        files: List[Path],
+        target_shape_3d: Tuple[int, int, int],
+        max_processors: int = cpu_count(logical=False)):
+    """
+    Yield the planes of a series of down-sampled planes resized to the target 3D shape, in z order.
+
+    The result matches skimage.transform.resize(..., preserve_range=True, anti_aliasing=True) of the whole stack:
+    planes are resized on xy one by one if needed, then anti-aliased with a separable gaussian and linearly
+    interpolated on z. Only the planes inside the gaussian window are kept in memory.
+    """
+    num_images = len(files)
+    target_shape_3d = tuple(int(s) for s in target_shape_3d)
+    target_shape_2d = target_shape_3d[1:3]
+    factor = num_images / target_shape_3d[0]
+    weights, radius = gaussian_kernel_1d(max(0., (factor - 1) / 2))
+
+    def read_plane(file):
+        img = imread_tif_raw_png(file)
+        if img.shape != target_shape_2d:
+            img = resize(img, target_shape_2d, preserve_range=True, anti_aliasing=True)
+        return img.astype(float32)
+
+    planes = prefetched(read_plane, files, max_processors)
+    raw_window, filtered_window = {}, {}
+    next_plane = 0
+
+    def filtered(k: int):
+        nonlocal next_plane
+        if k not in filtered_window:
+            needed = [mirror_index(k + offset, num_images) for offset in range(-radius, radius + 1)]
+            while next_plane <= max(needed):
+                raw_window[next_plane] = next(planes)
+                next_plane += 1
+            result = zeros(target_shape_2d, dtype=float32)
+            for weight, idx in zip(weights, needed):
+                result += weight * raw_window[idx]
+            filtered_window[k] = result
+        return filtered_window[k]
+
+    for idx_out in tqdm(range(target_shape_3d[0]), desc="resizing z", unit="planes"):
+        position = (idx_out + 0.5) * factor - 0.5
+        # when up-sampling the first and last positions fall outside the stack and are mirrored like skimage does
+        if num_images == 1:
+            position = 0
+        elif position < 0:
+            position = -position
+        elif position > num_images - 1:
+            position = 2 * (num_images - 1) - position
+        k0 = int(position)
+        k1 = min(k0 + 1, num_images - 1)
+        fraction = float32(position - k0)
+        img = filtered(k0) * (1 - fraction)
+        if fraction > 0:
+            img += filtered(k1) * fraction
+        yield img
+        # a mirrored last position may step back by one plane
+        for k in [k for k in filtered_window if k < k0 - 1]:
+            del filtered_window[k]
+        for idx in [idx for idx in raw_window if idx < k0 - 1 - radius]:
+            del raw_window[idx]
+
+
+def stream_resize_z_to_npz(
+        files: List[Path],
+        target_shape_3d: Tuple[int, int, int],
+        npz_file: Path,
+        axes_spacing: list,
+        max_processors: int = cpu_count(logical=False),
+        compression_level: int = 6):
+    """
+    Resize a series of down-sampled planes to the target 3D shape with resized_z_planes and write the npz file
+    incrementally. The resized planes are compressed on parallel threads as soon as they are ready, so neither the
+    input nor the output volume is ever in memory.
+
+    files: list of Path
+        2D tif series in z order.
+    target_shape_3d: tuple of int
+        zyx shape of the output volume.
+    npz_file: Path
+        path of the output npz file, with the same I and xI arrays that savez_compressed would have written.
+    axes_spacing: list
+        voxel locations of each axis, saved as xI.
+    max_processors: int
+        number of reading and compressing threads.
+    compression_level: int
+        zlib compression level.
+    """
+    target_shape_3d = tuple(int(s) for s in target_shape_3d)
+    with ParallelDeflateNpz(npz_file, workers=max_processors, level=compression_level) as npz:
+        npz.write_planes("I.npy", target_shape_3d, float32,
+                         resized_z_planes(files, target_shape_3d, max_processors=max_processors))
+        # note specify object to avoid "ragged" warning
+        npz.write_array("xI.npy", array(axes_spacing, dtype='object'))
+
+
 def jumpy_step_range(start, end):
     distance = end - start
     steps = [1, ]
@@ -509,7 +1250,10 @@ def parallel_image_processor(
         resume: bool = True,
         needed_memory: int = None,
         save_images: bool = True,
-        return_downsampled_path: bool = False
+        return_downsampled_path: bool = False,
+        locality_scheduling: bool = False,
+        preview_step: int = 100,
+        sinks: List[PlaneSink] = None
 ):
     """
     fun: Callable
@@ -534,6 +1278,8 @@ def parallel_image_processor(
         down-sampled isotropic voxel size in um.
     downsampled_path: Path
         path to save the downsampled image. If None destination path will be used.
+        For ims files, if save_images is False, the coarsest resolution level that is still finer than the
+        target voxel is down-sampled instead of resolution level 0.
     rotation: int
         Rotate the image. One of 0, 90, 180 or 270 degree values are accepted. Default is 0 (no rotation).
     timeout: float
@@ -546,7 +1292,17 @@ def parallel_image_processor(
     progress_bar_name: str
         the name next to the progress bar
     needed_memory: int
-        needed_memory in bytes to run the function. if provided the workers try to avoid out of memory condition.
+        needed_memory in bytes to run the function. if provided, the workers reserve it from a budget of the
+        memory available at start before reading each image and release it after saving, to avoid out of memory
+        condition.
+    locality_scheduling: bool
+        for tsv volumes, give each worker a contiguous block of z-steps (with work stealing at the end) instead of
+        spreading the z-steps, so that the tiles are read sequentially.
+    preview_step: int
+        with locality scheduling, every preview_step-th z-step is stitched first to check the stitching quality.
+    sinks: list of PlaneSink
+        additional outputs that receive every processed plane, e.g. MaxIntensityProjectionSink or HistogramSink.
+        Resumed planes are read back from the destination to feed them.
     """
     if isinstance(source, str):
         source = Path(source)
@@ -568,6 +1324,14 @@ def parallel_image_processor(
     #print(f"Debug: final dsp: {downsampled_path}")
     #sys.exit()
 
+    sinks = sinks or []
+    # ordered sinks bound their reorder buffer, which needs the planes to be handed out in increasing z order
+    in_z_order = any(isinstance(sink, OrderedPlaneSink) for sink in sinks)
+    if in_z_order and locality_scheduling:
+        print(f"{PrintColors.WARNING}locality scheduling is disabled because a sink needs the planes in z order"
+              f"{PrintColors.ENDC}")
+        locality_scheduling = False
+
     down_sampling_z_steps: int = 1
     need_down_sampling: bool = False
     if source_voxel is not None and target_voxel is not None:
@@ -575,40 +1339,60 @@ def parallel_image_processor(
         down_sampling_z_steps = max(1, floor(target_voxel / source_voxel[0]))
 
     args_queue = Queue()
+    z_scheduler = None
+    resolution_level = 0
     if isinstance(source, TSVVolume):
         images = source
         num_images = source.volume.z1 - source.volume.z0
         shape = source.volume.shape[1:3]
         dtype = source.dtype
-        # to test stitching quality first a sample from every 100 z-step will be stitched
+        preview = []
         if need_down_sampling and down_sampling_z_steps > 1:
-            for ds_z_idx, z_range in enumerate(
-                    calculate_downsampling_z_ranges(source.volume.z0, source.volume.z1, down_sampling_z_steps)):
-                args_queue.put((ds_z_idx, z_range))
+            tasks = list(enumerate(
+                calculate_downsampling_z_ranges(source.volume.z0, source.volume.z1, down_sampling_z_steps)))
+        elif locality_scheduling:
+            tasks = [(idx, [idx]) for idx in range(source.volume.z0, source.volume.z1)]
+            # the preview lane stitches every preview_step-th z-step in the jumpy order first
+            preview = [preview_step * idx for idx in jumpy_step_range(0, ceil(len(tasks) / preview_step))]
+        elif in_z_order:
+            tasks = [(idx, [idx]) for idx in range(source.volume.z0, source.volume.z1)]
         else:
-            for idx in jumpy_step_range(source.volume.z0, source.volume.z1):
-                args_queue.put((idx, [idx]))
+            # to test stitching quality first a sample from every 100 z-step will be stitched
+            tasks = [(idx, [idx]) for idx in jumpy_step_range(source.volume.z0, source.volume.z1)]
+        if locality_scheduling:
+            z_scheduler = ZBlockScheduler(tasks, min(max_processors, len(tasks)), preview)
+        else:
+            for task in tasks:
+                args_queue.put(task)
 
     elif source.is_file() and source.suffix.lower() == ".ims":
-        # print(f"ims file detected. hdf5plugin=v{hdf5plugin.version}")
-        # with h5py.File(source) as ims_file:
-        #     img = ims_file[f"DataSet/ResolutionLevel 0/TimePoint 0/Channel {channel}/Data"]
-        #     num_images = img.shape[0]
-        #     shape = img.shape[1:3]
-        #     dtype = img.dtype
-        print(f"ims file detected. using imaris_ims_file_reader!")
-        with ImarisZWrapper(source, timepoint=0, channel=channel) as ims_wrapper:
+        print(f"ims file detected.")
+        if need_down_sampling and not save_images:
+            # only the down-sampled image is needed, so a coarser resolution level may be enough
+            resolution_level, source_voxel = select_ims_resolution_level(
+                source, source_voxel, target_voxel, channel=channel)
+            down_sampling_z_steps = max(1, floor(target_voxel / source_voxel[0]))
+            if resolution_level > 0:
+                print(f"\treading resolution level {resolution_level} with voxel sizes zyx: "
+                      f"{' '.join(f'{v:.3f}' for v in source_voxel)}")
+        with ImarisZWrapper(source, timepoint=0, channel=channel, resolution_level=resolution_level) as ims_wrapper:
             num_images = len(ims_wrapper)  # Number of Z planes
-            img0 = ims_wrapper[0]  # Example 2D image to get shape and dtype
-            shape = img0.shape  # (Y, X)
-            dtype = img0.dtype
+            shape = ims_wrapper.shape[1:3]  # (Y, X)
+            dtype = ims_wrapper.dtype
+            slab_depth = ims_wrapper.slab_depth
 
         if need_down_sampling and down_sampling_z_steps > 1:
             for ds_z_idx, z_range in enumerate(calculate_downsampling_z_ranges(0, num_images, down_sampling_z_steps)):
                 args_queue.put((ds_z_idx, z_range))
-        else:
+        elif need_down_sampling:
+            # every task is reduced to one down-sampled plane, so slabs would be squashed into one plane.
+            # consecutive planes still reuse the decompressed chunks through the slab cache of ImarisZWrapper.
             for idx in range(num_images):
                 args_queue.put((idx, [idx]))
+        else:
+            # each worker gets whole chunk-aligned slabs, so no chunk is decompressed by more than one worker
+            for z0 in range(0, num_images, slab_depth):
+                args_queue.put((z0, list(range(z0, min(z0 + slab_depth, num_images)))))
         images = str(source)
     elif source.is_dir():
         images = natural_sorted([str(f) for f in source.iterdir() if f.is_file() and f.suffix.lower() in (
@@ -624,8 +1408,8 @@ def parallel_image_processor(
         img = imread_tif_raw_png(Path(images[0]))
         shape = img.shape
         dtype = img.dtype
-        manager = Manager()
-        images = manager.list(images)
+        # an immutable tuple is inherited (or pickled once) by every worker, so path lookups need no IPC
+        images = tuple(images)
         del img
     else:
         print("source can be either a tsv volume, an ims file path, or a 2D tiff series folder")
@@ -658,9 +1442,9 @@ def parallel_image_processor(
             os.chmod(downsampled_path, 0o777)
 
     progress_queue = Queue()
-    semaphore = Queue()
-    semaphore.put(1)
-    workers = min(max_processors, args_queue.qsize())
+    sink_queue = Queue() if sinks else None
+    workers = min(max_processors, args_queue.qsize() if z_scheduler is None else len(z_scheduler.tasks))
+    memory_budget = None if needed_memory is None else MemoryBudget(virtual_memory().available, workers)
     worker_processes = []
     print(f"{PrintColors.GREEN}{date_time_now()}: {PrintColors.ENDC}starting workers ...")
     for worker in tqdm(range(workers), desc=' workers'):
@@ -672,11 +1456,12 @@ def parallel_image_processor(
             #print(f"Debug print - dsp in multi process: {downsampled_path}")
             #sys.exit()
             worker = MultiProcess(
-                progress_queue, args_queue, semaphore, fun, images, destination, args, kwargs, shape, dtype,
+                progress_queue, args_queue, memory_budget, fun, images, destination, args, kwargs, shape, dtype,
                 rename=rename, tif_prefix=tif_prefix,
                 source_voxel=source_voxel, target_voxel=target_voxel, down_sampled_path=downsampled_path,
                 rotation=rotation, channel=channel, timeout=timeout, compression=compression, resume=resume,
-                needed_memory=needed_memory, save_images=save_images)
+                needed_memory=needed_memory, save_images=save_images, resolution_level=resolution_level,
+                z_scheduler=z_scheduler, worker_id=worker, sinks=sinks, sink_queue=sink_queue)
             worker.start()
             worker_processes.append(worker)
         else:
@@ -684,7 +1469,18 @@ def parallel_image_processor(
             workers = worker
             break
 
+    first_idx = source.volume.z0 if isinstance(source, TSVVolume) else 0
+    for sink in sinks:
+        sink.start(first_idx, num_images)
     return_code = progress_manager(progress_queue, workers, num_images, desc=progress_bar_name)
+    sink_results = [[] for _ in sinks]
+    for _ in range(len(worker_processes) if sinks else 0):
+        try:
+            for results, result in zip(sink_results, sink_queue.get(timeout=60)):
+                results.append(result)
+        except Empty:
+            print(f"{PrintColors.WARNING}a worker did not return the results of its sinks{PrintColors.ENDC}")
+            break
     args_queue.cancel_join_thread()
     args_queue.close()
     progress_queue.cancel_join_thread()
@@ -692,6 +1488,8 @@ def parallel_image_processor(
     for worker in worker_processes:
         worker.terminate()
         worker.join()
+    for sink, results in zip(sinks, sink_results):
+        sink.reduce(results, return_code == 0)
 
     # down-sample on z accurately
     if return_code == 0 and need_down_sampling:
@@ -716,51 +1514,30 @@ def parallel_image_processor(
             
             
         files = sorted(downsampled_path.glob("*.tif"))
-        print(f"Debug: Number of files loaded = {len(files)}") 
-        print(f"Debug: path used: {downsampled_path}")
-            # Using a ThreadPoolExecutor to read and process files concurrently
-        with ThreadPoolExecutor(max_processors) as pool:
-            img_stack = list(pool.map(imread_tif_raw_png, tqdm(files, desc="loading", unit="images")))
-            # print(f"Debug: Shape of img_stack after loading = {img_stack[0].shape} if img_stack else 'Empty'")  # Debugging statement after list creation
-            # print(f"Debug: Shape of img_stack after loading = {img_stack.shape if img_stack else 'Empty'}")
-
-            img_stack = dstack(img_stack)  # yxz format
-            # print(f"Debug: Dimensions of img_stack after dstack = {img_stack.shape}")
-            
-            img_stack = rollaxis(img_stack, -1)  # zyx format
-            print(f"{PrintColors.GREEN}{date_time_now()}: {PrintColors.ENDC}"
-                  f"{PrintColors.BLUE}down-sampling: {PrintColors.ENDC}"
-                  f"resizing the z-axis ...")
-            img_stack = resize(img_stack, target_shape_3d, preserve_range=True, anti_aliasing=True)
-            axes_spacing = generate_voxel_spacing(
-                (num_images, shape[0], shape[1]),
-                source_voxel,
-                target_shape_3d,
-                target_voxel)
-            print(f"{PrintColors.GREEN}{date_time_now()}:{PrintColors.ENDC}"
-                  f"{PrintColors.BLUE} down-sampling: {PrintColors.ENDC}"
-                  f"saving as npz.")
-            
-            if npz_file.exists():
-                stat_info = os.stat(npz_file)
-                permissions = oct(stat_info.st_mode)[-3:]
-                if permissions != '666':
-                    print(f"Permissions for '{npz_file}' are {permissions}. Must update permissions...")
-                    print(f"Modifying npz file: {npz_file}")
-                    # Windows Permission Check
-                    if os.name == 'nt':
-                        os.chmod(npz_file, 0o666)
-                    else:
-                        os.chmod(npz_file, 0o777)
+        axes_spacing = generate_voxel_spacing(
+            (num_images, shape[0], shape[1]),
+            source_voxel,
+            target_shape_3d,
+            target_voxel)
+        if npz_file.exists():
+            stat_info = os.stat(npz_file)
+            permissions = oct(stat_info.st_mode)[-3:]
+            if permissions != '666':
+                print(f"Permissions for '{npz_file}' are {permissions}. Must update permissions...")
+                print(f"Modifying npz file: {npz_file}")
+                # Windows Permission Check
+                if os.name == 'nt':
+                    os.chmod(npz_file, 0o666)
                 else:
-                    print(f"Permissions for '{npz_file}' are correctly set to 777.")
-            else: 
-                print("Permission edit skipped")
-            savez_compressed(
-                npz_file,
-                I=img_stack,
-                xI=array(axes_spacing, dtype='object')  # note specify object to avoid "ragged" warning
-            )
+                    os.chmod(npz_file, 0o777)
+            else:
+                print(f"Permissions for '{npz_file}' are correctly set to 777.")
+        else:
+            print("Permission edit skipped")
+        print(f"{PrintColors.GREEN}{date_time_now()}: {PrintColors.ENDC}"
+              f"{PrintColors.BLUE}down-sampling: {PrintColors.ENDC}"
+              f"resizing the z-axis and streaming to npz ...")
+        stream_resize_z_to_npz(files, target_shape_3d, npz_file, axes_spacing, max_processors=max_processors)
 
     if return_downsampled_path:
         return return_code, downsampled_path
@@ -6,6 +6,7 @@ import logging as log
 import os
 import platform
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from math import floor
 from multiprocessing import freeze_support, Queue, Process, Pool, set_start_method
@@ -21,8 +22,9 @@ from argparse import RawDescriptionHelpFormatter, ArgumentParser, BooleanOptiona
 import mpi4py
 import psutil
 from cpufeature.extension import CPUFeature
-from cv2 import MOTION_TRANSLATION, findTransformECC, TERM_CRITERIA_COUNT, TERM_CRITERIA_EPS
-from numpy import ndarray, zeros, uint8, float32, eye, dstack, append, array, absolute, expm1
+from cv2 import (MOTION_TRANSLATION, findTransformECC, TERM_CRITERIA_COUNT, TERM_CRITERIA_EPS, remap, convertMaps,
+                 CV_16SC2, INTER_LINEAR, BORDER_CONSTANT)
+from numpy import ndarray, zeros, uint8, uint16, int16, float32, eye, dstack, append, array, absolute, expm1, arange
 from numpy import round as np_round
 from numpy.linalg import inv
 from psutil import cpu_count, virtual_memory
@@ -33,13 +35,16 @@ from skimage.filters import sobel
 from skimage.filters.thresholding import threshold_multiotsu
 from torch.cuda import set_per_process_memory_fraction as cuda_set_per_process_memory_fraction
 
-from parallel_image_processor import parallel_image_processor, jumpy_step_range
-from pystripe.core import (batch_filter, imread_tif_raw_png, imsave_tif, MultiProcessQueueRunner, progress_manager,
+from parallel_image_processor import parallel_image_processor, jumpy_step_range, MaxIntensityProjectionSink
+from pystripe.core import (batch_filter, imread_tif_raw_png, imsave_tif, progress_manager,
                            process_img, convert_to_8bit_fun, log1p_jit, prctl, np_max, np_mean, is_uniform_2d,
-                           calculate_pad_size, cuda_get_device_properties, cuda_device_count,
+                           calculate_pad_size, IntensityHistogram, cuda_get_device_properties, cuda_device_count,
                            CUDA_IS_AVAILABLE_FOR_PT, USE_PYTORCH, USE_JAX)
 from supplements.cli_interface import (ask_for_a_number_in_range, date_time_now, PrintColors)
+from supplements.ims_writer import tif_series_to_ims
+from supplements.registration import register_stacks
 from supplements.tifstack import TifStack, imread_tif_stck
+from tsv.displacements import compute_displacements
 from tsv.volume import TSVVolume, VExtent
 
 from align_images import main as align_main
@@ -317,12 +322,7 @@ def get_gradient(img: ndarray) -> ndarray:
     return img
 
 
-def estimate_bit_shift(img, threshold: float, percentile=99.9):
-    try:
-        upper_bound = prctl(img[img > threshold], percentile)
-    except (ValueError, AssertionError):
-        upper_bound = np_max(img)
-    upper_bound = int(np_round(expm1(upper_bound)))
+def bit_shift_for_upper_bound(upper_bound: int) -> int:
     right_bit_shift: int = 8
     for b in range(0, 9):
         if 256 * 2 ** b >= upper_bound:
@@ -331,6 +331,19 @@ def estimate_bit_shift(img, threshold: float, percentile=99.9):
     return right_bit_shift
 
 
+def estimate_bit_shift(img, threshold: float, percentile=99.9):
+    try:
+        upper_bound = prctl(img[img > threshold], percentile)
+    except (ValueError, AssertionError):
+        upper_bound = np_max(img)
+    return bit_shift_for_upper_bound(int(np_round(expm1(upper_bound))))
+
+
+def estimate_bit_shift_from_histogram(histogram: IntensityHistogram, threshold: float, percentile=99.9):
+    """the same as estimate_bit_shift for log1p thresholds but on the histogram of the whole dataset"""
+    return bit_shift_for_upper_bound(histogram.percentile(percentile, above=expm1(threshold)))
+
+
 def process_channel(
         source_path: Path,
         channel: str,
@@ -372,11 +385,13 @@ def process_channel(
         exclude_gpus: list = [],
         enable_axis_correction: bool = False,
         cosine_blending: bool = False,
+        in_process_alignment: bool = False,
 ):
     # preprocess each tile as needed using PyStripe --------------------------------------------------------------------
 
     assert source_path.joinpath(channel).exists()
     assert isotropic_downsampl_downsampled_path.exists()
+    histogram_path = preprocessed_path / f"{channel}_histogram.npy"
     if need_gaussian_filter_2d or need_destriping or need_flat_image_application or \
             need_raw_png_to_tiff_conversion or \
             down_sampling_factor not in (None, (1, 1)) or new_tile_size is not None:
@@ -392,7 +407,7 @@ def process_channel(
                       f"\t{flat_img_created_already.absolute()}.")
             else:
                 p_log(f"{PrintColors.GREEN}{date_time_now()}: {PrintColors.ENDC}"
-                      f"{channel}: creating a new flat image.")
+                      f"{channel}: flat and dark-fields will be estimated from the tiles.")
 
         tile_destriping_sigma = (0, 0)  # sigma=(foreground, background) Default is (0, 0), indicating no de-striping.
         if need_destriping:
@@ -408,7 +423,7 @@ def process_channel(
             f"\tsource: {source_path / channel}\n"
             f"\tdestination: {preprocessed_path / channel}\n"
             f"\tcompression: ({compression_method}, {compression_level})\n"
-            f"\tflat application: {img_flat is not None}\n"
+            f"\tflat application: {img_flat is not None or need_flat_image_application}\n"
             f"\tgaussian: {need_gaussian_filter_2d}\n"
             f"\tbaseline subtraction value: {dark}\n"
             f"\ttile de-striping sigma: {tile_destriping_sigma}\n"
@@ -443,7 +458,11 @@ def process_channel(
             convert_to_8bit=False,  # need_16bit_to_8bit_conversion
             bit_shift_to_right=8,
             compression=(compression_method, compression_level) if compression_level > 0 else None,
-            threads_per_gpu=8  # if sys.platform.lower() == "win32" else 1
+            threads_per_gpu=8,  # if sys.platform.lower() == "win32" else 1
+            histogram_path=histogram_path,
+            flat=img_flat,
+            flat_dark_path=preprocessed_path / f"{channel}_flat_dark.npz"
+            if need_flat_image_application and img_flat is None else None
         )
 
         if return_code != 0:
@@ -539,6 +558,17 @@ def process_channel(
             proj_out = stitched_path / f"{channel_for_alignment}_xml_import_step_{step}.xml"
 
             assert proj_in.exists()
+            if step == 2 and in_process_alignment:
+                p_log(f"\t{PrintColors.BLUE}{steps_str[step - 2]}:{PrintColors.ENDC} in-process FFT-NCC")
+                compute_displacements(
+                    proj_in,
+                    proj_out,
+                    search_radius=(25, 25, 0 if (objective == '40x' or stitch_mip) else 10),
+                    subvolume_depth=1 if stitch_mip else subvolume_depth,
+                    max_workers=nthreads)
+                assert proj_out.exists()
+                proj_in.unlink(missing_ok=False)
+                continue
             if step == 2 and n_cores > 1:
                 os.environ["slots"] = f"{cpu_count(logical=True)}"
                 command = [
@@ -596,13 +626,24 @@ def process_channel(
         sig = 0
         frequency = None
         background, bit_shift, clip_min, clip_med, clip_max = 0, 8, None, None, None
-        if need_16bit_to_8bit_conversion or need_bleach_correction:
+        histogram = None
+        if (need_16bit_to_8bit_conversion or need_bleach_correction) and histogram_path.exists():
+            histogram = IntensityHistogram.load(histogram_path)
+            try:
+                p_log(f"{PrintColors.GREEN}{date_time_now()}: {PrintColors.ENDC}"
+                      f"calculating thresholding, and bit shift for 8-bit conversion using the histogram of "
+                      f"{histogram.total} preprocessed voxels ...")
+                clip_min, clip_med, clip_max = histogram.multiotsu(classes=4)
+                bit_shift = estimate_bit_shift_from_histogram(histogram, threshold=clip_max, percentile=99.99)
+            except ValueError:
+                histogram = None
+        if (need_16bit_to_8bit_conversion or need_bleach_correction) and histogram is None:
             found_threshold = False
             # Calculate highest bitshift value at 3 various z-level indecies
             z = [floor(shape[0] * 0.25), floor(shape[0] * 0.5), floor(shape[0] * 0.75)]
             z_bitshift_vals = []
             for i in range(0, 3):
-                found_threshold = false
+                found_threshold = False
                 while not found_threshold:
                     try:
                         p_log(f"{PrintColors.GREEN}{date_time_now()}: {PrintColors.ENDC}"
@@ -630,15 +671,15 @@ def process_channel(
             
             bit_shift = max(z_bitshift_vals)
             # print(f'DEBUG: using {bit_shift} of max({z_bitshift_vals}) at 25, 50, and 75% zsteps respectively')
-            if need_bleach_correction:
-                background = int(np_round(expm1(clip_min)))
-                if new_tile_size is not None:
-                    sig = min(new_tile_size)
-                elif down_sampling_factor is not None:
-                    sig = min(new_tile_size) // min(down_sampling_factor)
-                else:
-                    sig = min(tile_size)
-                # frequency = 1 / sig
+        if need_bleach_correction:
+            background = int(np_round(expm1(clip_min)))
+            if new_tile_size is not None:
+                sig = min(new_tile_size)
+            elif down_sampling_factor is not None:
+                sig = min(new_tile_size) // min(down_sampling_factor)
+            else:
+                sig = min(tile_size)
+            # frequency = 1 / sig
 
         sigma = (int(sig * 2), ) * 2
         memory_needed_per_thread = 21 if need_bleach_correction else 16
@@ -699,6 +740,8 @@ def process_channel(
         for cpu in range(get_cpu_sockets()):
             gpu_semaphore.put(("cpu", virtual_memory().available))
 
+    # the maximum intensity projection of the stitched channel is made from the same planes while they are stitched
+    mip_path = stitched_path / f"{channel}_mip_z.tif"
     return_code, downsampled_subpath = parallel_image_processor(
         source=tsv_volume,
         destination=stitched_tif_path,
@@ -736,7 +779,9 @@ def process_channel(
         resume=continue_process_terastitcher,
         needed_memory=ram_needed_per_thread * 1024 ** 3 * 8,
         enable_axis_correction=enable_axis_correction,
-        return_downsampled_path=True
+        return_downsampled_path=True,
+        locality_scheduling=True,
+        sinks=None if mip_path.exists() else [MaxIntensityProjectionSink(mip_path)]
     )
     if need_rotation_stitched_tif:
         shape = (shape[0], shape[2], shape[1])
@@ -857,6 +902,66 @@ def transformation_is_needed(matrix: ndarray):
         return False
 
 
+def integer_translation(matrix: ndarray, tolerance: float = 0.01) -> Union[Tuple[int, int], None]:
+    """(dy, dx) if the matrix is a translation by whole pixels within tolerance, otherwise None"""
+    if absolute(matrix[0:2, 0:2] - eye(2)).max() > tolerance / 10:
+        return None
+    dx, dy = matrix[0, 2], matrix[1, 2]
+    if abs(dx - round(dx)) > tolerance or abs(dy - round(dy)) > tolerance:
+        return None
+    return int(round(dy)), int(round(dx))
+
+
+def translate_image(img: ndarray, shift: Tuple[int, int], shape: Tuple[int, int]) -> ndarray:
+    """out[y, x] = img[y + dy, x + dx] with zeros outside img, the same as warp with a translation matrix"""
+    dy, dx = shift
+    if dy == dx == 0:
+        return correct_shape(img, shape, zero_is_origin=True)
+    out = zeros(shape, dtype=img.dtype)
+    y0, y1 = max(0, -dy), min(shape[0], img.shape[0] - dy)
+    x0, x1 = max(0, -dx), min(shape[1], img.shape[1] - dx)
+    if y1 > y0 and x1 > x0:
+        out[y0:y1, x0:x1] = img[y0 + dy:y1 + dy, x0 + dx:x1 + dx]
+    return out
+
+
+class ChannelWarp:
+    def __init__(self, matrix: ndarray, use_maps: bool = True):
+        """
+        Applies the transformation matrix of one channel to its planes.
+        Whole pixel translations are slice copies. Other transformations use cv2.remap in the native data type
+        with maps that are calculated once for the output shape and reused for every plane.
+        """
+        self.matrix = matrix
+        self.shift = integer_translation(matrix)
+        if not transformation_is_needed(matrix):
+            self.shift = (0, 0)
+        self.use_maps = use_maps
+        self.maps = None
+        self.maps_shape = None
+
+    def remap_maps(self, shape: Tuple[int, int]):
+        if self.maps_shape != shape:
+            # output (x, y) samples the source at matrix @ (x, y, 1), the same as skimage warp
+            x = arange(shape[1], dtype=float32)[None, :]
+            y = arange(shape[0], dtype=float32)[:, None]
+            m = self.matrix.astype(float32)
+            map_x = m[0, 0] * x + m[0, 1] * y + m[0, 2]
+            map_y = m[1, 0] * x + m[1, 1] * y + m[1, 2]
+            self.maps = convertMaps(map_x, map_y, CV_16SC2)
+            self.maps_shape = shape
+        return self.maps
+
+    def __call__(self, img: ndarray, shape: Tuple[int, int]) -> ndarray:
+        if self.shift is not None:
+            return translate_image(img, self.shift, shape)
+        # cv2.remap is limited to images smaller than 32767 pixels on each axis
+        if self.use_maps and img.dtype in (uint8, uint16, int16, float32) and max(img.shape + tuple(shape)) < 32767:
+            map_1, map_2 = self.remap_maps(tuple(shape))
+            return remap(img, map_1, map_2, INTER_LINEAR, borderMode=BORDER_CONSTANT, borderValue=0)
+        return warp(img, self.matrix, output_shape=shape, preserve_range=True).astype(img.dtype)
+
+
 def generate_composite_image(
         img_idx: int,
         tif_stacks: List[TifStack],
@@ -873,6 +978,18 @@ def generate_composite_image(
     if resume and save_path.exists():
         return
     images = [tif_stack[img_idx] for tif_stack in tif_stacks]
+    warps = [ChannelWarp(matrix, use_maps=False) for matrix in transformation_matrices]
+    imsave_tif(save_path, compose_channels(images, warps, order_of_colors, right_bit_shifts),
+               compression=compression)
+
+
+def compose_channels(
+        images: List[Union[ndarray, None]],
+        warps: List[ChannelWarp],
+        order_of_colors: str,
+        right_bit_shifts: Union[Tuple[int, ...], None] = None
+) -> ndarray:
+    """align the channels of one z-step to the first (reference) channel and stack them as colors"""
     assert images[0] is not None
     if right_bit_shifts is not None:
         images = [convert_to_8bit_fun(img, bit_shift_to_right=bsh) for img, bsh in zip(images, right_bit_shifts)]
@@ -882,28 +999,92 @@ def generate_composite_image(
     for idx in range(1, len(images)):
         if images[idx] is None:
             images[idx] = zeros(img_shape, dtype=img_dtype)
-        elif transformation_is_needed(transformation_matrices[idx - 1]):
-            images[idx] = warp(images[idx], transformation_matrices[idx - 1],
-                               output_shape=img_shape, preserve_range=True)
-            images[idx] = images[idx].astype(img_dtype)
-            # images[idx] = correct_shape(images[idx], img_shape, zero_is_origin=True)
         else:
-            images[idx] = correct_shape(images[idx], img_shape, zero_is_origin=True)
+            images[idx] = warps[idx - 1](images[idx], img_shape).astype(img_dtype, copy=False)
         assert images[idx].shape == img_shape
 
-    if len(tif_stacks) == 3:
+    if len(images) == 3:
         # Dynamically create color_idx
         available_colors = order_of_colors.lower()[:3] 
         color_idx = {color: idx for idx, color in enumerate(order_of_colors.lower())}
         images = [images[color_idx[color]] for color in available_colors]
-    elif len(tif_stacks) == 4:
+    elif len(images) == 4:
         color_idx = {color: idx for idx, color in enumerate(order_of_colors.lower())}
         images = [images[color_idx[color]] for color in "cmyk"]
-    elif len(tif_stacks) == 2:
+    elif len(images) == 2:
         images += [zeros(img_shape, dtype=img_dtype)]
 
-    images = dstack(images)
-    imsave_tif(save_path, images, compression=compression)
+    return dstack(images)
+
+
+class MultiProcessChannelMerger(Process):
+    def __init__(self, progress_queue: Queue, args_queue: Queue, tif_stacks: List[TifStack],
+                 transformation_matrices: List[ndarray], order_of_colors: str, merged_tif_path: Path, resume: bool,
+                 compression: Union[Tuple[str, int], None] = ("ADOBE_DEFLATE", 1),
+                 right_bit_shifts: Union[Tuple[int, ...], None] = None, io_threads: int = None):
+        """
+        The file tables of the stacks and the matrices are sent to the worker once and the queue only carries img_idx.
+        Channels are read concurrently in a thread pool and the reads of the next z-step overlap the merging of
+        the current one.
+        """
+        Process.__init__(self)
+        self.daemon = False
+        self.progress_queue = progress_queue
+        self.args_queue = args_queue
+        self.tif_stacks = tif_stacks
+        self.warps = [ChannelWarp(matrix) for matrix in transformation_matrices]
+        self.order_of_colors = order_of_colors
+        self.merged_tif_path = merged_tif_path
+        self.resume = resume
+        self.compression = compression
+        self.right_bit_shifts = right_bit_shifts
+        self.io_threads = io_threads or 2 * len(tif_stacks)
+
+    def save_path(self, img_idx: int) -> Path:
+        return self.merged_tif_path / f"img_{img_idx:06n}.tif"
+
+    def next_img_idx(self) -> Union[int, None]:
+        while self.args_queue.qsize() > 0:
+            try:
+                img_idx = self.args_queue.get(block=True, timeout=1)
+            except Empty:
+                return None
+            if self.resume and self.save_path(img_idx).exists():
+                self.progress_queue.put(True)
+            else:
+                return img_idx
+        return None
+
+    def run(self):
+        tif_stacks = self.tif_stacks
+        with ThreadPoolExecutor(max_workers=self.io_threads) as pool:
+            def submit_reads(idx: int):
+                return idx, [pool.submit(imread_tif_stck, tif_stack, idx) for tif_stack in tif_stacks]
+
+            img_idx = self.next_img_idx()
+            pending = None if img_idx is None else submit_reads(img_idx)
+            while pending is not None:
+                img_idx, futures = pending
+                next_idx = self.next_img_idx()
+                pending = None if next_idx is None else submit_reads(next_idx)
+                try:
+                    images = [future.result() for future in futures]
+                    imsave_tif(
+                        self.save_path(img_idx),
+                        compose_channels(images, self.warps, self.order_of_colors, self.right_bit_shifts),
+                        compression=self.compression)
+                except KeyboardInterrupt:
+                    break
+                except Exception as inst:
+                    print(
+                        f"{PrintColors.WARNING}"
+                        f"\nwarning: merging channels failed for image index {img_idx}."
+                        f"\nexception instance: {type(inst)}"
+                        f"\nexception arguments: {inst.args}"
+                        f"\nexception: {inst}"
+                        f"{PrintColors.ENDC}")
+                self.progress_queue.put(True)
+        self.progress_queue.put(False)
 
 
 def merge_all_channels(
@@ -952,37 +1133,24 @@ def merge_all_channels(
     if resume and len(list(merged_tif_path.glob("*.tif"))) >= max([tif_stack.nz for tif_stack in tif_stacks]):
         return
 
-    img_reference_idx = tif_stacks[0].nz // 2
-    if not all([tif_stack.nz > img_reference_idx for tif_stack in tif_stacks]):
-        img_reference_idx = min([tif_stack.nz for tif_stack in tif_stacks])
-    print(f"reference image index = {img_reference_idx}")
-    assert img_reference_idx >= 0
-    with Pool(len(tif_paths)) as pool:
-        img_samples = list(pool.starmap(imread_tif_stck, zip(tif_stacks, (img_reference_idx,) * len(tif_paths))))
-        img_samples = list(map(get_gradient, img_samples))
-    assert all([img is not None for img in img_samples])
-    transformation_matrices = [get_transformation_matrix(img_samples[0], img) for img in img_samples[1:]]
-    del img_samples
+    transformation_matrices = []
+    for tif_path, tif_stack in zip(tif_paths[1:], tif_stacks[1:]):
+        registration = register_stacks(tif_stacks[0], tif_stack, workers=workers)
+        p_log(f"{PrintColors.GREEN}{date_time_now()}: {PrintColors.ENDC}"
+              f"registration of {tif_path} to {tif_paths[0]}:\n{registration.report()}")
+        transformation_matrices += [registration.matrix]
 
     args_queue = Queue(maxsize=tif_stacks[0].nz)
     for idx in jumpy_step_range(0, tif_stacks[0].nz):
-        args_queue.put({
-            "img_idx": idx,
-            "tif_stacks": tif_stacks,
-            "transformation_matrices": transformation_matrices,
-            "order_of_colors": order_of_colors,
-            "merged_tif_path": merged_tif_path,
-            "resume": resume,
-            "compression": compression,
-            "right_bit_shifts": right_bit_shifts
-        })
+        args_queue.put(idx)
 
     workers = min(workers, tif_stacks[0].nz)
     progress_queue = Queue()
     worker_processes = []
     for worker_ in range(workers):
-        worker = MultiProcessQueueRunner(progress_queue, args_queue,
-                                fun=generate_composite_image, replace_timeout_with_dummy=False)
+        worker = MultiProcessChannelMerger(
+            progress_queue, args_queue, tif_stacks, transformation_matrices, order_of_colors, merged_tif_path,
+            resume, compression=compression, right_bit_shifts=right_bit_shifts)
         worker.start()
         worker_processes.append(worker)
 
@@ -1046,6 +1214,44 @@ def get_imaris_command(imaris_path: Path, input_path: Path, output_path: Path =
     return " ".join(command)
 
 
+class MultiProcessImarisWriter(Process):
+    def __init__(self, queue, input_path: Path, output_path: Path, voxel_size: Tuple[float, float, float],
+                 workers: int = cpu_count(logical=False), position: int = None):
+        Process.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.input_path = input_path
+        self.output_path = output_path
+        self.voxel_size = voxel_size
+        self.workers = workers
+        self.position = position
+        self.command = f"tif_series_to_ims({input_path}, {output_path})"
+
+    def run(self):
+        return_code = 0
+        previous_percent = 0
+
+        def progress(percent_addition: float):
+            nonlocal previous_percent
+            previous_percent += percent_addition
+            self.queue.put([percent_addition, self.position, None, self.command])
+
+        try:
+            tif_series_to_ims(
+                self.input_path, self.output_path, self.voxel_size, workers=self.workers, progress_callback=progress)
+        except Exception as inst:
+            return_code = 1
+            p_log(f"{PrintColors.FAIL}"
+                  f"Imaris conversion failed for:\n"
+                  f"\t{self.input_path}.\n"
+                  f"Error:\n"
+                  f"\ttype: {type(inst)}\n"
+                  f"\targs: {inst.args}\n"
+                  f"\t{inst}"
+                  f"{PrintColors.ENDC}")
+        self.queue.put([0 if return_code else 100 - previous_percent, self.position, return_code, self.command])
+
+
 def commands_progress_manger(queue: Queue, progress_bars: List[tqdm], running_processes: int):
     while running_processes > 0:
         try:
@@ -1346,7 +1552,8 @@ def main(args):
             nthreads=args.nthreads,
             exclude_gpus=exclude_gpus,
             enable_axis_correction=args.enable_axis_correction,
-            cosine_blending=args.cosine_blending
+            cosine_blending=args.cosine_blending,
+            in_process_alignment=args.in_process_alignment
         )
         # with open("./log.txt", 'a') as f:
         #     f.write("---------------------------------------\n")
@@ -1456,18 +1663,34 @@ def main(args):
         p_log(f"{PrintColors.GREEN}{date_time_now()}: {PrintColors.ENDC}"
               f"started ims conversion ...")
         for idx, composite_tif_path in enumerate(composite_tif_paths):
-            command = get_imaris_command(
-                imaris_path=imaris_converter,
-                input_path=composite_tif_path,
-                output_path=imaris_files[idx] if idx < len(imaris_files) else None,
-                voxel_size_x=voxel_size_y if args.rot90 else voxel_size_x,
-                voxel_size_y=voxel_size_x if args.rot90 else voxel_size_y,
-                voxel_size_z=voxel_size_z,
-                workers=args.nthreads,
-                dtype='uint8' if args.convert_to_8bit else 'uint16'
-            )
-            p_log(f"\t{PrintColors.BLUE}tiff to ims conversion command:{PrintColors.ENDC}\n\t\t{command}\n")
-            MultiProcessCommandRunner(queue, command, pattern=r"WriteProgress:\s+(\d*.\d+)\s*$", position=idx).start()
+            if args.native_imaris_writer:
+                ims_file_path = imaris_files[idx] if idx < len(imaris_files) else \
+                    composite_tif_path.parent / f'{composite_tif_path.name}.ims'
+                p_log(f"\t{PrintColors.BLUE}tiff to ims conversion:{PrintColors.ENDC}\n\t\t"
+                      f"{composite_tif_path} -> {ims_file_path}\n")
+                MultiProcessImarisWriter(
+                    queue,
+                    composite_tif_path,
+                    ims_file_path,
+                    (voxel_size_z, voxel_size_x if args.rot90 else voxel_size_y,
+                     voxel_size_y if args.rot90 else voxel_size_x),
+                    workers=args.nthreads,
+                    position=idx
+                ).start()
+            else:
+                command = get_imaris_command(
+                    imaris_path=imaris_converter,
+                    input_path=composite_tif_path,
+                    output_path=imaris_files[idx] if idx < len(imaris_files) else None,
+                    voxel_size_x=voxel_size_y if args.rot90 else voxel_size_x,
+                    voxel_size_y=voxel_size_x if args.rot90 else voxel_size_y,
+                    voxel_size_z=voxel_size_z,
+                    workers=args.nthreads,
+                    dtype='uint8' if args.convert_to_8bit else 'uint16'
+                )
+                p_log(f"\t{PrintColors.BLUE}tiff to ims conversion command:{PrintColors.ENDC}\n\t\t{command}\n")
+                MultiProcessCommandRunner(
+                    queue, command, pattern=r"WriteProgress:\s+(\d*.\d+)\s*$", position=idx).start()
             running_processes += 1
             progress_bars += [
                 tqdm(total=100, ascii=True, position=idx, unit=" %", smoothing=0.01,
@@ -1726,5 +1949,12 @@ if __name__ == '__main__':
                         help="include to automatically flip axes if necessary when processing .ims files")
     parser.add_argument("--cosine_blending", default=False, action=BooleanOptionalAction,
                         help="Enable cosine blending to reduce tile boundaries. Disable by --no-cosine_blending.")
+    parser.add_argument("--native_imaris_writer", default=False, action=BooleanOptionalAction,
+                        help="Write ims files with the built-in h5py writer in a single pass instead of converting "
+                             "them with ImarisConvertiv. Experimental: its files are not validated against Imaris "
+                             "yet. Disabled by default.")
+    parser.add_argument("--in_process_alignment", default=False, action=BooleanOptionalAction,
+                        help="Compute the pairwise tile displacements (stitching step 2) in-process with FFT-NCC "
+                             "instead of running Parastitcher.")
     main(parser.parse_args())
 
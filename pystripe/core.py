@@ -6,7 +6,7 @@ from argparse import RawDescriptionHelpFormatter, ArgumentParser
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError
 from concurrent.futures.process import BrokenProcessPool
 from functools import reduce
-from math import ceil, log, sqrt
+from math import ceil, floor, log, sqrt
 from multiprocessing import Process, Queue
 from operator import iconcat
 from os import scandir, DirEntry
@@ -19,7 +19,8 @@ from typing import Tuple, Iterator, List, Callable, Union
 from warnings import filterwarnings
 from gc import collect as gc_collect
 
-from cv2 import morphologyEx, MORPH_CLOSE, MORPH_OPEN, floodFill, GaussianBlur
+from cv2 import morphologyEx, MORPH_CLOSE, MORPH_OPEN, floodFill, GaussianBlur, INTER_AREA, INTER_LINEAR
+from cv2 import resize as cv2_resize
 from dcimg import DCIMGFile
 from imageio.v3 import imread as iio_imread
 from numba import jit
@@ -31,7 +32,11 @@ from numpy import median as np_median
 from numpy import min as np_min
 from numpy import (uint8, uint16, float32, float64, iinfo, ndarray, generic, broadcast_to, exp, expm1, log1p, tanh,
                    zeros, ones, cumsum, arange, unique, interp, pad, clip, where, rot90, flipud, dot, reshape, nonzero,
-                   logical_not, prod, rint, array)
+                   logical_not, prod, rint, array, uint32, uint64, minimum, maximum, bincount, searchsorted, linspace,
+                   stack, absolute, subtract)
+from numpy import save as np_save
+from numpy import load as np_load
+from numpy import savez as np_savez
 from psutil import cpu_count
 from ptwt import wavedec2 as pt_wavedec2
 from ptwt import waverec2 as pt_waverec2
@@ -566,6 +571,249 @@ def otsu_threshold(img: ndarray) -> float:
         return 2
 
 
+class IntensityHistogram:
+    """Streaming histogram of integer intensities that can be merged across workers and saved between runs.
+
+    Parameters
+    ----------
+    bins : int
+        number of integer intensity bins. Values above bins - 1 are counted in the last bin.
+    counts : ndarray or None
+        optional initial counts
+    """
+    def __init__(self, bins: int = 65536, counts: ndarray = None):
+        self.counts = zeros(bins, dtype=uint64) if counts is None else counts.astype(uint64)
+
+    @property
+    def bins(self) -> int:
+        return self.counts.size
+
+    @property
+    def total(self) -> int:
+        return int(self.counts.sum())
+
+    def add(self, img: ndarray):
+        if img.dtype.kind == "f":
+            img = rint(clip(img, 0, self.bins - 1)).astype(uint32)
+        elif iinfo(img.dtype).max >= self.bins:
+            img = minimum(img, self.bins - 1)
+        self.counts += bincount(img.ravel(), minlength=self.bins).astype(uint64)
+
+    def merge(self, other: "IntensityHistogram"):
+        if other is not None:
+            self.counts += other.counts
+        return self
+
+    def save(self, path: Path):
+        with open(path, "wb") as file:
+            np_save(file, self.counts)
+
+    @staticmethod
+    def load(path: Path) -> "IntensityHistogram":
+        return IntensityHistogram(counts=np_load(path))
+
+    def percentile(self, percentile: float, above: float = -1) -> int:
+        """intensity below which percentile % of the values greater than `above` fall"""
+        counts = self.counts[max(0, int(floor(above)) + 1):]
+        if counts.sum() == 0:
+            counts = self.counts
+        cumulative = cumsum(counts)
+        idx = int(searchsorted(cumulative, cumulative[-1] * percentile / 100))
+        return idx + self.bins - counts.size
+
+    def multiotsu(self, classes: int = 4, nbins: int = 256) -> ndarray:
+        """Multi-Otsu thresholds of log1p(intensities), the same as threshold_multiotsu(log1p(img), classes)"""
+        values = nonzero(self.counts)[0]
+        if values.size < classes:
+            raise ValueError("not enough distinct intensities for the requested number of classes")
+        log_values = log1p(values.astype(float64))
+        edges = linspace(log_values[0], log_values[-1], nbins + 1)
+        idx = clip(searchsorted(edges, log_values, side="right") - 1, 0, nbins - 1)
+        log_counts = bincount(idx, weights=self.counts[values].astype(float64), minlength=nbins)
+        centers = (edges[:-1] + edges[1:]) / 2
+        return threshold_multiotsu(hist=(log_counts, centers), classes=classes).astype(float32)
+
+
+def apply_flat_dark(img: ndarray, flat: ndarray = None, dark: ndarray = None) -> ndarray:
+    """Fused flat and dark-field correction (img - dark) / flat. Values below dark are set to zero.
+
+    Parameters
+    ----------
+    img : ndarray
+        2D image. It is converted to float32 if needed and corrected in place.
+    flat : ndarray or None
+        float32 flat-field of the image shape.
+    dark : ndarray or None
+        float32 dark-field of the image shape.
+
+    Returns
+    -------
+    img : ndarray
+        corrected float32 image
+    """
+    if img.dtype != float32:
+        img = img.astype(float32)
+    if flat is not None and dark is not None:
+        if USE_NUMEXPR:
+            evaluate("where(img > dark, (img - dark) / flat, 0)", out=img, casting="unsafe")
+        else:
+            subtract(img, dark, out=img)
+            maximum(img, 0, out=img)
+            img /= flat
+    elif flat is not None:
+        img /= flat
+    elif dark is not None:
+        if USE_NUMEXPR:
+            evaluate("where(img > dark, img - dark, 0)", out=img, casting="unsafe")
+        else:
+            subtract(img, dark, out=img)
+            maximum(img, 0, out=img)
+    return img
+
+
+def fit_flat_dark(
+        samples: ndarray,
+        iterations: int = 10,
+        smoothness: float = 2.0,
+        outlier_scale: float = 3.0
+) -> Tuple[ndarray, ndarray, ndarray]:
+    """BaSiC-like low-rank + sparse decomposition of down-sampled tiles.
+
+    Every sample is modeled as baseline_i * flat + dark + sparse, where the rank-one term is the shading of the
+    illumination, dark is the additive offset, and the sparse part is the foreground that differs between tiles.
+    The foreground is down-weighted with Cauchy weights of the robust residuals (iteratively reweighted least squares).
+    flat and dark are smoothed on each iteration, which plays the role of the low-frequency (DCT) constraint of BaSiC.
+
+    Parameters
+    ----------
+    samples : ndarray
+        float32 array of shape (n, y, x) of down-sampled tiles
+    iterations : int
+        number of reweighting iterations
+    smoothness : float
+        sigma of the gaussian smoothing of flat and dark in down-sampled pixels
+    outlier_scale : float
+        residuals larger than outlier_scale robust standard deviations are treated as foreground
+
+    Returns
+    -------
+    flat : ndarray
+        flat-field of shape (y, x) with a mean of 1
+    dark : ndarray
+        non-negative dark-field of shape (y, x)
+    baseline : ndarray
+        per-sample baseline intensity
+    """
+    eps = float32(1e-6)
+    weights = ones(samples.shape, dtype=float32)
+    baseline = samples.mean(axis=(1, 2), dtype=float64).astype(float32)
+    flat = ones(samples.shape[1:], dtype=float32)
+    dark = zeros(samples.shape[1:], dtype=float32)
+    for _ in range(iterations):
+        # weighted per-pixel linear regression of the samples on the baselines: samples = baseline * flat + dark
+        b = baseline.reshape(-1, 1, 1)
+        wb = weights * b
+        w_sum, wb_sum, wbb_sum = weights.sum(axis=0), wb.sum(axis=0), (wb * b).sum(axis=0)
+        wd_sum, wbd_sum = (weights * samples).sum(axis=0), (wb * samples).sum(axis=0)
+        det = w_sum * wbb_sum - wb_sum * wb_sum
+        # when the baselines hardly vary the offset is not identifiable and flat is a pure ratio
+        identifiable = det > eps * w_sum * wbb_sum
+        det = where(identifiable, det, 1)
+        flat = where(identifiable, (w_sum * wbd_sum - wb_sum * wd_sum) / det, wbd_sum / (wbb_sum + eps))
+        dark = where(identifiable, (wbb_sum * wd_sum - wb_sum * wbd_sum) / det, 0)
+        flat = GaussianBlur(flat.astype(float32), ksize=(0, 0), sigmaX=smoothness, sigmaY=smoothness)
+        dark = GaussianBlur(dark.astype(float32), ksize=(0, 0), sigmaX=smoothness, sigmaY=smoothness)
+        maximum(dark, 0, out=dark)
+        flat_mean = float32(flat.mean())
+        if flat_mean <= 0:
+            flat, dark = ones(samples.shape[1:], dtype=float32), zeros(samples.shape[1:], dtype=float32)
+            break
+        flat /= flat_mean
+
+        # per-sample baselines given flat and dark
+        wf = weights * flat
+        baseline = (wf * (samples - dark)).sum(axis=(1, 2)) / ((wf * flat).sum(axis=(1, 2)) + eps)
+        residual = samples - baseline.reshape(-1, 1, 1) * flat - dark
+        scale = float32(1.4826) * float32(np_median(absolute(residual))) * outlier_scale + eps
+        residual /= scale
+        weights = 1 / (1 + residual * residual)
+    return flat.astype(float32), dark.astype(float32), baseline.astype(float32)
+
+
+def estimate_flat_dark(
+        files: List[Path],
+        tile_size: Tuple[int, int] = None,
+        d_type: str = None,
+        num_samples: int = 256,
+        working_size: int = 128,
+        iterations: int = 10,
+        smoothness: float = 2.0,
+        workers: int = cpu_count(logical=False)
+) -> Tuple[ndarray, ndarray]:
+    """Estimate flat and dark fields of a channel from a sample of its tiles.
+
+    Tiles are evenly sampled from files, read in parallel threads, and down-sampled to working_size on the fly,
+    so memory is bounded by num_samples * working_size ** 2 regardless of the tile size.
+
+    Parameters
+    ----------
+    files : List[Path]
+        tif, raw or png tiles of one channel
+    tile_size : tuple (int, int) or None
+        shape of the tiles. Tiles of other shapes are skipped. Default is the shape of the first readable tile.
+    d_type : str or None
+        data type of raw files
+    num_samples : int
+        maximum number of sampled tiles
+    working_size : int
+        the longest side of the down-sampled tiles
+    iterations, smoothness :
+        see fit_flat_dark
+    workers : int
+        number of reader threads
+
+    Returns
+    -------
+    flat : ndarray
+        float32 flat-field of tile_size normalized to a maximum of 1 like normalize_flat
+    dark : ndarray
+        float32 dark-field of tile_size
+    """
+    files = list(files)
+    if not files:
+        print(f"{PrintColors.FAIL}no file is given for flat and dark-field estimation{PrintColors.ENDC}")
+        raise RuntimeError
+    indices = sorted(set(int(idx) for idx in linspace(0, len(files) - 1, min(num_samples, len(files)))))
+
+    def read_down_sampled(file: Path):
+        img = imread_tif_raw_png(file, dtype=d_type, shape=tile_size)
+        if img is None or img.ndim != 2 or is_uniform_2d(img):
+            return None
+        ratio = working_size / max(img.shape)
+        size = (max(1, int(round(img.shape[1] * ratio))), max(1, int(round(img.shape[0] * ratio))))
+        return img.shape, cv2_resize(img.astype(float32), size, interpolation=INTER_AREA)
+
+    samples = []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(indices)))) as pool:
+        for result in pool.map(read_down_sampled, [files[idx] for idx in indices]):
+            if result is None:
+                continue
+            shape, sample = result
+            if tile_size is None:
+                tile_size = shape
+            if shape == tuple(tile_size):
+                samples += [sample]
+    if len(samples) < 2:
+        print(f"{PrintColors.FAIL}not enough non-uniform tiles for flat and dark-field estimation{PrintColors.ENDC}")
+        raise RuntimeError
+
+    flat, dark, _ = fit_flat_dark(stack(samples), iterations=iterations, smoothness=smoothness)
+    size = (tile_size[1], tile_size[0])
+    flat = normalize_flat(cv2_resize(flat, size, interpolation=INTER_LINEAR))
+    dark = cv2_resize(dark, size, interpolation=INTER_LINEAR)
+    return flat, dark
+
+
 def sigmoid(img: ndarray) -> ndarray:
     if img.dtype != float32:
         img = img.astype(float32)
@@ -1211,6 +1459,7 @@ def process_img(
         bleach_correction_max_method: bool = False,
         log1p_normalization_needed: bool = True,
         dark: float = 0,
+        dark_field: ndarray = None,
         lightsheet: bool = False,
         artifact_length: int = 150,
         background_window_size: int = 200,
@@ -1245,13 +1494,18 @@ def process_img(
 
         img = zeros(shape=tile_size, dtype=d_type)
     else:
-        if flat is not None:
-            if tile_size == flat.shape:
-                img /= flat
-            else:
-                print(f"{PrintColors.WARNING}"
-                      f"warning: image and flat arrays had different shapes"
-                      f"{PrintColors.ENDC}")
+        if flat is not None and tile_size != flat.shape:
+            print(f"{PrintColors.WARNING}"
+                  f"warning: image and flat arrays had different shapes"
+                  f"{PrintColors.ENDC}")
+            flat = None
+        if dark_field is not None and tile_size != dark_field.shape:
+            print(f"{PrintColors.WARNING}"
+                  f"warning: image and dark-field arrays had different shapes"
+                  f"{PrintColors.ENDC}")
+            dark_field = None
+        if flat is not None or dark_field is not None:
+            img = apply_flat_dark(img, flat=flat, dark=dark_field)
 
         y_slice_min = y_slice_max = x_slice_min = x_slice_max = None
         if exclude_dark_edges_set_them_to_zero:
@@ -1406,6 +1660,7 @@ def read_filter_save(
         bleach_correction_clip_med: Union[float, int] = None,
         bleach_correction_clip_max: Union[float, int] = None,
         dark: float = 0,
+        dark_field: ndarray = None,
         lightsheet: bool = False,
         artifact_length: int = 150,
         background_window_size: int = 200,
@@ -1419,6 +1674,7 @@ def read_filter_save(
         new_size: Tuple[int, int] = None,
         rotate: int = 0,
         flip_upside_down: bool = False,
+        return_histogram: bool = False,
 ):
     """Convenience wrapper around filter streaks. Takes in a path to an image rather than an image array
 
@@ -1477,6 +1733,8 @@ def read_filter_save(
         foreground max
     dark : float
         Intensity to subtract from the images for dark offset. Default is 0.
+    dark_field : ndarray
+        dark-field of the same shape as input images, subtracted together with the flat division. Default is None
     lightsheet : bool
         if False, use wavelet method, if true use correct_lightsheet
     artifact_length : int
@@ -1504,6 +1762,8 @@ def read_filter_save(
         Rotate the image. One of 0, 90, 180 or 270 degree values are accepted. Default is 0 (no rotation).
     flip_upside_down : bool
         flip the image parallel to y-axis. Default is false.
+    return_histogram : bool
+        return the IntensityHistogram of the processed image.
     """
     try:
         # 1150 is 1850x1850 zeros image saved as compressed tif
@@ -1576,6 +1836,7 @@ def read_filter_save(
             bleach_correction_clip_med=bleach_correction_clip_med,
             bleach_correction_clip_max=bleach_correction_clip_max,
             dark=dark,
+            dark_field=dark_field,
             lightsheet=lightsheet,
             artifact_length=artifact_length,
             background_window_size=background_window_size,
@@ -1591,6 +1852,11 @@ def read_filter_save(
 
         imsave_tif(output_file, img, compression=compression)
 
+        if return_histogram:
+            histogram = IntensityHistogram()
+            histogram.add(img)
+            return histogram
+
     except (OSError, IndexError, TypeError, RuntimeError, TiffFileError) as inst:
         print(f"{PrintColors.WARNING}warning: read_filter_save function failed:"
               f"\n{type(inst)}"  # the exception instance
@@ -1684,13 +1950,32 @@ def process_dc_images(input_file: Path, input_path: Path, output_path: Path, arg
     return sub_stack
 
 
+_shared_args: dict = {}
+
+
+def _set_shared_args(shared_args: dict):
+    global _shared_args
+    _shared_args = shared_args
+
+
+def _call_with_shared_args(function: Callable, **args):
+    return function(**{**_shared_args, **args})
+
+
 class MultiProcessQueueRunner(Process):
+    """
+    Calls fun with the arguments of each item of args_queue.
+    shared_args, e.g. large arrays like flat and dark fields, are sent to the worker once and added to every call,
+    instead of being pickled with every item of the queue.
+    """
     def __init__(self, progress_queue: Queue, args_queue: Queue,
                  gpu_semaphore: Queue = None,
                  gpu: int = None,
                  fun: Callable = read_filter_save,
                  timeout: float = None,
-                 replace_timeout_with_dummy: bool = True):
+                 replace_timeout_with_dummy: bool = True,
+                 histogram: bool = False,
+                 shared_args: dict = None):
         if gpu is not None:
             os.environ["CUDA_VISIBLE_DEVICES"] = f"{gpu}"
         Process.__init__(self)
@@ -1702,13 +1987,21 @@ class MultiProcessQueueRunner(Process):
         self.die = False
         self.function = fun
         self.replace_timeout_with_dummy = replace_timeout_with_dummy
+        self.histogram = histogram
+        self.shared_args = shared_args or {}
+
+    def new_process_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=1, initializer=_set_shared_args, initargs=(self.shared_args,))
 
     def run(self):
         running_next = True
+        interrupted = False
         timeout = self.timeout
         gpu_semaphore = self.gpu_semaphore
+        histogram = IntensityHistogram() if self.histogram else None
+        _set_shared_args(self.shared_args)
         if timeout:
-            pool = ProcessPoolExecutor(max_workers=1)
+            pool = self.new_process_pool()
         else:
             pool = ThreadPoolExecutor(max_workers=1)
         function = self.function
@@ -1719,12 +2012,16 @@ class MultiProcessQueueRunner(Process):
                 args: dict = self.args_queue.get(block=True, timeout=queue_timeout)
                 if gpu_semaphore is not None:
                     args.update({"gpu_semaphore": gpu_semaphore})
+                if histogram is not None:
+                    args.update({"return_histogram": True})
                 if queue_timeout is not None:
                     queue_timeout = max(queue_timeout, 0.9 * queue_timeout + 0.3 * (time() - queue_start_time))
                 try:
                     start_time = time()
-                    future = pool.submit(function, **args)
-                    future.result(timeout=timeout)
+                    future = pool.submit(_call_with_shared_args, function, **args)
+                    result = future.result(timeout=timeout)
+                    if histogram is not None and isinstance(result, IntensityHistogram):
+                        histogram.merge(result)
                     if timeout is not None:
                         timeout = max(timeout, 0.9 * timeout + 0.3 * (time() - start_time))
                 except (BrokenProcessPool, TimeoutError, ValueError) as inst:
@@ -1745,6 +2042,7 @@ class MultiProcessQueueRunner(Process):
                             )
                             if die:
                                 self.die = True
+                                interrupted = True
                     else:
                         print(f"{PrintColors.WARNING}"
                               f"\nwarning: timeout reached for processing input file:\n\t{args['file_name']}\n\t"
@@ -1752,9 +2050,10 @@ class MultiProcessQueueRunner(Process):
                               f"{PrintColors.ENDC}")
                     if isinstance(pool, ProcessPoolExecutor):
                         pool.shutdown()
-                        pool = ProcessPoolExecutor(max_workers=1)
+                        pool = self.new_process_pool()
                 except KeyboardInterrupt:
                     self.die = True
+                    interrupted = True
                 except Exception as inst:
                     print(
                         f"{PrintColors.WARNING}"
@@ -1768,11 +2067,19 @@ class MultiProcessQueueRunner(Process):
                 self.die = True
         if isinstance(pool, ProcessPoolExecutor):
             pool.shutdown()
-        self.progress_queue.put(not running_next)
+        # with histograms the final message carries the histogram and whether the worker was interrupted
+        self.progress_queue.put(not running_next if histogram is None else (histogram, interrupted))
 
 
 def progress_manager(progress_queue: Queue, workers: int, total: int,
-                     desc="PyStripe", unit=" images"):
+                     desc="PyStripe", unit=" images", return_outputs: bool = False):
+    """
+    Show the progress of workers that put True for each processed item and a final non-True message when they finish.
+    Final messages that are not bool are collected as outputs.
+
+    returns: the outputs if any, otherwise the return code, which is 1 if interrupted.
+    With return_outputs, (return_code, outputs) is always returned so an interruption is not hidden by the outputs.
+    """
     return_code = 0
     list_of_outputs = []
     print(f"{PrintColors.GREEN}{date_time_now()}: {PrintColors.ENDC}"
@@ -1800,6 +2107,8 @@ def progress_manager(progress_queue: Queue, workers: int, total: int,
             print(f"\n{PrintColors.WARNING}Terminating processes with dignity!{PrintColors.ENDC}")
             return_code = 1
     progress_bar.close()
+    if return_outputs:
+        return return_code, list_of_outputs
     return list_of_outputs if list_of_outputs else return_code
 
 
@@ -1842,7 +2151,10 @@ def batch_filter(
         new_size: Tuple[int, int] = None,
         print_input_file_names: bool = False,
         timeout: float = None,
-        compression: Tuple[str, int] = ('ADOBE_DEFLATE', 1)
+        compression: Tuple[str, int] = ('ADOBE_DEFLATE', 1),
+        histogram_path: Path = None,
+        flat_dark_path: Path = None,
+        flat_dark_samples: int = 256
 ):
     """Applies `streak_filter` to all images in `input_path` and write the results to `output_path`.
 
@@ -1897,6 +2209,12 @@ def batch_filter(
         reference image for illumination correction. Must be same shape as input images. Default is None
     dark : float
         Intensity to subtract from the images for dark offset. Default is 0.
+    flat_dark_path : Path | None
+        if given and flat is None, flat and dark fields are loaded from this npz file, or estimated from a sample of
+        the input tiles with estimate_flat_dark and saved to it. They are applied as (img - dark) / flat.
+        Only tif, raw and png inputs are supported.
+    flat_dark_samples : int
+        maximum number of tiles sampled for flat and dark-field estimation.
     z_step : int
         z-step in tenths of micron. only used for DCIMG files.
     rotate : int
@@ -1933,6 +2251,11 @@ def batch_filter(
     timeout: float | None
         if file processing took more than timeout seconds, terminate the process.
         It is used whenever some tiles could be corrupt and in raw format and processing halts without raising an error.
+    histogram_path: Path | None
+        if given, the intensity histogram of all processed images is collected by the workers and saved as npy.
+        With continue_process the histogram of the previous run is loaded and extended. If images were skipped
+        because they were processed before and there is no histogram of them, no histogram is saved, since it would
+        only cover part of the dataset.
     """
     input_path = Path(input_path)
     assert input_path.is_dir()
@@ -1956,7 +2279,6 @@ def batch_filter(
         raise TypeError
 
     arg_dict_template = {
-        'flat': flat,
         'gaussian_filter_2d': gaussian_filter_2d,
         'sigma': sigma,
         'level': level,
@@ -2011,8 +2333,29 @@ def batch_filter(
         args_list = reduce(iconcat, args_list, [])  # unravel the list of list the fastest way possible
     del files, files_list
 
+    num_skipped = len(args_list)
     args_list = [arg for arg in args_list if arg is not None]
     num_images = len(args_list)
+    num_skipped -= num_images
+    dark_field = None
+    if flat is None and flat_dark_path is not None and num_images > 0:
+        flat_dark_path = Path(flat_dark_path)
+        if flat_dark_path.exists():
+            with np_load(flat_dark_path) as flat_dark:
+                flat, dark_field = flat_dark["flat"], flat_dark["dark"]
+            print(f"{PrintColors.GREEN}{date_time_now()}: {PrintColors.ENDC}"
+                  f"using the existing flat and dark-fields:\n\t{flat_dark_path}")
+        elif z_step is None:
+            print(f"{PrintColors.GREEN}{date_time_now()}: {PrintColors.ENDC}"
+                  f"estimating flat and dark-fields from up to {flat_dark_samples} tiles ...")
+            flat, dark_field = estimate_flat_dark(
+                [args['input_file'] for args in args_list], tile_size=tile_size, d_type=d_type,
+                num_samples=flat_dark_samples, workers=workers)
+            np_savez(flat_dark_path, flat=flat, dark=dark_field)
+        else:
+            print(f"{PrintColors.WARNING}flat and dark-field estimation is not supported for dcimg files"
+                  f"{PrintColors.ENDC}")
+            flat = dark_field = None
     args_queue = Queue(maxsize=num_images)
     for args in args_list:
         args_queue.put(args)
@@ -2034,9 +2377,29 @@ def batch_filter(
     progress_queue = Queue()
     for worker in range(workers):
         MultiProcessQueueRunner(progress_queue, args_queue, gpu_semaphore,
-                                fun=read_filter_save, timeout=timeout).start()
+                                fun=read_filter_save, timeout=timeout, histogram=histogram_path is not None,
+                                shared_args={'flat': flat, 'dark_field': dark_field}).start()
 
-    return_code = progress_manager(progress_queue, workers, num_images)
+    if histogram_path is None:
+        return_code = progress_manager(progress_queue, workers, num_images)
+    else:
+        return_code, worker_outputs = progress_manager(progress_queue, workers, num_images, return_outputs=True)
+        histogram = IntensityHistogram()
+        covers_skipped = num_skipped == 0
+        if continue_process and Path(histogram_path).exists():
+            histogram = IntensityHistogram.load(histogram_path)
+            covers_skipped = True
+        for worker_histogram, interrupted in worker_outputs:
+            histogram.merge(worker_histogram)
+            if interrupted:
+                return_code = 1
+        if covers_skipped:
+            # the histogram of the processed tiles is kept even if interrupted, continue_process extends it
+            histogram.save(histogram_path)
+        else:
+            print(f"{PrintColors.WARNING}the histogram is not saved since the {num_skipped} images processed "
+                  f"before have no histogram and it would only cover the images processed in this run"
+                  f"{PrintColors.ENDC}")
     args_queue.cancel_join_thread()
     args_queue.close()
     progress_queue.cancel_join_thread()
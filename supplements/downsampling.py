@@ -1,8 +1,10 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import time
+from concurrent.futures import ThreadPoolExecutor
 from numpy import ndarray
 from pathlib import Path
+from psutil import cpu_count
+from scipy.ndimage import gaussian_filter, zoom
 from supplements.tifstack import TifStack
 
 
@@ -45,6 +47,7 @@ def draw_slices(image: ndarray, n=5, channel_ax=0, fig=None, vmin=None, vmax=Non
 
     # set up a figure
     if fig is None:
+        import matplotlib.pyplot as plt  # only needed for drawing
         fig = plt.figure()
 
     # now we'll set up slices along each axis
@@ -76,12 +79,46 @@ def draw_slices(image: ndarray, n=5, channel_ax=0, fig=None, vmin=None, vmax=Non
     return fig, ax
 
 
-def downsample_ax(image: ndarray, downsampling_factor: int, ax: int):
+def block_reduce_nd(image: ndarray, factors, method: str = "mean"):
     """
-    Downsample along a given axis
+    Reduce non-overlapping blocks of an array with one reshape, for any integer factor on each axis.
+
+    Note the pixels that do not fill a whole block are left off the end.
+
+    Parameters
+    ----------
+    image : ndarray
+        Image to be downsampled
+    factors : list of int
+        Downsampling factor of each axis
+    method : str
+        mean or max
+
+    Returns
+    -------
+    downsampled_image : ndarray
+        For mean, a float image (the dtype of image if it is float, float32 otherwise).
+        For max, an image of the same dtype.
+    """
+    factors = [int(f) for f in factors]
+    if any(f < 1 for f in factors) or len(factors) != image.ndim:
+        raise ValueError(f"one positive integer factor is needed for each axis, got {factors}")
+    downsampled_shape = [n // f for n, f in zip(image.shape, factors)]
+    image = image[tuple(slice(0, n * f) for n, f in zip(downsampled_shape, factors))]
+    blocks = image.reshape([v for n, f in zip(downsampled_shape, factors) for v in (n, f)])
+    block_axes = tuple(range(1, 2 * image.ndim, 2))
+    if method == "max":
+        return blocks.max(axis=block_axes)
+    elif method == "mean":
+        dtype = image.dtype if np.issubdtype(image.dtype, np.floating) else np.float32
+        return blocks.mean(axis=block_axes, dtype=np.float64 if dtype == np.float64 else np.float32).astype(
+            dtype, copy=False)
+    raise ValueError(f"unsupported method {method}, use mean or max")
+
 
-    Use np take so that ax can be an argument
-    and no fancy indexing is needed
+def downsample_ax(image: ndarray, downsampling_factor: int, ax: int):
+    """
+    Downsample along a given axis by averaging blocks of downsampling_factor pixels
 
     Note downsampling here leaves the end off.
 
@@ -103,22 +140,14 @@ def downsample_ax(image: ndarray, downsampling_factor: int, ax: int):
     """
     if downsampling_factor == 1:
         return np.array(image)  # note this is making a new array, just like below
-
-    downsampled_shape = np.array(image.shape)
-    downsampled_shape[ax] //= downsampling_factor
-    downsampled_image = np.zeros(downsampled_shape, dtype=image.dtype)
-    for i in range(downsampling_factor):
-        downsampled_image += np.take(
-            image,
-            np.arange(i, downsampled_shape[ax] * downsampling_factor, downsampling_factor),
-            axis=ax) / downsampling_factor
-    return downsampled_image
+    factors = [1] * image.ndim
+    factors[ax] = downsampling_factor
+    return block_reduce_nd(image, factors)
 
 
 def is_prime(d):
     """
-    Determine if an integer is prime by looping over all its possible factors.
-    This is not a high performance algorithm and should be done with small numbers
+    Determine if an integer is prime by trial division up to its square root.
 
     Parameters
     ----------
@@ -130,10 +159,9 @@ def is_prime(d):
     is_prime : bool
         Whether the number is prime
     """
-    for i in range(2, d):  # between 2 and d-2
-        if d // i == d / i:
-            return False
-    return True
+    if d < 2:
+        return False
+    return all(d % i for i in range(2, int(d ** 0.5) + 1))
 
 
 def prime_factor(d):
@@ -151,38 +179,61 @@ def prime_factor(d):
         A list of prime factors sorted from lowest to highest
 
     """
-    if is_prime(d):
-        return [d]
-    # otherwise I'll recurse and get a left factor and a right factor
-    output = []
-    for i in range(2, d):
-        if d // i == d / i:
-            # this is a factor
-            left = i
-            right = d // i
-            output = []
-            output += prime_factor(left)
-            output += prime_factor(right)
-    output.sort()
+    output, i = [], 2
+    while i * i <= d:
+        while d % i == 0:
+            output.append(i)
+            d //= i
+        i += 1
+    if d > 1 or not output:
+        output.append(d)
     return output
 
 
-def downsample(I, d):
-    '''
-    Downsample along each axis
+def resize_antialiased(image: ndarray, shape, order: int = 1):
+    """
+    Resize to any shape, smoothing with a gaussian of sigma (factor - 1) / 2 on every down-sampled axis first,
+    the same anti-aliasing as skimage.transform.resize.
+
+    Parameters
+    ----------
+    image : ndarray
+        Image to be resized
+    shape : list of int
+        Output shape
+    order : int
+        Order of the spline interpolation
+
+    Returns
+    -------
+    resized_image : ndarray
+        float image of the given shape
+    """
+    factors = [n / m for n, m in zip(image.shape, shape)]
+    image = image.astype(np.float32, copy=False)
+    sigma = [max(0., (f - 1) / 2) for f in factors]
+    if any(sigma):
+        image = gaussian_filter(image, sigma, mode="mirror")
+    return zoom(image, [m / n for n, m in zip(image.shape, shape)], order=order, mode="nearest",
+                grid_mode=True, output=np.float32)
 
-    If it can be factored it would be perfect
 
-    In factors always put the small number first
+def downsample(I, d, method: str = "mean"):
+    '''
+    Downsample along each axis
 
-    Not pixels are left off the end.
+    Integer factors reduce non-overlapping blocks (block_reduce_nd) and leave the pixels off the end.
+    Non-integer factors first reduce by the integer part of the factor and then resize the rest with
+    resize_antialiased to round(shape / d).
 
     Parameters
     ----------
     I : numpy array
         Imaging data to downsample
-    d : list of ints
+    d : list of int or float
         Downsampling factors along each axis
+    method : str
+        mean or max for the block reduction
 
 
 
@@ -192,50 +243,110 @@ def downsample(I, d):
         Downsampled image
 
     '''
-    Id = I
-    for i, di in enumerate(d):
-        for dii in prime_factor(di):
-            Id = downsample_ax(Id, dii, i)
+    integer_factors = [max(1, int(np.floor(di))) for di in d]
+    Id = block_reduce_nd(I, integer_factors, method=method)
+    if any(di != fi for di, fi in zip(d, integer_factors)):
+        Id = resize_antialiased(Id, [max(1, int(round(n / di))) for n, di in zip(I.shape, d)])
     return Id
 
 
-def downsample_dataset(data, down, xI=None):
-    # okay now I have to iterate over the dataset
-    fig, ax = plt.subplots(1, 2)
-    working = []
-    output = []
+def downsample_slab(data, slab: int, down, exponent: float = None, method: str = "mean"):
+    """
+    Downsample the planes of one slab (down[0] consecutive planes) of a 3D dataset into one output plane.
+
+    Parameters
+    ----------
+    data : TifStack or ndarray
+        3D dataset indexed by z
+    slab : int
+        index of the output plane
+    down : list of int
+        Downsampling factors along z, y, x
+    exponent : float or None
+        optional power applied to the planes before downsampling to reduce the dynamic range
+    method : str
+        mean or max
+
+    Returns
+    -------
+    plane : ndarray
+        2D downsampled plane
+    """
+    planes = None
+    for i, z in enumerate(range(slab * down[0], (slab + 1) * down[0])):
+        plane = data[z].astype(np.float32)
+        if exponent is not None:
+            plane **= exponent
+        plane = block_reduce_nd(plane, down[1:], method=method)
+        if planes is None:
+            planes = np.empty((down[0],) + plane.shape, dtype=plane.dtype)
+        planes[i] = plane
+    return block_reduce_nd(planes, [down[0], 1, 1], method=method)[0]
+
+
+def downsample_dataset(data, down, xI=None, num_workers: int = cpu_count(logical=False), exponent: float = None,
+                       method: str = "mean", checkpoint_path: Path = None):
+    """
+    Downsample a 3D dataset by integer factors, slab by slab in parallel threads.
+
+    Parameters
+    ----------
+    data : TifStack or ndarray
+        3D dataset indexed by z
+    down : list of int
+        Downsampling factors along z, y, x
+    xI : list of ndarray or None
+        voxel locations of each axis, downsampled with the same factors if given
+    num_workers : int
+        number of threads, each one processing one slab
+    exponent : float or None
+        optional power applied to the planes before downsampling
+    method : str
+        mean or max
+    checkpoint_path : Path or None
+        if given, each downsampled slab is saved there as npy and loaded instead of being recomputed
+
+    Returns
+    -------
+    Id : ndarray or tuple of (ndarray, list of ndarray)
+        Downsampled dataset, and the downsampled voxel locations if xI is given
+    """
+    down = [int(d) for d in down]
+    num_slabs = data.shape[0] // down[0]
+    output_shape = (num_slabs,) + tuple(n // d for n, d in zip(data.shape[1:], down[1:]))
+    Id = np.empty(output_shape, dtype=np.float32)
+    if checkpoint_path is not None:
+        checkpoint_path.mkdir(parents=True, exist_ok=True)
+
+    def process_slab(slab: int):
+        slab_file = None if checkpoint_path is None else checkpoint_path / f"slab_{slab:04d}.npy"
+        if slab_file is not None and slab_file.exists():
+            Id[slab] = np.load(str(slab_file))
+        else:
+            Id[slab] = downsample_slab(data, slab, down, exponent=exponent, method=method)
+            if slab_file is not None:
+                np.save(str(slab_file), Id[slab])
+
     start = time.time()
-    for i in range(data.shape[0]):
-        starti = time.time()
-
-        s = data[i]
-        sd = downsample(s.astype(float), down[1:])
-        ax[0].cla()
-        ax[0].imshow(sd)
-        working.append(sd)
-        if len(working) == down[0]:
-            out = downsample(np.stack(working), [down[0], 1, 1])
-            ax[1].cla()
-            ax[1].imshow(out[0])
-            output.append(out)
-            working = []
-        fig.canvas.draw()
-        print(f'Finished loading slice {i} of {data.shape[0]}, time {time.time() - starti} s')
-    output = np.concatenate(output)
-    Id = output
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        for count, _ in enumerate(pool.map(process_slab, range(num_slabs)), start=1):
+            if count % max(1, num_slabs // 20) == 0 or count == num_slabs:
+                print(f'Finished slab {count} of {num_slabs}, time {time.time() - start:.1f} s')
 
     output = Id
     if xI is not None:
         xId = [downsample(x, [d]) for x, d in zip(xI, down)]
         output = (Id, xId)
 
-    print(f'Finished downsampling, time {time.time() - start}')
+    print(f'Finished downsampling, time {time.time() - start:.1f}')
 
     return output
 
 
 def downsample_2d_tif_series(
-        input_directory: Path, output_filename: Path, voxel_sizes: tuple, target_voxel_size: float
+        input_directory: Path, output_filename: Path, voxel_sizes: tuple, target_voxel_size: float,
+        num_workers: int = cpu_count(logical=False), exponent: float = 0.25, method: str = "mean",
+        exact_voxel_size: bool = False
 ):
     """
     input_directory : Path
@@ -244,9 +355,19 @@ def downsample_2d_tif_series(
         the name of output npz file name
     voxel_sizes : tuple
         a tuple of (z, y, x) form containing voxel sizes of the input files
+    target_voxel_size : float
+        desired voxel size in microns. The integer factors floor(target_voxel_size / voxel_sizes) are used.
+    num_workers : int
+        number of slabs downsampled in parallel
+    exponent : float or None
+        power applied to the planes before downsampling to reduce the dynamic range. None means no power.
+    method : str
+        mean or max for the block reduction
+    exact_voxel_size : bool
+        resize the block reduced volume with anti-aliasing so that the voxel size is exactly target_voxel_size
     """
 
-    # we need a temporary output directory for intermediate results (each slice)
+    # we need a temporary output directory for intermediate results (each slab)
     output_path = input_directory.parent.joinpath("downsampling_tmp")
     output_path.mkdir(parents=True, exist_ok=True)
 
@@ -261,7 +382,7 @@ def downsample_2d_tif_series(
     print(f'Resolution is {dI}')
     print(f'Desired resolution is {res}')
 
-    down = np.floor(res / dI).astype(int)
+    down = np.maximum(np.floor(res / dI), 1).astype(int)
     print(f'Downsampling factors are {down}')
     print(f'Downsampled res {dI * down}')
 
@@ -272,32 +393,14 @@ def downsample_2d_tif_series(
     nI = np.array(data.shape)
     xI = [np.arange(n) * d - (n - 1) / 2.0 * d for n, d in zip(nI, dI)]
 
-    xId = [downsample(x, [d]) for x, d in zip(xI, down)]
-    dId = [x[1] - x[0] for x in xId]
+    # slabs are saved in the temporary directory in case of errors
+    Id, xId = downsample_dataset(data, down, xI=xI, num_workers=num_workers, exponent=exponent, method=method,
+                                 checkpoint_path=output_path)
+    if exact_voxel_size:
+        shape = [max(1, int(round(n * d / res))) for n, d in zip(Id.shape, dI * down)]
+        Id = resize_antialiased(Id, shape)
+        xId = [np.arange(n) * res - (n - 1) / 2.0 * res + x.mean() for n, x in zip(shape, xId)]
+    dId = [x[1] - x[0] if len(x) > 1 else res for x in xId]
     print(f"output voxel sizes {dId}")
-
-    # iterate over the dataset
-    # we need to save intermediate outputs (each slice) in case of errors
-    working, output = [], []
-    start = time.time()
-    for i in range(data.shape[0]):
-        start_time = time.time()
-        downsampled_output_file = output_path / f"{i:04d}.npy"
-        if downsampled_output_file.exists():
-            sd = np.load(str(downsampled_output_file))
-        else:
-            s = data[i] ** 0.25  # test reduce dynamic range before downsampling with this power
-            sd = downsample(s.astype(float), down[1:])
-            np.save(str(downsampled_output_file), sd)
-
-        working.append(sd)
-        if len(working) == down[0]:
-            out = downsample(np.stack(working), [down[0], 1, 1])
-            output += [out]
-            working = []
-        print(f'Finished loading slice {i} of {data.shape[0]}, time {time.time() - start_time:.1f} s')
-    output = np.concatenate(output)
-    Id = output
-    print(f'Finished downsampling, time {time.time() - start:.1f}')
     np.savez(output_filename, I=Id, xI=np.array(xId, dtype='object'))  # note specify object to avoid "ragged" warning
     assert Id.shape == (len(xId[0]), len(xId[1]), len(xId[2]))
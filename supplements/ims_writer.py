@@ -0,0 +1,343 @@
+"""
+ims_writer.py - write Imaris 5.5 (.ims) files with h5py
+
+The resolution pyramid is built on the fly while planes are streamed in z order, and the HDF5 chunks are
+compressed in a thread pool and stored with direct chunk writes, so the data is read only once.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from math import ceil
+from pathlib import Path
+from typing import Callable, List, Tuple, Union
+from zlib import compress
+
+from h5py import File
+from numpy import ndarray, zeros, array, frombuffer, bincount, concatenate, hstack, arange, uint8, uint16, uint32, \
+    uint64, float32
+from numpy import dtype as np_d_type
+from psutil import cpu_count
+
+from pystripe.core import imread_tif_raw_png
+from supplements.cli_interface import PrintColors
+
+DEFAULT_COLORS = ("1.000 0.000 0.000", "0.000 1.000 0.000", "0.000 0.000 1.000", "1.000 0.000 1.000",
+                  "0.000 1.000 1.000", "1.000 1.000 0.000")
+
+
+def ims_string(value) -> ndarray:
+    """Imaris stores attributes as arrays of single characters"""
+    return frombuffer(str(value).encode(), dtype="S1")
+
+
+def imaris_pyramid(
+        shape: Tuple[int, int, int],
+        voxel_size: Tuple[float, float, float],
+        min_voxels: int = 1024 ** 2
+) -> Tuple[List[Tuple[int, int, int]], List[bool]]:
+    """
+    Shapes of the resolution levels of an Imaris file.
+
+    x and y are halved every level and z is halved only if its voxel size is not larger than the one of xy,
+    until a level has less than min_voxels voxels.
+
+    shape: tuple of int
+        zyx shape of resolution level 0.
+    voxel_size: tuple of float
+        zyx voxel size of resolution level 0.
+    min_voxels: int
+        the number of voxels under which no coarser level is made.
+
+    returns: zyx shapes of all levels and whether z is halved to get from each level to the next one.
+    """
+    shapes, halve_z = [tuple(int(s) for s in shape)], []
+    voxel_z, voxel_xy = voxel_size[0], max(voxel_size[1:3])
+    while True:
+        z, y, x = shapes[-1]
+        if z * y * x <= min_voxels or y == 1 and x == 1:
+            break
+        halve = z > 1 and voxel_z <= voxel_xy
+        shapes += [(ceil(z / 2) if halve else z, ceil(y / 2), ceil(x / 2))]
+        halve_z += [halve]
+        voxel_z *= 2 if halve else 1
+        voxel_xy *= 2
+    return shapes, halve_z
+
+
+def halve(img: ndarray, axis: int) -> ndarray:
+    """Average pairs of rows or columns of a float image, the last one is repeated for odd sizes"""
+    if img.shape[axis] == 1:
+        return img
+    if img.shape[axis] % 2:
+        img = concatenate([img, img[-1:] if axis == 0 else img[:, -1:]], axis=axis)
+    if axis == 0:
+        return (img[0::2] + img[1::2]) * 0.5
+    return (img[:, 0::2] + img[:, 1::2]) * 0.5
+
+
+class PyramidLevel:
+    def __init__(self, data, shape: Tuple[int, int, int], chunks: Tuple[int, int, int], dtype: np_d_type):
+        self.data = data
+        self.shape = shape
+        self.chunks = chunks
+        self.buffer = zeros((chunks[0],) + shape[1:3], dtype=dtype)
+        self.fill = 0
+        self.z0 = 0
+        self.pending = None
+        self.histogram = zeros(256, dtype=uint64)
+
+
+class ImarisWriter:
+    def __init__(
+            self,
+            path: Union[Path, str],
+            shape: Tuple[int, int, int],
+            dtype: Union[str, np_d_type],
+            voxel_size: Tuple[float, float, float] = (1, 1, 1),
+            n_channels: int = 1,
+            channel_names: List[str] = None,
+            chunk_shape: Tuple[int, int, int] = (8, 256, 256),
+            compression_level: int = 2,
+            workers: int = cpu_count(logical=False)
+    ):
+        """
+        Write planes in z order to an Imaris file.
+
+        path: Path or str
+            path of the .ims file.
+        shape: tuple of int
+            zyx shape of the image.
+        dtype: str or numpy dtype
+            uint8 or uint16.
+        voxel_size: tuple of float
+            zyx voxel size in um.
+        n_channels: int
+            number of channels. Planes of multichannel images are given in yxc order.
+        channel_names: list of str
+            names of the channels.
+        chunk_shape: tuple of int
+            zyx shape of the HDF5 chunks. A z-slab of chunk_shape[0] planes is buffered at resolution level 0.
+        compression_level: int
+            gzip compression level.
+        workers: int
+            number of compression threads.
+        """
+        self.dtype = np_d_type(dtype)
+        if self.dtype not in (np_d_type(uint8), np_d_type(uint16)):
+            print(f"{PrintColors.FAIL}only uint8 and uint16 images can be written to ims files{PrintColors.ENDC}")
+            raise RuntimeError
+        self.path = Path(path)
+        self.shape = tuple(int(s) for s in shape)
+        self.voxel_size = tuple(voxel_size)
+        self.n_channels = n_channels
+        self.channel_names = channel_names or [f"Channel {channel}" for channel in range(n_channels)]
+        self.compression_level = compression_level
+        self.shapes, self.halve_z = imaris_pyramid(self.shape, self.voxel_size)
+        self.pool = ThreadPoolExecutor(max(1, workers))
+        self.in_flight = deque()
+        self.max_in_flight = 4 * max(1, workers)
+        self.file = File(self.path, mode="w")
+        self.write_metadata()
+        self.levels: List[List[PyramidLevel]] = []
+        for channel in range(n_channels):
+            levels = []
+            for resolution_level, level_shape in enumerate(self.shapes):
+                chunks = tuple(min(c, s) for c, s in zip(chunk_shape, level_shape))
+                padded_shape = tuple(ceil(s / c) * c for s, c in zip(level_shape, chunks))
+                group = self.file.require_group(
+                    f"DataSet/ResolutionLevel {resolution_level}/TimePoint 0/Channel {channel}")
+                for axis, size, chunk in zip("ZYX", level_shape, chunks):
+                    group.attrs[f"ImageSize{axis}"] = ims_string(size)
+                    group.attrs[f"ImageBlockSize{axis}"] = ims_string(chunk)
+                data = group.create_dataset(
+                    "Data", shape=padded_shape, dtype=self.dtype, chunks=chunks,
+                    compression="gzip", compression_opts=compression_level)
+                levels += [PyramidLevel(data, level_shape, chunks, self.dtype)]
+            self.levels += [levels]
+
+    def write_metadata(self):
+        attrs = self.file.attrs
+        attrs["ImarisDataSet"] = ims_string("ImarisDataSet")
+        attrs["ImarisVersion"] = ims_string("5.5.0")
+        attrs["DataSetDirectoryName"] = ims_string("DataSet")
+        attrs["DataSetInfoDirectoryName"] = ims_string("DataSetInfo")
+        attrs["ThumbnailDirectoryName"] = ims_string("Thumbnail")
+        attrs["NumberOfDataSets"] = array([1], dtype=uint32)
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S.000")
+        info = self.file.create_group("DataSetInfo")
+        info.create_group("ImarisDataSet").attrs.update({
+            "Creator": ims_string("image_preprocessing_pipeline"),
+            "NumberOfImages": ims_string(1),
+            "Version": ims_string("5.5")})
+        info.create_group("Imaris").attrs.update({
+            "Version": ims_string("7.0"),
+            "ThumbnailMode": ims_string("thumbnailMIP")})
+        z, y, x = self.shape
+        voxel_z, voxel_y, voxel_x = self.voxel_size
+        info.create_group("Image").attrs.update({
+            "X": ims_string(x), "Y": ims_string(y), "Z": ims_string(z),
+            "Unit": ims_string("um"),
+            "Noc": ims_string(self.n_channels),
+            "ExtMin0": ims_string(0), "ExtMin1": ims_string(0), "ExtMin2": ims_string(0),
+            "ExtMax0": ims_string(f"{x * voxel_x:.3f}"),
+            "ExtMax1": ims_string(f"{y * voxel_y:.3f}"),
+            "ExtMax2": ims_string(f"{z * voxel_z:.3f}"),
+            "Name": ims_string(self.path.stem),
+            "Description": ims_string("(description not specified)"),
+            "RecordingDate": ims_string(now)})
+        for channel, name in enumerate(self.channel_names):
+            color = "1.000 1.000 1.000" if self.n_channels == 1 else DEFAULT_COLORS[channel % len(DEFAULT_COLORS)]
+            info.create_group(f"Channel {channel}").attrs.update({
+                "Name": ims_string(name),
+                "Description": ims_string("(description not specified)"),
+                "Color": ims_string(color),
+                "ColorMode": ims_string("BaseColor"),
+                "ColorOpacity": ims_string("1.000"),
+                "GammaCorrection": ims_string("1.000")})
+        info.create_group("TimeInfo").attrs.update({
+            "DatasetTimePoints": ims_string(1),
+            "FileTimePoints": ims_string(1),
+            "TimePoint1": ims_string(now)})
+
+    def histogram_bins(self, plane: ndarray) -> ndarray:
+        return (plane if self.dtype == uint8 else plane >> 8).ravel()
+
+    def write_plane(self, plane: ndarray):
+        """Write the next z plane, in yx order or yxc order for multichannel images"""
+        if plane.ndim == 3:
+            for channel in range(self.n_channels):
+                self.write_level_plane(plane[:, :, channel], channel, 0)
+        else:
+            self.write_level_plane(plane, 0, 0)
+
+    def write_level_plane(self, plane: ndarray, channel: int, resolution_level: int):
+        level = self.levels[channel][resolution_level]
+        if plane.shape != level.shape[1:3]:
+            print(f"{PrintColors.FAIL}plane shape {plane.shape} does not match the image shape "
+                  f"{level.shape[1:3]} of resolution level {resolution_level}{PrintColors.ENDC}")
+            raise RuntimeError
+        level.buffer[level.fill] = plane
+        level.fill += 1
+        level.histogram += bincount(self.histogram_bins(plane), minlength=256).astype(uint64)
+        if level.fill == level.chunks[0] or level.z0 + level.fill == level.shape[0]:
+            self.flush(level)
+        if resolution_level + 1 < len(self.shapes):
+            reduced = halve(halve(plane.astype(float32), 0), 1)
+            if self.halve_z[resolution_level]:
+                if level.pending is None:
+                    level.pending = reduced
+                    return
+                reduced = (level.pending + reduced) * 0.5
+                level.pending = None
+            self.write_level_plane((reduced + 0.5).astype(self.dtype), channel, resolution_level + 1)
+
+    def flush(self, level: PyramidLevel):
+        """Compress the buffered z-slab chunk by chunk in the thread pool"""
+        depth = level.fill
+        chunk_z, chunk_y, chunk_x = level.chunks
+        for y0 in range(0, level.shape[1], chunk_y):
+            for x0 in range(0, level.shape[2], chunk_x):
+                tile = zeros(level.chunks, dtype=self.dtype)
+                block = level.buffer[:depth, y0:y0 + chunk_y, x0:x0 + chunk_x]
+                tile[:depth, :block.shape[1], :block.shape[2]] = block
+                self.in_flight.append((
+                    level.data, (level.z0, y0, x0), self.pool.submit(compress, tile, self.compression_level)))
+                while len(self.in_flight) > self.max_in_flight:
+                    self.write_chunk()
+        level.z0 += depth
+        level.fill = 0
+
+    def write_chunk(self):
+        data, offset, future = self.in_flight.popleft()
+        data.id.write_direct_chunk(offset, future.result())
+
+    def write_thumbnail(self):
+        thumbnails = []
+        for levels in self.levels:
+            level = levels[-1]
+            z, y, x = level.shape
+            mip = level.data[0:z, 0:y, 0:x].max(axis=0).astype(float32)
+            mip *= 255 / max(mip.max(), 1)
+            rows, columns = arange(256) * y // 256, arange(256) * x // 256
+            thumbnails += [mip[rows][:, columns].astype(uint8)]
+        self.file.create_dataset("Thumbnail/Data", data=hstack(thumbnails))
+
+    def close(self):
+        for channel, levels in enumerate(self.levels):
+            for resolution_level, level in enumerate(levels):
+                if level.pending is not None:
+                    self.write_level_plane((level.pending + 0.5).astype(self.dtype), channel, resolution_level + 1)
+                    level.pending = None
+                if level.fill > 0:
+                    self.flush(level)
+        while self.in_flight:
+            self.write_chunk()
+        self.pool.shutdown()
+        for channel, levels in enumerate(self.levels):
+            if levels[0].z0 < levels[0].shape[0]:
+                print(f"{PrintColors.WARNING}only {levels[0].z0} of {levels[0].shape[0]} planes were written to "
+                      f"channel {channel} of {self.path}{PrintColors.ENDC}")
+            for level in levels:
+                level.data.parent.create_dataset("Histogram", data=level.histogram)
+                level.data.parent.attrs["HistogramMin"] = ims_string(0)
+                level.data.parent.attrs["HistogramMax"] = ims_string(255 if self.dtype == uint8 else 65535)
+            non_zero = levels[0].histogram.nonzero()[0]
+            upper = (non_zero[-1] + 1 if len(non_zero) else 1) * (1 if self.dtype == uint8 else 256) - 1
+            self.file[f"DataSetInfo/Channel {channel}"].attrs["ColorRange"] = ims_string(f"0.000 {upper:.3f}")
+        self.write_thumbnail()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def tif_series_to_ims(
+        input_path: Path,
+        output_path: Path,
+        voxel_size: Tuple[float, float, float],
+        workers: int = cpu_count(logical=False),
+        compression_level: int = 2,
+        progress_callback: Callable = None
+):
+    """
+    Convert a 2D tif series to an Imaris file in a single pass.
+
+    input_path: Path
+        folder of the tif series.
+    output_path: Path
+        path of the .ims file.
+    voxel_size: tuple of float
+        zyx voxel size in um.
+    workers: int
+        number of reading and compression threads.
+    compression_level: int
+        gzip compression level.
+    progress_callback: Callable
+        called with the added percentage after each plane.
+    """
+    files = sorted(list(input_path.glob("*.tif")) + list(input_path.glob("*.tiff")))
+    if len(files) == 0:
+        print(f"{PrintColors.FAIL}no tif file found to convert to ims:\n\t{input_path}{PrintColors.ENDC}")
+        raise RuntimeError
+    first = imread_tif_raw_png(files[0])
+    n_channels = first.shape[2] if first.ndim == 3 else 1
+    shape = (len(files),) + first.shape[0:2]
+    with ImarisWriter(output_path, shape, first.dtype, voxel_size=voxel_size, n_channels=n_channels,
+                      compression_level=compression_level, workers=workers) as writer, \
+            ThreadPoolExecutor(max(1, workers)) as reader:
+        futures = deque()
+        for file in files + [None] * workers:
+            if file is not None:
+                futures.append(reader.submit(imread_tif_raw_png, file))
+            if len(futures) > workers or file is None and futures:
+                plane = futures.popleft().result()
+                if plane is None:
+                    print(f"{PrintColors.WARNING}a dummy (zeros) plane is written instead of a damaged file"
+                          f"{PrintColors.ENDC}")
+                    plane = zeros(first.shape, dtype=first.dtype)
+                writer.write_plane(plane)
+                if progress_callback is not None:
+                    progress_callback(100 / len(files))
@@ -0,0 +1,233 @@
+"""
+registration.py - translation between the channels of 2D tif series
+
+Several planes sampled along z are registered in parallel on an image pyramid: FFT phase correlation on the
+coarsest level gives the initial shift and ECC only refines it on the finer levels with a few iterations each.
+The per-plane shifts and residuals show z-dependent drift that a single plane can not show.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil, log2
+from typing import List, Tuple, Union
+
+from cv2 import (findTransformECC, resize, error as cv2_error, INTER_AREA, MOTION_TRANSLATION, TERM_CRITERIA_COUNT,
+                 TERM_CRITERIA_EPS)
+from numpy import (ndarray, array, eye, append, ones, float32, uint8, uint16, hanning, conj, absolute, argmax,
+                   unravel_index, median, linspace, nan, isfinite, sqrt)
+from numpy.fft import rfftn, irfftn
+from numpy.linalg import inv
+from psutil import cpu_count
+from skimage.filters import sobel
+
+from pystripe.core import is_uniform_2d
+from supplements.cli_interface import PrintColors
+from supplements.tifstack import TifStack
+
+
+def pyramid_factor(length: int, size: int) -> int:
+    """the smallest power of 2 that reduces length to size or less"""
+    return 2 ** max(0, ceil(log2(length / size)))
+
+
+def gradient_pyramid(img: ndarray, factors: List[int]) -> dict:
+    """sobel gradients of the image down-sampled by each factor, the coarser levels are made from the finer ones"""
+    levels, level, level_factor = {}, img, 1
+    if img.dtype not in (uint8, uint16, float32):
+        level = img.astype(float32)
+    for factor in sorted(set(factors)):
+        if factor != level_factor:
+            ratio = factor // level_factor
+            level = resize(level, (ceil(level.shape[1] / ratio), ceil(level.shape[0] / ratio)),
+                           interpolation=INTER_AREA)
+            level_factor = factor
+        levels[factor] = sobel(level.astype(float32, copy=False)).astype(float32, copy=False)
+    return levels
+
+
+def parabola_vertex(left: float, center: float, right: float) -> float:
+    denominator = left - 2 * center + right
+    if denominator == 0:
+        return 0
+    return 0.5 * (left - right) / denominator
+
+
+def phase_correlation_nd(reference: ndarray, subject: ndarray) -> Tuple[Tuple[float, ...], float]:
+    """
+    Translation of subject with respect to reference using the normalized cross power spectrum of arrays of any
+    dimension with the same shape.
+
+    returns: per axis shifts t, such that reference(p) ~ subject(p + t) like findTransformECC,
+    and the height of the correlation peak, which is 1 for a perfect match.
+    """
+    window = ones(reference.shape, dtype=float32)
+    for axis, length in enumerate(reference.shape):
+        if length >= 8:  # very short axes are not windowed
+            shape = [1] * reference.ndim
+            shape[axis] = length
+            window *= hanning(length).astype(float32).reshape(shape)
+    cross = rfftn(subject * window) * conj(rfftn(reference * window))
+    cross /= absolute(cross) + 1e-12
+    correlation = irfftn(cross, s=reference.shape)
+    peak_idx = unravel_index(argmax(correlation), correlation.shape)
+    peak = correlation[peak_idx]
+    shifts = []
+    for axis, (idx, length) in enumerate(zip(peak_idx, correlation.shape)):
+        before, after = list(peak_idx), list(peak_idx)
+        before[axis], after[axis] = (idx - 1) % length, (idx + 1) % length
+        shift = idx + parabola_vertex(correlation[tuple(before)], peak, correlation[tuple(after)])
+        if shift > length / 2:
+            shift -= length
+        shifts += [float(shift)]
+    return tuple(shifts), float(peak)
+
+
+def phase_correlation(reference: ndarray, subject: ndarray) -> Tuple[float, float, float]:
+    """2D phase correlation, returns (tx, ty, peak) in the convention of findTransformECC"""
+    (ty, tx), peak = phase_correlation_nd(reference, subject)
+    return tx, ty, peak
+
+
+def register_plane(
+        reference: ndarray,
+        subject: ndarray,
+        coarse_size: int = 512,
+        refine_size: int = 2048,
+        iterations: int = 50,
+        termination: float = 1e-6
+) -> Tuple[float, float, float]:
+    """
+    Translation between two planes: phase correlation on the level whose longest side fits in coarse_size,
+    then ECC from that level down to the level whose longest side fits in refine_size.
+
+    reference: ndarray
+        2D reference plane.
+    subject: ndarray
+        2D plane of the channel that should be aligned to the reference.
+    coarse_size: int
+        the longest side of the level used for phase correlation.
+    refine_size: int
+        the longest side of the finest level refined with ECC.
+    iterations: int
+        maximum ECC iterations on each level.
+    termination: float
+        ECC termination epsilon.
+
+    returns: (tx, ty, residual) in full resolution pixels. residual is 1 - the ECC correlation coefficient of the
+    finest level, or nan if ECC did not converge and the phase correlation shift is returned instead.
+    """
+    shape = (min(reference.shape[0], subject.shape[0]), min(reference.shape[1], subject.shape[1]))
+    reference, subject = reference[0:shape[0], 0:shape[1]], subject[0:shape[0], 0:shape[1]]
+    coarse_factor = pyramid_factor(max(shape), coarse_size)
+    refine_factor = min(coarse_factor, pyramid_factor(max(shape), refine_size))
+    factors = [coarse_factor]
+    while factors[-1] > refine_factor:
+        factors += [factors[-1] // 2]
+    reference_levels = gradient_pyramid(reference, factors)
+    subject_levels = gradient_pyramid(subject, factors)
+
+    tx, ty, peak = phase_correlation(reference_levels[coarse_factor], subject_levels[coarse_factor])
+    tx, ty = tx * coarse_factor, ty * coarse_factor
+    residual = nan
+    for factor in factors:
+        warp_matrix = eye(2, 3, dtype=float32)
+        warp_matrix[0, 2], warp_matrix[1, 2] = tx / factor, ty / factor
+        try:
+            cc, warp_matrix = findTransformECC(
+                reference_levels[factor],
+                subject_levels[factor],
+                warp_matrix,
+                MOTION_TRANSLATION,
+                (TERM_CRITERIA_COUNT | TERM_CRITERIA_EPS, iterations, termination),
+                inputMask=None,
+                gaussFiltSize=5
+            )
+        except cv2_error:
+            residual = nan
+            continue
+        tx, ty = float(warp_matrix[0, 2]) * factor, float(warp_matrix[1, 2]) * factor
+        residual = 1 - cc
+    return tx, ty, residual
+
+
+class StackRegistration:
+    def __init__(self, plane_indices: List[int], plane_shifts: List[Union[Tuple[float, float], None]],
+                 residuals: List[float]):
+        """
+        The translation of a channel is the median of the shifts of the registered planes.
+        drift is the largest distance of a plane shift from the median shift.
+        """
+        self.plane_indices = plane_indices
+        self.plane_shifts = plane_shifts
+        self.residuals = residuals
+        shifts = array([shift for shift in plane_shifts if shift is not None], dtype=float32)
+        if len(shifts) > 0:
+            self.shift = tuple(float(value) for value in median(shifts, axis=0))
+            self.drift = float(sqrt(((shifts - array(self.shift)) ** 2).sum(axis=1)).max())
+        else:
+            self.shift = (0., 0.)
+            self.drift = nan
+
+    @property
+    def matrix(self) -> ndarray:
+        """3x3 matrix in the same convention as process_images.get_transformation_matrix"""
+        warp_matrix = eye(2, 3, dtype=float32)
+        warp_matrix[0, 2], warp_matrix[1, 2] = self.shift
+        return inv(append(warp_matrix, array([[0, 0, 1]], dtype=float32), axis=0))
+
+    def report(self) -> str:
+        lines = [f"\tshift (x, y): ({self.shift[0]:.2f}, {self.shift[1]:.2f}) px, drift: {self.drift:.2f} px"]
+        for idx, shift, residual in zip(self.plane_indices, self.plane_shifts, self.residuals):
+            if shift is None:
+                lines += [f"\t\tz={idx}: skipped"]
+            else:
+                lines += [f"\t\tz={idx}: ({shift[0]:.2f}, {shift[1]:.2f}) px, residual: {residual:.4f}"]
+        return "\n".join(lines)
+
+
+def register_stacks(
+        reference: TifStack,
+        subject: TifStack,
+        num_planes: int = 7,
+        workers: int = cpu_count(logical=False),
+        coarse_size: int = 512,
+        refine_size: int = 2048,
+        iterations: int = 50,
+        termination: float = 1e-6
+) -> StackRegistration:
+    """
+    Register num_planes planes evenly spaced in z, excluding the first and the last one, in parallel threads.
+
+    reference: TifStack
+        the reference channel.
+    subject: TifStack
+        the channel that should be aligned to the reference. Its z_offset is respected.
+    num_planes: int
+        number of sampled planes.
+    workers: int
+        number of threads reading and registering planes.
+    coarse_size, refine_size, iterations, termination:
+        see register_plane.
+    """
+    first = max(0, -subject.z_offset)
+    last = min(reference.nz, subject.nz - subject.z_offset) - 1
+    if last < first:
+        print(f"{PrintColors.FAIL}channels do not overlap in z:\n"
+              f"\t{reference.input_directory}\n\t{subject.input_directory}{PrintColors.ENDC}")
+        raise RuntimeError
+    indices = sorted(set(int(round(idx)) for idx in linspace(first, last, num_planes + 2)[1:-1]))
+
+    def register(idx: int):
+        img_reference, img_subject = reference[idx], subject[idx]
+        if img_reference is None or img_subject is None or is_uniform_2d(img_reference) or \
+                is_uniform_2d(img_subject):
+            return None, nan
+        tx, ty, residual = register_plane(img_reference, img_subject, coarse_size=coarse_size,
+                                          refine_size=refine_size, iterations=iterations, termination=termination)
+        return (tx, ty), residual
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(indices)))) as pool:
+        results = list(pool.map(register, indices))
+    registration = StackRegistration(indices, [shift for shift, _ in results], [residual for _, residual in results])
+    if not isfinite(registration.drift):
+        print(f"{PrintColors.WARNING}no plane could be registered, identity transformation is used for\n"
+              f"\t{subject.input_directory}{PrintColors.ENDC}")
+    return registration
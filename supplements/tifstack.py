@@ -1,8 +1,12 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Union
+from threading import Lock
+from typing import Union, Tuple
 
 from tifffile import natural_sorted
-from numpy import zeros
+from numpy import zeros, empty, ndarray, float32, bool_
+from numpy.lib.format import open_memmap
 
 from pystripe.core import imread_tif_raw_png
 
@@ -12,13 +16,22 @@ class TifStack:
     """
     We need a tif stack with an interface that will load a slice one at a time
     We assume each tif has the same size
+
+    Planes are decoded lazily. The last cache_size planes are kept in an LRU cache, and if memmap_path is given every
+    decoded plane is also kept in a memory-mapped npy file that survives the process, so planes read many times are
+    decoded once. Slabs are read in parallel threads with read_range, and the stack can be sliced like an array:
+    stack[z], stack[z0:z1], stack[z0:z1:step, y0:y1, x0:x1].
+    Integer z indices are shifted by z_offset and planes outside the stack are None, or zeros in slabs.
     """
 
-    def __init__(self, input_directory: Union[Path, str], z_offset: int = 0):
+    def __init__(self, input_directory: Union[Path, str], z_offset: int = 0, cache_size: int = 8,
+                 num_threads: int = 8, memmap_path: Union[Path, str, None] = None):
         if isinstance(input_directory, str):
             input_directory = Path(input_directory)
         self.input_directory = input_directory
         self.z_offset = z_offset
+        self.cache_size = cache_size
+        self.num_threads = num_threads
         self.files = [file.__str__() for file in input_directory.iterdir() if
                       file.is_file() and file.suffix.lower() in (".tif", ".tiff")]
         self.files = list(map(Path, natural_sorted(self.files)))
@@ -28,21 +41,183 @@ class TifStack:
         self.nyx = img.shape
         self.nz = len(self.files)
         self.shape = (self.nz, self.nyx[0], self.nyx[1])  # stack height, img_y, img_x
+        self.memmap_path = None if memmap_path is None else Path(memmap_path)
+        self._lock = Lock()
+        self._cache = OrderedDict()
+        self._memmap, self._decoded = None, None
+        self._cache_plane(0, img)
 
-    def __getitem__(self, i):
-        i += self.z_offset
-        if i < 0 or i >= self.nz:
+    def __getstate__(self):
+        # locks, caches and memory maps are not sent to other processes
+        state = self.__dict__.copy()
+        state.update({"_lock": None, "_cache": None, "_memmap": None, "_decoded": None})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return self.nz
+
+    def _open_memmap(self):
+        if self._memmap is None and self.memmap_path is not None:
+            decoded_path = self.memmap_path.with_suffix(".decoded.npy")
+            if self.memmap_path.exists() and decoded_path.exists():
+                self._memmap = open_memmap(self.memmap_path, mode="r+")
+                self._decoded = open_memmap(decoded_path, mode="r+")
+                if self._memmap.shape != self.shape or self._memmap.dtype != self.dtype or \
+                        self._decoded.shape != (self.nz,):
+                    self._memmap, self._decoded = None, None
+            if self._memmap is None:
+                self.memmap_path.parent.mkdir(parents=True, exist_ok=True)
+                self._memmap = open_memmap(self.memmap_path, mode="w+", dtype=self.dtype, shape=self.shape)
+                self._decoded = open_memmap(decoded_path, mode="w+", dtype=bool_, shape=(self.nz,))
+        return self._memmap
+
+    def _cache_plane(self, idx: int, img: ndarray):
+        if img is None or img.shape != self.nyx:
+            return
+        with self._lock:
+            memmap = self._open_memmap()
+            if memmap is not None:
+                memmap[idx] = img
+                self._decoded[idx] = True
+            if self.cache_size > 0:
+                self._cache[idx] = img
+                self._cache.move_to_end(idx)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+    def _cached_plane(self, idx: int) -> Union[ndarray, None]:
+        with self._lock:
+            if idx in self._cache:
+                self._cache.move_to_end(idx)
+                return self._cache[idx]
+            memmap = self._open_memmap()
+            if memmap is not None and self._decoded[idx]:
+                return memmap[idx]
+        return None
+
+    def read_plane(self, idx: int) -> Union[ndarray, None]:
+        """plane of file index idx, without z_offset. The returned array is not shared with the cache."""
+        if idx < 0 or idx >= self.nz:
             return None
-        return imread_tif_raw_png(self.files[i])
+        img = self._cached_plane(idx)
+        if img is not None:
+            return img.copy()
+        img = imread_tif_raw_png(self.files[idx])
+        # the cache keeps its own copy, callers may modify the returned plane in place
+        self._cache_plane(idx, None if img is None else img.copy() if self.cache_size > 0 else img)
+        return img
+
+    def __getitem__(self, i):
+        if isinstance(i, tuple):
+            z_key, yx_key = i[0], i[1:]
+        else:
+            z_key, yx_key = i, ()
+        if isinstance(z_key, slice):
+            z0, z1, step = z_key.indices(self.nz)
+            return self.read_range(z0, z1, step=step, yx_key=yx_key)
+        img = self.read_plane(int(z_key) + self.z_offset)
+        if img is not None and yx_key:
+            img = img[yx_key]
+        return img
+
+    def read_range(self, z0: int, z1: int, step: int = 1, yx_key: tuple = (), out: ndarray = None,
+                   num_threads: int = None) -> ndarray:
+        """
+        Read planes z0 to z1 (exclusive) with the given step in parallel threads into one (z, y, x) array.
+        z is shifted by z_offset like __getitem__ and the missing planes are zeros.
+
+        z0, z1, step: int
+            range of z indices.
+        yx_key: tuple
+            optional slices of the y and x axes applied to each plane.
+        out: ndarray
+            optional output array of the right shape, for example a slice of a larger volume or a memory map.
+        num_threads: int
+            number of reading threads. Default is the num_threads of the stack.
+        """
+        indices = range(z0, z1, step)
+        plane_shape = zeros(self.nyx, dtype=bool_)[yx_key].shape
+        if out is None:
+            out = empty((len(indices),) + plane_shape, dtype=self.dtype)
+
+        def read(count_idx: Tuple[int, int]):
+            count, idx = count_idx
+            img = self.read_plane(idx + self.z_offset)
+            if img is None or img.shape != self.nyx:
+                out[count] = 0
+            else:
+                out[count] = img[yx_key]
+
+        with ThreadPoolExecutor(max_workers=max(1, min(num_threads or self.num_threads, len(indices)))) as pool:
+            list(pool.map(read, enumerate(indices)))
+        return out
+
+    def view(self, step: Tuple[int, int, int] = (1, 1, 1), binned: bool = False) -> "TifStackView":
+        """strided, or block averaged if binned, (z, y, x) view of the stack"""
+        return TifStackView(self, step, binned=binned)
 
     def close(self):
-        pass
+        with self._lock:
+            self._cache.clear()
+            if self._memmap is not None:
+                self._memmap.flush()
+                self._decoded.flush()
+            self._memmap, self._decoded = None, None
+
+    def as_3d_numpy(self):
+        return self.read_range(0, self.nz)
+
+
+class TifStackView:
+    """
+    Lazily down-sampled view of a TifStack. With binned=False every step-th voxel is taken, otherwise blocks of step
+    voxels are averaged and the trailing voxels that do not fill a block are left off. Binned views are float32.
+    """
+
+    def __init__(self, tif_stack: TifStack, step: Tuple[int, int, int] = (1, 1, 1), binned: bool = False):
+        self.tif_stack = tif_stack
+        self.step = tuple(max(1, int(s)) for s in step)
+        self.binned = binned
+        sz, sy, sx = self.step
+        if binned:
+            self.nz, self.nyx = tif_stack.nz // sz, (tif_stack.nyx[0] // sy, tif_stack.nyx[1] // sx)
+            self.dtype = float32
+        else:
+            self.nz = len(range(0, tif_stack.nz, sz))
+            self.nyx = (len(range(0, tif_stack.nyx[0], sy)), len(range(0, tif_stack.nyx[1], sx)))
+            self.dtype = tif_stack.dtype
+        self.shape = (self.nz, self.nyx[0], self.nyx[1])
+
+    def __len__(self):
+        return self.nz
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            z0, z1, step = i.indices(self.nz)
+            return self.read_range(z0, z1, step=step)
+        slab = self.read_range(int(i), int(i) + 1)
+        return slab[0]
+
+    def read_range(self, z0: int, z1: int, step: int = 1) -> ndarray:
+        sz, sy, sx = self.step
+        indices = range(z0, z1, step)
+        if not self.binned:
+            return self.tif_stack.read_range(z0 * sz, z1 * sz, step=step * sz,
+                                             yx_key=(slice(None, None, sy), slice(None, None, sx)))
+        ny, nx = self.nyx
+        out = empty((len(indices), ny, nx), dtype=float32)
+        for count, idx in enumerate(indices):
+            slab = self.tif_stack.read_range(idx * sz, (idx + 1) * sz, yx_key=(slice(0, ny * sy), slice(0, nx * sx)))
+            out[count] = slab.reshape(sz, ny, sy, nx, sx).mean(axis=(0, 2, 4), dtype=float32)
+        return out
 
     def as_3d_numpy(self):
-        stack = zeros(self.shape, dtype=self.dtype)
-        for idx in range(self.nz):
-            stack[idx] = self.__getitem__(idx)
-        return stack
+        return self.read_range(0, self.nz)
 
 
 def imread_tif_stck(tif_stack, idx):
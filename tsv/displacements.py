@@ -0,0 +1,498 @@
+"""displacements.py - in-process pairwise displacement computation (TeraStitcher step 2)
+
+Each stack is streamed once per z layer to build maximum intensity projections
+of its overlap strips.  Neighbouring projections are aligned with normalized
+cross-correlation computed with numpy FFTs and the result is written in the
+xml_import_step_2.xml format that TeraStitcher reads in the projection step.
+"""
+import logging
+from collections import deque
+from math import ceil, sqrt
+from multiprocessing import Pool, cpu_count
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+from xml.etree import ElementTree
+
+from numpy import ndarray, zeros, ones, maximum, where, arange, ix_, conj, unravel_index, float64, \
+    dtype as np_d_type
+from numpy import round as np_round
+from numpy import sqrt as np_sqrt
+from numpy.fft import rfftn, irfftn
+from psutil import virtual_memory
+from tifffile import imread
+from tqdm import tqdm
+
+from supplements.cli_interface import PrintColors
+from .raw import raw_imread
+from .volume import TSVStack, Location, get_dim_tuple
+
+# TeraStitcher caps the NCC width range at S_NCC_WIDTH_MAX - 1
+S_NCC_WIDTH_MAX = 30
+NCC_WIDTH_THRESHOLD = .8
+AXES = "VHD"
+# the edge of the second stack of a pair that faces the edge of the first one
+FACING_EDGE = {"east": "west", "south": "north"}
+# the axes of the xy, xz and yz projections of a strip
+PROJECTION_AXES = (("V", "H"), ("D", "H"), ("D", "V"))
+
+KEY_t = Tuple[int, int]
+PAIR_t = Tuple[KEY_t, KEY_t, str]
+
+
+def subvolume_layers(n_slices: int, depth: int) -> List[Tuple[int, int]]:
+    """Partition the z range the same way TeraStitcher does
+
+    Parameters
+    ----------
+    n_slices: int
+        number of slices of the stacks
+    depth: int
+        requested depth of a subvolume
+
+    Returns
+    -------
+    list of (z0, z1) half-open z ranges, the first n_slices % n_layers layers being one slice deeper
+    """
+    n_layers = max(1, ceil(n_slices / depth))
+    layer_depth = n_slices // n_layers
+    layers, z0 = [], 0
+    for layer in range(n_layers):
+        z1 = z0 + layer_depth + (1 if layer < n_slices % n_layers else 0)
+        layers.append((z0, z1))
+        z0 = z1
+    return layers
+
+
+def read_plane(path: str, input_plugin: str) -> Union[ndarray, None]:
+    if input_plugin == "raw":
+        return raw_imread(path)
+    try:
+        return imread(path)
+    except Exception as inst:
+        print(f"{PrintColors.FAIL}damaged plane:\n\t{path}\n\t{type(inst)}\n\t{inst}{PrintColors.ENDC}")
+        return None
+
+
+def edge_strip(plane: ndarray, edge: str, overlap_v: int, overlap_h: int) -> ndarray:
+    """The part of a plane that overlaps the neighbouring stack at the given edge"""
+    if edge == "east":
+        return plane[:, plane.shape[1] - overlap_h:]
+    if edge == "west":
+        return plane[:, :overlap_h]
+    if edge == "south":
+        return plane[plane.shape[0] - overlap_v:]
+    return plane[:overlap_v]
+
+
+def edge_projections(
+        paths: List[str],
+        input_plugin: str,
+        tile_shape: Tuple[int, int],
+        dtype: np_d_type,
+        overlap_v: int,
+        overlap_h: int,
+        edges: Tuple[str, ...]
+) -> Dict[str, Tuple[ndarray, ndarray, ndarray]]:
+    """Stream the planes of one stack layer and project its overlap strips
+
+    Only one plane is held in memory at a time, so the cost is independent of the layer depth.
+
+    Parameters
+    ----------
+    paths: list of str
+        paths of the planes of the layer
+    input_plugin: str
+        TeraStitcher input plugin of the volume
+    tile_shape: tuple of int
+        height and width of a plane
+    dtype: numpy dtype
+        data type of the planes
+    overlap_v: int
+        number of rows shared with the north and south neighbours
+    overlap_h: int
+        number of columns shared with the east and west neighbours
+    edges: tuple of str
+        the edges that face a neighbour, among "north", "east", "south" and "west"
+
+    Returns
+    -------
+    a dictionary of edge -> (xy, xz, yz) maximum intensity projections of the strip
+    """
+    depth = len(paths)
+    height, width = tile_shape
+    projections = {}
+    for edge in edges:
+        strip_height, strip_width = (height, overlap_h) if edge in ("east", "west") else (overlap_v, width)
+        projections[edge] = (
+            zeros((strip_height, strip_width), dtype=dtype),
+            zeros((depth, strip_width), dtype=dtype),
+            zeros((depth, strip_height), dtype=dtype))
+    for z, path in enumerate(paths):
+        plane = read_plane(path, input_plugin)
+        if plane is None:
+            continue
+        for edge, (xy, xz, yz) in projections.items():
+            strip = edge_strip(plane, edge, overlap_v, overlap_h)
+            maximum(xy, strip, out=xy)
+            xz[z] = strip.max(axis=0)
+            yz[z] = strip.max(axis=1)
+    return projections
+
+
+def ncc_map(fixed: ndarray, moving: ndarray, radius: Tuple[int, ...]) -> Tuple[ndarray, Tuple[int, ...]]:
+    """Normalized cross-correlation of two images for all shifts within the search radius
+
+    The local sums needed for the normalization are computed with FFTs as well, so the result is the exact
+    Pearson correlation of the overlapping parts of the two images for every shift.
+
+    Parameters
+    ----------
+    fixed: ndarray
+        the reference image
+    moving: ndarray
+        the image to be shifted, with the same shape as fixed
+    radius: tuple of int
+        the maximum shift along each axis, clipped to the image size
+
+    Returns
+    -------
+    the correlation for shifts -radius..radius where moving[p] is matched with fixed[p + shift]
+    and the clipped radius
+    """
+    radius = tuple(min(r, s - 1) for r, s in zip(radius, fixed.shape))
+    shape = tuple(s + 2 * r for s, r in zip(fixed.shape, radius))
+    fixed = fixed.astype(float64)
+    moving = moving.astype(float64)
+    # removing the mean keeps the sums of squares well-conditioned
+    fixed -= fixed.mean()
+    moving -= moving.mean()
+
+    def correlate(a_spectrum, b_spectrum):
+        return irfftn(a_spectrum * conj(b_spectrum), shape)[ix_(*[arange(-r, r + 1) % s for r, s in zip(radius, shape)])]
+
+    ones_spectrum = rfftn(ones(fixed.shape), shape)
+    fixed_spectrum = rfftn(fixed, shape)
+    moving_spectrum = rfftn(moving, shape)
+    n = maximum(np_round(correlate(ones_spectrum, ones_spectrum)), 1)
+    sum_fixed = correlate(fixed_spectrum, ones_spectrum)
+    sum_moving = correlate(ones_spectrum, moving_spectrum)
+    covariance = correlate(fixed_spectrum, moving_spectrum) - sum_fixed * sum_moving / n
+    del moving_spectrum
+    variance_fixed = correlate(rfftn(fixed * fixed, shape), ones_spectrum) - sum_fixed ** 2 / n
+    variance_moving = correlate(ones_spectrum, rfftn(moving * moving, shape)) - sum_moving ** 2 / n
+    denominator = np_sqrt(maximum(variance_fixed * variance_moving, 0))
+    # flat overlaps have no meaningful correlation, and FFT round-off would turn them into noise
+    tolerance = 1e-6 * sqrt(float((fixed * fixed).sum()) * float((moving * moving).sum())) + 1e-12
+    return where(denominator > tolerance, covariance / where(denominator > tolerance, denominator, 1), 0), radius
+
+
+def peak_width(ncc: ndarray, peak: Tuple[int, ...], axis: int, inf_width: int) -> int:
+    """Width of the correlation peak along one axis, inf_width if the peak is not isolated in the window"""
+    line = ncc[tuple(slice(None) if a == axis else p for a, p in enumerate(peak))]
+    if len(line) == 1:
+        return 1
+    if line[peak[axis]] <= 0:
+        return inf_width
+    above = line >= NCC_WIDTH_THRESHOLD * line[peak[axis]]
+    lo = hi = peak[axis]
+    while lo > 0 and above[lo - 1]:
+        lo -= 1
+    while hi < len(line) - 1 and above[hi + 1]:
+        hi += 1
+    if lo == 0 or hi == len(line) - 1:
+        return inf_width
+    return min(hi - lo + 1, inf_width)
+
+
+def align_overlap(
+        fixed: Tuple[ndarray, ndarray, ndarray],
+        moving: Tuple[ndarray, ndarray, ndarray],
+        search_radius: Tuple[int, int, int]
+) -> Dict[str, Tuple[float, int, int]]:
+    """Find the shift between the projections of two overlapping strips
+
+    Every axis is observed in two of the three projections; the estimate with the higher correlation peak wins.
+
+    Parameters
+    ----------
+    fixed: tuple of ndarray
+        xy, xz and yz projections of the strip of the first stack
+    moving: tuple of ndarray
+        xy, xz and yz projections of the facing strip of the second stack
+    search_radius: tuple of int
+        maximum shift along V, H and D
+
+    Returns
+    -------
+    a dictionary of axis -> (NCC peak, shift, NCC width)
+    """
+    radius = dict(zip(AXES, search_radius))
+    inf_width = max(min(r, S_NCC_WIDTH_MAX - 1) for r in search_radius) + 1
+    candidates = {axis: [] for axis in AXES}
+    for fixed_mip, moving_mip, axes in zip(fixed, moving, PROJECTION_AXES):
+        ncc, clipped = ncc_map(fixed_mip, moving_mip, tuple(radius[axis] for axis in axes))
+        peak = unravel_index(ncc.argmax(), ncc.shape)
+        for idx, axis in enumerate(axes):
+            candidates[axis].append((
+                float(ncc[peak]), int(peak[idx]) - clipped[idx], peak_width(ncc, peak, idx, inf_width)))
+    return {axis: max(candidates[axis], key=lambda candidate: candidate[0]) for axis in AXES}
+
+
+def displacement_element(
+        shifts: Dict[str, Tuple[float, int, int]],
+        default_displacement: Tuple[int, int, int],
+        search_radius: Tuple[int, int, int],
+        mirror: bool = False
+) -> ElementTree.Element:
+    """A TeraStitcher MIP_NCC Displacement element
+
+    Parameters
+    ----------
+    shifts: dict
+        axis -> (NCC peak, shift, NCC width) as returned by align_overlap
+    default_displacement: tuple of int
+        the V, H and D displacement expected from the stage movement
+    search_radius: tuple of int
+        maximum shift along V, H and D
+    mirror: bool
+        if True, the displacement seen from the second stack of the pair is returned
+
+    Returns
+    -------
+    the Displacement element
+    """
+    sign = -1 if mirror else 1
+    w_range_thresholds = [min(r, S_NCC_WIDTH_MAX - 1) for r in search_radius]
+    inf_width = max(w_range_thresholds) + 1
+    element = ElementTree.Element("Displacement", TYPE="MIP_NCC")
+    for axis, default, w_range_threshold, delay in zip(
+            AXES, default_displacement, w_range_thresholds, search_radius):
+        peak, shift, width = shifts[axis]
+        reliability = sqrt(.5 * (1 - width / inf_width) ** 2 + .5 * max(peak, 0) ** 2)
+        ElementTree.SubElement(
+            element, axis,
+            displ=str(sign * (default + shift)),
+            default_displ=str(sign * default),
+            reliability=f"{reliability:f}",
+            nccPeak=f"{peak:f}",
+            nccWidth=str(width),
+            nccWRangeThr=str(w_range_threshold),
+            nccInvWidth=str(inf_width),
+            delay=str(delay))
+    return element
+
+
+def plan_alignment(
+        tile_shape: Tuple[int, int],
+        itemsize: int,
+        overlap_v: int,
+        overlap_h: int,
+        search_radius: Tuple[int, int, int],
+        subvolume_depth: int,
+        n_columns: int,
+        max_workers: int,
+        memory_fraction: float = .8
+) -> Tuple[int, int]:
+    """Size the subvolume depth and the number of workers from the buffers they need
+
+    A worker holds two planes (the one being read and its decoded copy), the projections of the four edge strips
+    and about a dozen float64 maps of the largest padded projection while correlating.
+    The parent keeps the projections of about one row of stacks until their southern neighbours are done.
+
+    Parameters
+    ----------
+    tile_shape: tuple of int
+        height and width of a plane
+    itemsize: int
+        bytes per voxel
+    overlap_v: int
+        number of rows shared with the north and south neighbours
+    overlap_h: int
+        number of columns shared with the east and west neighbours
+    search_radius: tuple of int
+        maximum shift along V, H and D
+    subvolume_depth: int
+        requested depth of a subvolume
+    n_columns: int
+        number of stack columns
+    max_workers: int
+        upper bound on the number of workers
+    memory_fraction: float
+        fraction of the available memory that may be used
+
+    Returns
+    -------
+    subvolume depth, number of workers
+    """
+    height, width = tile_shape
+    r_v, r_h, r_d = search_radius
+    overlap_v, overlap_h = max(overlap_v, 0), max(overlap_h, 0)
+    available = virtual_memory().available * memory_fraction
+    depth = subvolume_depth
+    while True:
+        projection_bytes = itemsize * 2 * (
+            height * overlap_h + depth * (overlap_h + height) +
+            overlap_v * width + depth * (width + overlap_v))
+        largest_map = max(
+            (height + 2 * r_v) * (overlap_h + 2 * r_h),
+            (overlap_v + 2 * r_v) * (width + 2 * r_h),
+            (depth + 2 * r_d) * (max(height, width) + 2 * max(r_v, r_h)))
+        worker_bytes = 2 * height * width * itemsize + projection_bytes + 12 * 8 * largest_map
+        parent_bytes = (n_columns + 2 * max_workers) * projection_bytes
+        workers = int((available - parent_bytes) // worker_bytes)
+        if workers >= 1 or depth == 1:
+            break
+        depth = max(1, depth // 2)
+    if workers < 1:
+        print(f"{PrintColors.FAIL}not enough memory to align a single subvolume:\n\t"
+              f"needed {worker_bytes / 1024 ** 3:.1f} GB, available {available / 1024 ** 3:.1f} GB"
+              f"{PrintColors.ENDC}")
+        raise RuntimeError
+    return depth, min(workers, max_workers)
+
+
+def compute_displacements(
+        xml_in: Union[str, Path],
+        xml_out: Union[str, Path],
+        search_radius: Tuple[int, int, int] = (25, 25, 10),
+        subvolume_depth: int = 100,
+        max_workers: int = cpu_count(),
+        memory_fraction: float = .8
+):
+    """Compute the pairwise displacements of the stacks of an imported volume
+
+    Parameters
+    ----------
+    xml_in: str or Path
+        the xml_import_step_1.xml written by TeraStitcher's import step
+    xml_out: str or Path
+        where to write the xml_import_step_2.xml
+    search_radius: tuple of int
+        maximum shift along V, H and D (TeraStitcher's sV, sH and sD)
+    subvolume_depth: int
+        requested depth of a subvolume (TeraStitcher's subvoldim), reduced if memory is short
+    max_workers: int
+        upper bound on the number of worker processes
+    memory_fraction: float
+        fraction of the available memory that may be used
+    """
+    tree = ElementTree.parse(str(xml_in))
+    root = tree.getroot()
+    assert root.tag == "TeraStitcher"
+    dims = root.find("dimensions")
+    n_columns = int(dims.attrib["stack_columns"])
+    n_slices = int(dims.attrib["stack_slices"])
+    voxel_dims = get_dim_tuple(root.find("voxel_dims"))  # zyx order
+    md = root.find("mechanical_displacements")
+    default_v = int(abs(float(md.attrib["V"]) / voxel_dims[1]))
+    default_h = int(abs(float(md.attrib["H"]) / voxel_dims[2]))
+    stacks_dir = root.find("stacks_dir").attrib["value"]
+    input_plugin = root.attrib["input_plugin"]
+
+    elements: Dict[KEY_t, ElementTree.Element] = {}
+    stacks: Dict[KEY_t, TSVStack] = {}
+    for element in root.find("STACKS").iter(tag="Stack"):
+        key = int(element.attrib["ROW"]), int(element.attrib["COL"])
+        elements[key] = element
+        stacks[key] = TSVStack(element, Location(0, 0, 0), stacks_dir, input_plugin=input_plugin, z_step=voxel_dims)
+
+    pairs: List[PAIR_t] = []
+    for row, column in sorted(stacks):
+        if (row, column + 1) in stacks:
+            pairs.append(((row, column), (row, column + 1), "east"))
+        if (row + 1, column) in stacks:
+            pairs.append(((row, column), (row + 1, column), "south"))
+    edges = {key: set() for key in stacks}
+    for key0, key1, direction in pairs:
+        edges[key0].add(direction)
+        edges[key1].add(FACING_EDGE[direction])
+
+    first_plane = None
+    for key in sorted(stacks):
+        if stacks[key].paths:
+            first_plane = read_plane(stacks[key].paths[0], input_plugin)
+            break
+    if first_plane is None:
+        print(f"{PrintColors.FAIL}no readable plane was found in {stacks_dir}{PrintColors.ENDC}")
+        raise RuntimeError
+    tile_shape = first_plane.shape[-2:]
+    dtype = first_plane.dtype
+    overlap_v, overlap_h = tile_shape[0] - default_v, tile_shape[1] - default_h
+    if any(direction == "east" for _, _, direction in pairs) and overlap_h <= 0 or \
+            any(direction == "south" for _, _, direction in pairs) and overlap_v <= 0:
+        print(f"{PrintColors.FAIL}the mechanical displacements leave no overlap between the stacks: "
+              f"V={overlap_v}, H={overlap_h}{PrintColors.ENDC}")
+        raise RuntimeError
+    depth, workers = plan_alignment(
+        tile_shape, dtype.itemsize, overlap_v, overlap_h, search_radius, subvolume_depth, n_columns, max_workers,
+        memory_fraction=memory_fraction)
+    layers = subvolume_layers(n_slices, depth)
+    logging.info(f"aligning {len(pairs)} stack pairs in {len(layers)} layers of depth {depth} with {workers} workers")
+
+    def layer_paths(stack: TSVStack, z0: int, z1: int) -> Union[List[str], None]:
+        """The paths of the layer, or None unless the stack has every slice of it"""
+        positions = {z: position for position, z in enumerate(stack.z_indices)}
+        if any(positions.get(z, len(stack.paths)) >= len(stack.paths) for z in range(z0, z1)):
+            return None
+        return [stack.paths[positions[z]] for z in range(z0, z1)]
+
+    tasks, pending = [], {}
+    for layer, (z0, z1) in enumerate(layers):
+        complete = {key: layer_paths(stack, z0, z1) for key, stack in stacks.items()}
+        for key0, key1, _ in pairs:
+            if complete[key0] is not None and complete[key1] is not None:
+                pending[key0, layer] = pending.get((key0, layer), 0) + 1
+                pending[key1, layer] = pending.get((key1, layer), 0) + 1
+        tasks += [(key, layer, complete[key]) for key in sorted(stacks) if (key, layer) in pending]
+
+    projections = {}
+    alignments: Dict[PAIR_t, list] = {pair: [] for pair in pairs}
+    pair_futures = []
+    with Pool(workers) as pool, tqdm(total=len(tasks), desc="projecting", unit="layer", mininterval=1.0) as bar:
+        in_flight = deque()
+
+        def collect():
+            key, layer, future = in_flight.popleft()
+            projections[key, layer] = future.get()
+            bar.update(1)
+            for pair in pairs:
+                key0, key1, direction = pair
+                if key not in (key0, key1) or (key0, layer) not in projections or (key1, layer) not in projections:
+                    continue
+                pair_futures.append((pair, layer, pool.apply_async(align_overlap, (
+                    projections[key0, layer][direction],
+                    projections[key1, layer][FACING_EDGE[direction]],
+                    search_radius))))
+                for done in ((key0, layer), (key1, layer)):
+                    pending[done] -= 1
+                    if pending[done] == 0:
+                        del projections[done]
+
+        for key, layer, paths in tasks:
+            if len(in_flight) >= 2 * workers:
+                collect()
+            in_flight.append((key, layer, pool.apply_async(edge_projections, (
+                paths, input_plugin, tile_shape, dtype, overlap_v, overlap_h, tuple(sorted(edges[key]))))))
+        while in_flight:
+            collect()
+        for pair, layer, future in tqdm(pair_futures, desc="correlating", unit="pair", mininterval=1.0):
+            alignments[pair].append((layer, future.get()))
+
+    for element in elements.values():
+        for tag in ("NORTH_displacements", "EAST_displacements", "SOUTH_displacements", "WEST_displacements"):
+            child = element.find(tag)
+            if child is None:
+                ElementTree.SubElement(element, tag)
+            else:
+                for displacement in list(child):
+                    child.remove(displacement)
+    for (key0, key1, direction), layer_shifts in alignments.items():
+        default_displacement = (0, default_h, 0) if direction == "east" else (default_v, 0, 0)
+        for _, shifts in sorted(layer_shifts, key=lambda layer_shift: layer_shift[0]):
+            elements[key0].find(f"{direction.upper()}_displacements").append(
+                displacement_element(shifts, default_displacement, search_radius))
+            elements[key1].find(f"{FACING_EDGE[direction].upper()}_displacements").append(
+                displacement_element(shifts, default_displacement, search_radius, mirror=True))
+    with open(xml_out, "w", encoding="utf-8") as fd:
+        fd.write('<?xml version="1.0" encoding="UTF-8" ?>\n<!DOCTYPE TeraStitcher SYSTEM "TeraStitcher.DTD">\n')
+        fd.write(ElementTree.tostring(root, encoding="unicode"))
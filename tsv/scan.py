@@ -1,9 +1,11 @@
+import functools
 import itertools
 import logging
 import multiprocessing
 import numpy as np
 import os
 import pathlib
+from numba import jit
 from scipy.ndimage import zoom, distance_transform_edt
 import tifffile
 import tqdm
@@ -174,7 +176,9 @@ class Scanner(TSVVolumeBase):
                  decimate=1,
                  min_support=5,
                  n_cores=os.cpu_count(),
-                 loose_x=False):
+                 loose_x=False,
+                 min_sharpness=None,
+                 low_confidence_z_skip=None):
         """
         Initialize the scanner with the root path to the directory hierarchy
         and the voxel dimensions
@@ -193,14 +197,30 @@ class Scanner(TSVVolumeBase):
         :param path_weight: add an extra weight to 1-score when calculating the
         graph connecting blocks to favor shorter paths.
         :param loose_x: interpret X offsets loosely, with different ones per Y
+        :param min_sharpness: if not None, a peak whose score beats the best
+        score away from it by at least this much is unambiguous: finer
+        decimation levels only search its z plane and the next round skips
+        a decimation level.
+        :param low_confidence_z_skip: if not None, pairs that scored below
+        threshold in the last round sample every low_confidence_z_skip'th
+        plane in the next round instead of z_skip.
         """
         self.pool = None
+        self.bar = None
         self.futures_x = {}
         self.futures_y = {}
         self.futures_z = {}
         self.alignments_x = {}
         self.alignments_y = {}
         self.alignments_z = {}
+        self.sharpness_x = {}
+        self.sharpness_y = {}
+        self.sharpness_z = {}
+        self.low_confidence_x = set()
+        self.low_confidence_y = set()
+        self.low_confidence_z = set()
+        self.min_sharpness = min_sharpness
+        self.low_confidence_z_skip = low_confidence_z_skip
         self._stacks = {}
         self.decimate = decimate
         self.min_support = min_support
@@ -314,6 +334,9 @@ class Scanner(TSVVolumeBase):
         self.alignments_x = {}
         self.alignments_y = {}
         self.alignments_z = {}
+        self.sharpness_x = {}
+        self.sharpness_y = {}
+        self.sharpness_z = {}
         self.decimate = decimate
         self.z_skip = z_skip
         self.x_slop = x_slop
@@ -324,27 +347,189 @@ class Scanner(TSVVolumeBase):
         else:
             self.drift = drift
 
+    def start_pool(self):
+        """
+        Start the alignment workers unless they are already running. Each
+        worker receives the table of stack paths once, when it starts, so
+        alignment tasks only carry stack keys and plane indices. The workers
+        are reused by every round until close_pool is called.
+        """
+        if self.pool is None:
+            the_stack_paths = dict([(k, stack.paths) for k, stack in self._stacks.items()])
+            self.pool = multiprocessing.Pool(self.n_cores,
+                                             initializer=init_alignment_worker,
+                                             initargs=(the_stack_paths,))
+
+    def close_pool(self):
+        """
+        Stop the alignment workers
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
     def align_all_stacks(self):
-        with multiprocessing.Pool(self.n_cores) as self.pool:
-            if len(self.xs) > 1:
-                self.align_stacks_x()
-            if len(self.ys) > 1:
-                self.align_stacks_y()
-            if len(self.zs) > 1:
-                self.align_stacks_z()
-            acc = 0
-            for src in (self.futures_x, self.futures_y, self.futures_z):
-                for k in src:
-                    acc += len(src[k])
-            bar = tqdm.tqdm(total=acc)
-            for src, dest in ((self.futures_x, self.alignments_x),
-                              (self.futures_y, self.alignments_y),
-                              (self.futures_z, self.alignments_z)):
-                for k in src:
-                    dest[k] = []
-                    for z, future in src[k]:
-                        dest[k].append((z, future.get()))
-                        bar.update()
+        self.start_pool()
+        self.bar = tqdm.tqdm(total=0)
+        if len(self.xs) > 1:
+            self.align_stacks_x()
+        if len(self.ys) > 1:
+            self.align_stacks_y()
+        if len(self.zs) > 1:
+            self.align_stacks_z()
+        futures = [future
+                   for src in (self.futures_x, self.futures_y, self.futures_z)
+                   for k in src
+                   for z, future in src[k]]
+        for future in futures:
+            future.wait()
+        self.bar.close()
+        self.bar = None
+        for alignments in (self.alignments_x, self.alignments_y, self.alignments_z,
+                           self.sharpness_x, self.sharpness_y, self.sharpness_z):
+            for k in alignments:
+                alignments[k].sort(key=lambda _: _[0])
+        for future in futures:
+            if not future.successful():
+                # re-raise the worker's exception
+                future.get()
+
+    def store_alignment(self, alignments, sharpness, k, z, result):
+        """
+        Completion callback of an alignment task, run by the pool's result
+        thread as soon as the task is done.
+
+        :param alignments: the alignments dictionary for the direction
+        :param sharpness: the sharpness dictionary for the direction
+        :param k: the key of the first stack of the pair
+        :param z: the plane index of the alignment
+        :param result: the score, x, y and z offsets and the peak sharpness
+        """
+        score, xoff, yoff, zoff, peak_sharpness = result
+        alignments[k].append((z, (score, xoff, yoff, zoff)))
+        sharpness[k].append((z, peak_sharpness))
+        self.bar.update()
+
+    def submit_alignment(self, alignments, sharpness, k, z, fn, args):
+        """
+        Queue an alignment task whose result is stored by store_alignment
+
+        :param alignments: the alignments dictionary for the direction
+        :param sharpness: the sharpness dictionary for the direction
+        :param k: the key of the first stack of the pair
+        :param z: the plane index of the alignment
+        :param fn: the worker function, align_pair_x, _y or _z
+        :param args: the arguments to fn
+        :return: the AsyncResult of the task
+        """
+        if k not in alignments:
+            alignments[k] = []
+            sharpness[k] = []
+        self.bar.total += 1
+        self.bar.refresh()
+        return self.pool.apply_async(
+            fn, args,
+            callback=functools.partial(self.store_alignment, alignments, sharpness, k, z))
+
+    def align_adaptively(self, threshold=.75, max_rounds=3):
+        """
+        Align the stacks in rounds, deriving each round's decimation, search
+        windows and z sampling from the previous round.
+
+        Rounds stop early once every pair aligns over threshold with an
+        unambiguous peak. The alignments of the last round are kept so that
+        calculate_next_round_parameters can be called afterwards as usual.
+        The stacks are moved by every round, so the next round's search
+        windows are centred on the measured offsets. flat_adjust_stacks sets
+        the offsets from the original stack positions, so the rounds do not
+        add up.
+
+        :param threshold: the score for a good match between stacks
+        :param max_rounds: the maximum number of alignment rounds
+        """
+        for round_idx in range(max_rounds):
+            logging.info("Alignment round %d, decimate: %d" %
+                         (round_idx + 1, self.decimate))
+            self.align_all_stacks()
+            self.collect_low_confidence(threshold)
+            n_low_confidence = len(self.low_confidence_x) + \
+                len(self.low_confidence_y) + len(self.low_confidence_z)
+            sharpness = self.median_sharpness(threshold)
+            if sharpness is None:
+                logging.warning("No alignment is over threshold, "
+                                "stopping after round %d" % (round_idx + 1))
+                break
+            if n_low_confidence == 0 and \
+                    (self.min_sharpness is None or sharpness >= self.min_sharpness):
+                break
+            if round_idx < max_rounds - 1:
+                self.calculate_next_round_parameters(threshold, adaptive=True)
+
+    def collect_low_confidence(self, threshold: float):
+        """
+        Record the pairs whose best score over all sampled planes is below
+        threshold so the next round can sample more of their planes.
+
+        :param threshold: the score for a good match between stacks
+        """
+        for alignments, low_confidence in (
+                (self.alignments_x, self.low_confidence_x),
+                (self.alignments_y, self.low_confidence_y),
+                (self.alignments_z, self.low_confidence_z)):
+            low_confidence.clear()
+            for k in alignments:
+                scores = [score for z, (score, xoff, yoff, zoff) in alignments[k]]
+                if len(scores) == 0 or max(scores) < threshold:
+                    low_confidence.add(k)
+
+    def median_sharpness(self, threshold: float):
+        """
+        The median peak sharpness of the alignments over threshold
+
+        :param threshold: the score for a good match between stacks
+        :return: the median sharpness or None if no alignment is over threshold
+        """
+        sharpnesses = []
+        for alignments, sharpness in ((self.alignments_x, self.sharpness_x),
+                                      (self.alignments_y, self.sharpness_y),
+                                      (self.alignments_z, self.sharpness_z)):
+            for k in alignments:
+                if k not in sharpness:
+                    continue
+                for (z, (score, xoff, yoff, zoff)), (_, peak_sharpness) in \
+                        zip(alignments[k], sharpness[k]):
+                    if score >= threshold:
+                        sharpnesses.append(peak_sharpness)
+        if len(sharpnesses) == 0:
+            return None
+        return float(np.median(sharpnesses))
+
+    def next_decimation(self, threshold: float) -> int:
+        """
+        Pick the decimation for the next round. Sharp score surfaces let us
+        skip a level of the coarse-to-fine schedule.
+
+        :param threshold: the score for a good match between stacks
+        :return: the decimation factor for the next round
+        """
+        sharpness = self.median_sharpness(threshold)
+        if self.min_sharpness is not None and sharpness is not None and \
+                sharpness >= self.min_sharpness:
+            return max(1, self.decimate // 4)
+        return max(1, self.decimate // 2)
+
+    def pair_z_skip(self, low_confidence: set, k0: tuple):
+        """
+        The z_skip to use for a pair, sampling low-confidence pairs more densely
+
+        :param low_confidence: the low confidence keys for the direction
+        :param k0: the key of the first stack in the pair
+        :return: the z_skip for the pair
+        """
+        if self.low_confidence_z_skip is not None and k0 in low_confidence:
+            return self.low_confidence_z_skip
+        return self.z_skip
 
     def align_stacks_x(self):
         """
@@ -356,9 +541,8 @@ class Scanner(TSVVolumeBase):
             k1 = (xidx + 1, yidx, zidx)
             if k1 not in self._stacks or k0 not in self._stacks:
                 continue
-            s0 = self._stacks[k0]
-            s1 = self._stacks[k1]
-            self.futures_x[xidx, yidx, zidx] = self.align_stack_x(s0, s1)
+            self.futures_x[xidx, yidx, zidx] = self.align_stack_x(
+                k0, k1, self.pair_z_skip(self.low_confidence_x, k0))
 
     def align_stacks_y(self):
         """
@@ -370,10 +554,8 @@ class Scanner(TSVVolumeBase):
             k1 = (xidx, yidx + 1, zidx)
             if k1 not in self._stacks or k0 not in self._stacks:
                 continue
-            s0 = self._stacks[k0]
-            s1 = self._stacks[k1]
-            self.align_stack_y(s0, s1)
-            self.futures_y[xidx, yidx, zidx] = self.align_stack_y(s0, s1)
+            self.futures_y[xidx, yidx, zidx] = self.align_stack_y(
+                k0, k1, self.pair_z_skip(self.low_confidence_y, k0))
 
     def align_stacks_z(self):
         """
@@ -385,18 +567,17 @@ class Scanner(TSVVolumeBase):
             k1 = (xidx, yidx, zidx + 1)
             if k1 not in self._stacks or k0 not in self._stacks:
                 continue
-            s0 = self._stacks[k0]
-            s1 = self._stacks[k1]
-            self.futures_z[xidx, yidx, zidx] = self.align_stack_z(s0, s1)
+            self.futures_z[xidx, yidx, zidx] = self.align_stack_z(k0, k1)
 
-    def align_stack_x(self, s0: ScanStack, s1: ScanStack):
+    def align_stack_x(self, k0: tuple, k1: tuple, z_skip=None):
         """
         Align stacks that are overlapping in the X direction
-        :param s0:
-        :type s0:
-        :param s1:
-        :type s1:
+        :param k0: the key of the first stack
+        :param k1: the key of the stack next to it in X
+        :param z_skip: if not None, use this instead of self.z_skip
         """
+        s0 = self._stacks[k0]
+        s1 = self._stacks[k1]
         xc = s1.x0 - s0.x0 + self.drift.xoffx
         x0 = xc - self.x_slop
         x1 = xc + self.x_slop + 1
@@ -406,25 +587,29 @@ class Scanner(TSVVolumeBase):
         z1m = min(len(s1.paths),
                   len(s1.paths) - self.z_slop + self.drift.zoffx - 1)
         futures = []
-        if self.z_skip == "middle":
+        if z_skip is None:
+            z_skip = self.z_skip
+        if z_skip == "middle":
             zrange = [(z0m + z1m) // 2]
         else:
-            zrange = range(z0m, z1m, self.z_skip)
+            zrange = range(z0m, z1m, z_skip)
         for z in zrange:
             z0 = z - self.z_slop - self.drift.zoffx
             z1 = z + self.z_slop + 1 - self.drift.zoffx
-            futures.append((z, self.pool.apply_async(
-                align_one_x,
-                (s1.paths[z],
-                 s0.paths[z0:z1],
-                 x0, x1, y0, y1, z0 - z,
+            futures.append((z, self.submit_alignment(
+                self.alignments_x, self.sharpness_x, k0, z,
+                align_pair_x,
+                (k0, k1, z, z0, z1,
+                 x0, x1, y0, y1,
                  self.dark,
-                 self.decimate)
-
+                 self.decimate,
+                 self.min_sharpness)
             )))
         return futures
 
-    def align_stack_y(self, s0: ScanStack, s1: ScanStack):
+    def align_stack_y(self, k0: tuple, k1: tuple, z_skip=None):
+        s0 = self._stacks[k0]
+        s1 = self._stacks[k1]
         yc = s1.y0 - s0.y0 + self.drift.yoffy
         y0 = yc - self.y_slop
         y1 = yc + self.y_slop + 1
@@ -434,10 +619,12 @@ class Scanner(TSVVolumeBase):
         z1m = min(len(s1.paths),
                   len(s1.paths) - self.z_slop + self.drift.zoffx - 1)
         futures = []
-        if self.z_skip == "middle":
+        if z_skip is None:
+            z_skip = self.z_skip
+        if z_skip == "middle":
             zrange = [(z0m + z1m) // 2]
         else:
-            zrange = range(z0m, z1m, self.z_skip)
+            zrange = range(z0m, z1m, z_skip)
         for z in zrange:
             z0 = z - self.z_slop - self.drift.zoffx
             z1 = z + self.z_slop + 1 - self.drift.zoffx
@@ -445,26 +632,26 @@ class Scanner(TSVVolumeBase):
                          (s1.paths[z], s0.paths[z0], s0.paths[z1]))
             logging.info("x0: %d, x1: %d, y0: %d, y1: %d" %
                          (x0, x1, y0, y1))
-            futures.append((z, self.pool.apply_async(
-                align_one_y,
-                (s1.paths[z],
-                 s0.paths[z0:z1],
-                 x0, x1, y0, y1, z0 - z,
+            futures.append((z, self.submit_alignment(
+                self.alignments_y, self.sharpness_y, k0, z,
+                align_pair_y,
+                (k0, k1, z, z0, z1,
+                 x0, x1, y0, y1,
                  self.dark,
-                 self.decimate)
+                 self.decimate,
+                 self.min_sharpness)
             )))
         return futures
 
-    def align_stack_z(self, s0: ScanStack, s1: ScanStack):
+    def align_stack_z(self, k0: tuple, k1: tuple):
         x0 = -self.x_slop + self.drift.xoffz
         x1 = self.x_slop + 1 + self.drift.xoffz
         y0 = -self.y_slop + self.drift.yoffz
         y1 = self.y_slop + 1 + self.drift.yoffz
-        s0_paths = s0.paths[-self.z_slop:]
-        s1_path = s1.paths[0]
-        future = self.pool.apply_async(
-            align_one_z, (s0_paths, s1_path, x0, x1, y0, y1,
-                          -self.z_slop, self.dark, self.decimate))
+        future = self.submit_alignment(
+            self.alignments_z, self.sharpness_z, k0, 0,
+            align_pair_z, (k0, k1, self.z_slop, x0, x1, y0, y1,
+                           self.dark, self.decimate, self.min_sharpness))
         return [[0, future]]
 
     def compute_median_min_max_without_outliers(self, offs, stds):
@@ -499,7 +686,18 @@ class Scanner(TSVVolumeBase):
             (zmedian, zmin, zmax)
 
     def calculate_next_round_parameters(self, threshold=.75, stds=3.0,
-                                        slop_factor=1.25):
+                                        slop_factor=1.25, adaptive=False):
+        """
+        Adjust the stacks from this round's alignments and set up the next round
+
+        :param threshold: the score for a good match between stacks
+        :param stds: offsets further than this many standard deviations from
+        the median are treated as outliers
+        :param slop_factor: widen the observed spread of offsets by this
+        factor to get the next round's search windows
+        :param adaptive: pick the next decimation from the score sharpness of
+        this round and size the search windows for that decimation
+        """
         (xoffx, xminx, xmaxx), (yoffx, yminx, ymaxx), (zoffx, zminx, zmaxx) = \
             self.accumulate_offsets(self.alignments_x, threshold, stds)
         (xoffy, xminy, xmaxy), (yoffy, yminy, ymaxy), (zoffy, zminy, zmaxy) = \
@@ -518,12 +716,18 @@ class Scanner(TSVVolumeBase):
                          zmaxy - zoffy, zoffy - zminy,
                          zmaxz - zoffz, zoffz - zminz) *
                      slop_factor) + self.decimate
+        if adaptive:
+            decimate = self.next_decimation(threshold)
+            x_slop, y_slop, z_slop = [
+                _ - self.decimate + decimate for _ in (x_slop, y_slop, z_slop)]
+        else:
+            decimate = int(self.decimate // 2)
         drift = AverageDrift(int(xoffx), int(yoffx), int(zoffx),
                              int(xoffy), int(yoffy), int(zoffy),
                              int(xoffz), int(yoffz), int(zoffz))
         self.flat_adjust_stacks(threshold)
         self.setup(int(x_slop), int(y_slop), int(z_slop), self.z_skip,
-                   int(self.decimate // 2),
+                   decimate,
                    AverageDrift(0, 0, 0, 0, 0, 0, 0, 0, 0))
 
     KEY_t = typing.Tuple[int, int, int]
@@ -760,9 +964,11 @@ class Scanner(TSVVolumeBase):
             median_z = np.median(z_offs) if len(z_offs) >= self.min_support else 0
             off_z_y[y] = median_z
         #
-        # Update z offsets in z-stack
+        # Update z offsets in z-stack. The offsets are relative to the file indices, so the first stack of each
+        # column starts from its original z0 and repeated calls do not accumulate the X offsets.
         #
         for x, y in itertools.product(range(self.n_x), range(self.n_y)):
+            self._stacks[x, y, 0].z0 = self._stacks[x, y, 0].z0_orig
             for z in range(1, self.n_z):
                 if (x, y, z) in off_z_z:
                     self._stacks[x, y, z].z0 = self._stacks[x, y, z - 1].z1 + off_z_z[x, y, z]
@@ -838,13 +1044,51 @@ class Scanner(TSVVolumeBase):
             stack.z0 = stack.z0 - z0
 
 
+stack_paths = None
+
+
+def init_alignment_worker(the_stack_paths):
+    """
+    Install the table of stack paths once per alignment worker
+
+    :param the_stack_paths: a dictionary of stack key to the stack's plane paths
+    """
+    global stack_paths
+    stack_paths = the_stack_paths
+
+
+def align_pair_x(k0, k1, z, z0, z1, x0_off, x1_off, y0_off, y1_off, dark, decimate, min_sharpness):
+    """
+    Align plane z of stack k1 to planes z0:z1 of stack k0, its neighbor in X
+    """
+    return align_one_x(stack_paths[k1][z], stack_paths[k0][z0:z1],
+                       x0_off, x1_off, y0_off, y1_off, z0 - z, dark, decimate, min_sharpness)
+
+
+def align_pair_y(k0, k1, z, z0, z1, x0_off, x1_off, y0_off, y1_off, dark, decimate, min_sharpness):
+    """
+    Align plane z of stack k1 to planes z0:z1 of stack k0, its neighbor in Y
+    """
+    return align_one_y(stack_paths[k1][z], stack_paths[k0][z0:z1],
+                       x0_off, x1_off, y0_off, y1_off, z0 - z, dark, decimate, min_sharpness)
+
+
+def align_pair_z(k0, k1, z_slop, x0, x1, y0, y1, dark, decimate, min_sharpness):
+    """
+    Align the first plane of stack k1 to the last z_slop planes of stack k0, its neighbor in Z
+    """
+    return align_one_z(stack_paths[k0][-z_slop:], stack_paths[k1][0],
+                       x0, x1, y0, y1, -z_slop, dark, decimate, min_sharpness)
+
+
 def align_one_x(tgt_path: pathlib.Path,
                 src_paths: typing.Sequence[pathlib.Path],
                 x0_off: int, x1_off: int,
                 y0_off: int, y1_off: int,
                 z_off: int,
                 dark: int,
-                decimate: int) -> typing.Tuple[float, int, int, int]:
+                decimate: int,
+                min_sharpness: float = None) -> typing.Tuple[float, int, int, int, float]:
     """
     Align the target to all of the sources, returning the chosen x_offset,
     y_offset and z_offset
@@ -856,17 +1100,19 @@ def align_one_x(tgt_path: pathlib.Path,
     :param y0_off: Start looking in Y here
     :param y1_off: End looking here
     :param decimate: Decimate the image by this amount (= zoom by 1/decimate)
-    :return: a 4 tuple of the best alignment score, and the x, y and z offsets
-    chosen
+    :param min_sharpness: stop searching other z planes once the peak is
+    sharper than this
+    :return: a 5 tuple of the best alignment score, the x, y and z offsets
+    chosen and the sharpness of the peak
     """
-    best_score, best_xoff, best_yoff, best_zoff = align_one(
+    best_score, best_xoff, best_yoff, best_zoff, sharpness = align_one(
         dark, decimate, align_plane_x, src_paths, tgt_path, x0_off,
-        x1_off, y0_off, y1_off)
-    return best_score, best_xoff, best_yoff, best_zoff + z_off
+        x1_off, y0_off, y1_off, min_sharpness)
+    return best_score, best_xoff, best_yoff, best_zoff + z_off, sharpness
 
 
 def align_one(dark, decimate, plane_fn, src_paths, tgt_path, x0_off, x1_off,
-              y0_off, y1_off):
+              y0_off, y1_off, min_sharpness=None):
     tgt_img = imread(tgt_path)
     src_imgs = [imread(_) for _ in src_paths]
     decimations = []
@@ -876,69 +1122,193 @@ def align_one(dark, decimate, plane_fn, src_paths, tgt_path, x0_off, x1_off,
         if d == 1:
             break
         d = d // 2
-    for decimate in decimations:
+    z_candidates = range(len(src_imgs))
+    sharpness = 0.0
+    for level, decimate in enumerate(decimations):
         best_score = 0.0
         best_xoff = 0
         best_yoff = 0
         best_zoff = 0
+        scores = [] if level == 0 else None
         if decimate != 1:
             tgt_img_decimate = zoom(tgt_img, 1 / decimate)
-            src_imgs_decimate = [zoom(_, 1 / decimate) for _ in src_imgs]
+            src_imgs_decimate = dict([(z, zoom(src_imgs[z], 1 / decimate)) for z in z_candidates])
         else:
             tgt_img_decimate = tgt_img
-            src_imgs_decimate = src_imgs
-        for z, src_img in enumerate(src_imgs_decimate):
+            src_imgs_decimate = dict([(z, src_imgs[z]) for z in z_candidates])
+        for z in z_candidates:
             best_score, best_xoff, best_yoff, best_zoff = plane_fn(
                 best_score, best_xoff, best_yoff, best_zoff, dark,
-                decimate, src_img, tgt_img_decimate, x0_off, x1_off, y0_off,
-                y1_off, z)
+                decimate, src_imgs_decimate[z], tgt_img_decimate, x0_off, x1_off, y0_off,
+                y1_off, z, scores)
         if best_score == 0:
             break
+        if level == 0:
+            sharpness = peak_sharpness(scores, best_score, best_xoff, best_yoff, decimate)
+            if min_sharpness is not None and sharpness >= min_sharpness:
+                # The peak is unambiguous, the finer levels only need to refine x and y on its plane
+                z_candidates = [best_zoff]
         x0_off = max(-tgt_img.shape[1], best_xoff - decimate)
         x1_off = min(best_xoff + decimate, tgt_img.shape[1])
         y0_off = max(-tgt_img.shape[1], best_yoff - decimate)
         y1_off = min(best_yoff + decimate, tgt_img.shape[0])
-    return best_score, best_xoff, best_yoff, best_zoff
+    return best_score, best_xoff, best_yoff, best_zoff, sharpness
 
 
-def align_plane_x(best_score, best_xoff, best_yoff, best_zoff, dark,
-                  decimate, src_img, tgt_img, x0_off, x1_off, y0_off,
-                  y1_off, z):
+def peak_sharpness(scores, best_score, best_xoff, best_yoff, decimate):
+    """
+    Measure how unambiguous the best alignment of a search is
+
+    :param scores: a sequence of score, x offset and y offset of every
+    alignment tried with enough foreground support
+    :param best_score: the best score of the search
+    :param best_xoff: the x offset of the best score
+    :param best_yoff: the y offset of the best score
+    :param decimate: the search step, alignments within one step of the best
+    one are considered part of its peak
+    :return: the difference between the best score and the best score away
+    from its peak
+    """
+    runner_up = 0.0
+    for score, x_off, y_off in scores:
+        if abs(x_off - best_xoff) > decimate or abs(y_off - best_yoff) > decimate:
+            if score > runner_up:
+                runner_up = score
+    return best_score - runner_up
+
+
+@jit(nopython=True)
+def overlap(size: int, off: int, shifted: bool):
+    """
+    The bounds of the overlap of a source and a target axis offset by off
+
+    :param size: the length of the axis
+    :param off: the offset of the target relative to the source
+    :param shifted: if True, the source starts at off and the target at 0
+    regardless of the sign of off, otherwise the sign of off picks the image
+    that starts at abs(off).
+    :return: source start and end and target start and end
+    """
+    if shifted:
+        return off, size, 0, size - off
+    if off > 0:
+        return 0, size - off, off, size
+    return -off, size, 0, size + off
+
+
+@jit(nopython=True)
+def masked_pearson(src: np.ndarray, tgt: np.ndarray, dark: float):
+    """
+    Pearson correlation of two equally shaped views in a single pass
+    without copying them. Sums are shifted by the first voxel of each view
+    to keep the single pass variance accurate.
+
+    :param src: the source view
+    :param tgt: the target view
+    :param dark: voxels brighter than this in both views count as support
+    :return: the correlation coefficient (nan if either view is flat), the
+    number of supporting voxels and the number of voxels
+    """
+    n_y, n_x = src.shape
+    n = n_y * n_x
+    if n == 0:
+        return np.nan, 0, 0
+    k_s = float(src[0, 0])
+    k_t = float(tgt[0, 0])
+    sum_s = sum_t = sum_ss = sum_tt = sum_st = 0.0
+    support = 0
+    for y in range(n_y):
+        for x in range(n_x):
+            s = src[y, x]
+            t = tgt[y, x]
+            if s > dark and t > dark:
+                support += 1
+            s -= k_s
+            t -= k_t
+            sum_s += s
+            sum_t += t
+            sum_ss += s * s
+            sum_tt += t * t
+            sum_st += s * t
+    var_s = sum_ss - sum_s * sum_s / n
+    var_t = sum_tt - sum_t * sum_t / n
+    if var_s <= 0 or var_t <= 0:
+        return np.nan, support, n
+    return (sum_st - sum_s * sum_t / n) / np.sqrt(var_s * var_t), support, n
+
+
+@jit(nopython=True)
+def score_row(src_img: np.ndarray, tgt_img: np.ndarray, x_off: int, y_offs: np.ndarray,
+              x_shifted: bool, y_shifted: bool, dark: float,
+              scores: np.ndarray, supports: np.ndarray, sizes: np.ndarray):
+    """
+    Score one x offset against a whole row of y offsets
+
+    :param src_img: the source image
+    :param tgt_img: the target image
+    :param x_off: the x offset in decimated voxels
+    :param y_offs: the y offsets in decimated voxels
+    :param x_shifted: the source is shifted by x_off in x (see overlap)
+    :param y_shifted: the source is shifted by the y offset in y
+    :param dark: the threshold between foreground and background
+    :param scores: receives the correlation per y offset
+    :param supports: receives the number of foreground voxels per y offset
+    :param sizes: receives the number of overlapping voxels per y offset
+    """
+    if x_shifted:
+        sx0, sx1, tx0, tx1 = overlap(src_img.shape[1], x_off, True)
+    else:
+        sx0, sx1, tx0, tx1 = overlap(tgt_img.shape[1], x_off, False)
+    for idx in range(len(y_offs)):
+        if y_shifted:
+            sy0, sy1, ty0, ty1 = overlap(src_img.shape[0], y_offs[idx], True)
+        else:
+            sy0, sy1, ty0, ty1 = overlap(tgt_img.shape[0], y_offs[idx], False)
+        scores[idx], supports[idx], sizes[idx] = masked_pearson(
+            src_img[sy0:sy1, sx0:sx1], tgt_img[ty0:ty1, tx0:tx1], dark)
+
+
+def align_plane(x_shifted, y_shifted, best_score, best_xoff, best_yoff, best_zoff, dark,
+                decimate, src_img, tgt_img, x0_off, x1_off, y0_off, y1_off, z, scores=None):
+    """
+    Search a window of x and y offsets of one source plane for the best
+    correlation with the target, a row of y offsets at a time.
+    """
+    y_offs_big = np.arange(y0_off, y1_off, decimate)
+    y_offs = y_offs_big // decimate
+    row_scores = np.zeros(len(y_offs), np.float64)
+    row_supports = np.zeros(len(y_offs), np.int64)
+    row_sizes = np.zeros(len(y_offs), np.int64)
     for x_off_big in range(x0_off, x1_off, decimate):
         x_off = x_off_big // decimate
-        for y_off_big in range(y0_off, y1_off, decimate):
-            y_off = y_off_big // decimate
-            score, src_slice, tgt_slice = score_plane_x(src_img, tgt_img, x_off, y_off)
-            mask = (tgt_slice > dark) & (src_slice > dark)
-            if np.sum(mask) < np.sqrt(np.prod(tgt_slice.shape)):
+        score_row(src_img, tgt_img, x_off, y_offs, x_shifted, y_shifted, float(dark),
+                  row_scores, row_supports, row_sizes)
+        for y_off_big, score, support, size in zip(y_offs_big, row_scores, row_supports, row_sizes):
+            if support < np.sqrt(size):
                 continue
+            if scores is not None:
+                scores.append((score, x_off_big, int(y_off_big)))
             if score > best_score:
                 best_score = score
                 best_xoff = x_off_big
-                best_yoff = y_off_big
+                best_yoff = int(y_off_big)
                 best_zoff = z
     return best_score, best_xoff, best_yoff, best_zoff
 
 
+def align_plane_x(best_score, best_xoff, best_yoff, best_zoff, dark,
+                  decimate, src_img, tgt_img, x0_off, x1_off, y0_off,
+                  y1_off, z, scores=None):
+    return align_plane(True, False, best_score, best_xoff, best_yoff, best_zoff, dark,
+                       decimate, src_img, tgt_img, x0_off, x1_off, y0_off, y1_off, z, scores)
+
+
 def score_plane_x(src_img, tgt_img, x_off, y_off):
-    x00 = x_off
-    x10 = src_img.shape[1]
-    x01 = 0
-    x11 = src_img.shape[1] - x_off
-    if y_off > 0:
-        y00 = 0
-        y10 = tgt_img.shape[0] - y_off
-        y01 = y_off
-        y11 = tgt_img.shape[0]
-    else:
-        y00 = -y_off
-        y10 = tgt_img.shape[0]
-        y01 = 0
-        y11 = tgt_img.shape[0] + y_off
+    x00, x10, x01, x11 = overlap(src_img.shape[1], x_off, True)
+    y00, y10, y01, y11 = overlap(tgt_img.shape[0], y_off, False)
     tgt_slice = tgt_img[y01:y11, x01:x11]
     src_slice = src_img[y00:y10, x00:x10]
-    score = np.corrcoef(tgt_slice.flatten().astype(np.float32),
-                        src_slice.flatten().astype(np.float32))[0, 1]
+    score = masked_pearson(src_slice, tgt_slice, 0.0)[0]
     return score, src_slice, tgt_slice
 
 
@@ -948,7 +1318,8 @@ def align_one_y(tgt_path: pathlib.Path,
                 y0_off: int, y1_off: int,
                 z_off: int,
                 dark: int,
-                decimate: int) -> typing.Tuple[float, int, int, int]:
+                decimate: int,
+                min_sharpness: float = None) -> typing.Tuple[float, int, int, int, float]:
     """
     Align the target to all of the sources, returning the chosen x_offset,
     y_offset and z_offset
@@ -962,52 +1333,30 @@ def align_one_y(tgt_path: pathlib.Path,
     :param z_off: the z-offset of the first src_path
     :param dark: the threshold between foreground and background image intensity
     :param decimate: Decimate the image by this amount (= zoom by 1/decimate)
-    :return: a 4 tuple of the best alignment score, and the x, y and z offsets
-    chosen
+    :param min_sharpness: stop searching other z planes once the peak is
+    sharper than this
+    :return: a 5 tuple of the best alignment score, the x, y and z offsets
+    chosen and the sharpness of the peak
     """
-    best_score, best_xoff, best_yoff, best_zoff = align_one(
+    best_score, best_xoff, best_yoff, best_zoff, sharpness = align_one(
         dark, decimate, align_plane_y,
-        src_paths, tgt_path, x0_off, x1_off, y0_off, y1_off)
-    return best_score, best_xoff, best_yoff, best_zoff + z_off
+        src_paths, tgt_path, x0_off, x1_off, y0_off, y1_off, min_sharpness)
+    return best_score, best_xoff, best_yoff, best_zoff + z_off, sharpness
 
 
 def align_plane_y(best_score, best_xoff, best_yoff, best_zoff, dark, decimate,
-                  src_img, tgt_img, x0_off, x1_off, y0_off, y1_off, z):
-    for x_off_big in range(x0_off, x1_off, decimate):
-        x_off = x_off_big // decimate
-        for y_off_big in range(y0_off, y1_off, decimate):
-            y_off = y_off_big // decimate
-            score, src_slice, tgt_slice = score_plane_y(src_img, tgt_img, x_off, y_off)
-            mask = (tgt_slice > dark) & (src_slice > dark)
-            if np.sum(mask) < np.sqrt(np.prod(tgt_slice.shape)):
-                continue
-            if score > best_score:
-                best_score = score
-                best_xoff = x_off_big
-                best_yoff = y_off_big
-                best_zoff = z
-    return best_score, best_xoff, best_yoff, best_zoff
+                  src_img, tgt_img, x0_off, x1_off, y0_off, y1_off, z,
+                  scores=None):
+    return align_plane(False, True, best_score, best_xoff, best_yoff, best_zoff, dark,
+                       decimate, src_img, tgt_img, x0_off, x1_off, y0_off, y1_off, z, scores)
 
 
 def score_plane_y(src_img, tgt_img, x_off, y_off):
-    if x_off > 0:
-        x00 = 0
-        x10 = tgt_img.shape[1] - x_off
-        x01 = x_off
-        x11 = tgt_img.shape[1]
-    else:
-        x00 = -x_off
-        x10 = tgt_img.shape[1]
-        x01 = 0
-        x11 = tgt_img.shape[1] + x_off
-    y00 = y_off
-    y10 = src_img.shape[0]
-    y01 = 0
-    y11 = src_img.shape[0] - y_off
+    x00, x10, x01, x11 = overlap(tgt_img.shape[1], x_off, False)
+    y00, y10, y01, y11 = overlap(src_img.shape[0], y_off, True)
     tgt_slice = tgt_img[y01:y11, x01:x11]
     src_slice = src_img[y00:y10, x00:x10]
-    score = np.corrcoef(tgt_slice.flatten().astype(np.float32),
-                        src_slice.flatten().astype(np.float32))[0, 1]
+    score = masked_pearson(src_slice, tgt_slice, 0.0)[0]
     return score, src_slice, tgt_slice
 
 
@@ -1019,7 +1368,8 @@ def align_one_z(src_paths: typing.Sequence[pathlib.Path],
                 y1: int,
                 z_off: int,
                 dark: int,
-                decimate: int) -> typing.Tuple[float, int, int, int]:
+                decimate: int,
+                min_sharpness: float = None) -> typing.Tuple[float, int, int, int, float]:
     """
     Align one plane in the x and y direction on behalf of z
 
@@ -1033,58 +1383,30 @@ def align_one_z(src_paths: typing.Sequence[pathlib.Path],
     :param dark: For counting minimum # of bright pixels, all values lower
     than this are considered background
     :param decimate: Start out by reducing the size of the image by this factor
-    :return: a 4 tuple of the best score,  x offset, y offset and z offset
+    :param min_sharpness: stop searching other z planes once the peak is
+    sharper than this
+    :return: a 5 tuple of the best score,  x offset, y offset, z offset and
+    the sharpness of the peak
     """
-    best_score, best_x_offset, best_y_offset, best_z_offset = \
+    best_score, best_x_offset, best_y_offset, best_z_offset, sharpness = \
         align_one(dark, decimate, align_plane_z, src_paths, tgt_path,
-                  x0, x1, y0, y1)
-    return best_score, best_x_offset, best_y_offset, best_z_offset + z_off
+                  x0, x1, y0, y1, min_sharpness)
+    return best_score, best_x_offset, best_y_offset, best_z_offset + z_off, sharpness
 
 
 def align_plane_z(best_score, best_xoff, best_yoff, best_z_off, dark, decimate,
                   src_img, tgt_img, x0, x1, y0, y1,
-                  z_off):
-    for x_off_big in range(x0, x1, decimate):
-        x_off = x_off_big // decimate
-        for y_off_big in range(y0, y1, decimate):
-            y_off = y_off_big // decimate
-            score, src_slice, tgt_slice = score_plane_z(src_img, tgt_img, x_off, y_off)
-            mask = (tgt_slice > dark) & (src_slice > dark)
-            if np.sum(mask) < np.sqrt(np.prod(tgt_slice.shape)):
-                continue
-            if score > best_score:
-                best_score = score
-                best_xoff = x_off_big
-                best_yoff = y_off_big
-                best_z_off = z_off
-    return best_score, best_xoff, best_yoff, best_z_off
+                  z_off, scores=None):
+    return align_plane(False, False, best_score, best_xoff, best_yoff, best_z_off, dark,
+                       decimate, src_img, tgt_img, x0, x1, y0, y1, z_off, scores)
 
 
 def score_plane_z(src_img, tgt_img, x_off, y_off):
-    if x_off > 0:
-        x00 = 0
-        x10 = tgt_img.shape[1] - x_off
-        x01 = x_off
-        x11 = tgt_img.shape[1]
-    else:
-        x00 = -x_off
-        x10 = tgt_img.shape[1]
-        x01 = 0
-        x11 = tgt_img.shape[1] + x_off
-    if y_off > 0:
-        y00 = 0
-        y10 = tgt_img.shape[0] - y_off
-        y01 = y_off
-        y11 = tgt_img.shape[0]
-    else:
-        y00 = -y_off
-        y10 = tgt_img.shape[0]
-        y01 = 0
-        y11 = tgt_img.shape[0] + y_off
+    x00, x10, x01, x11 = overlap(tgt_img.shape[1], x_off, False)
+    y00, y10, y01, y11 = overlap(tgt_img.shape[0], y_off, False)
     tgt_slice = tgt_img[y01:y11, x01:x11]
     src_slice = src_img[y00:y10, x00:x10]
-    score = np.corrcoef(tgt_slice.flatten().astype(np.float32),
-                        src_slice.flatten().astype(np.float32))[0, 1]
+    score = masked_pearson(src_slice, tgt_slice, 0.0)[0]
     return score, src_slice, tgt_slice
 
 
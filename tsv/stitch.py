@@ -1,4 +1,5 @@
 import argparse
+import collections
 import json
 import logging
 import multiprocessing
@@ -89,6 +90,17 @@ def parse_args(args=sys.argv[1:]):
                         help="The compression level (0 to 9)",
                         default=3,
                         type=int)
+    parser.add_argument("--tile-size",
+                        help="Write tiled tiffs with square tiles of this "
+                             "size (a multiple of 16). Default is 0 for "
+                             "striped output.",
+                        default=0,
+                        type=int)
+    parser.add_argument("--n-in-flight",
+                        help="The maximum number of output planes being "
+                             "read or written at any one time. Default is "
+                             "twice the number of io cores.",
+                        type=int)
     parser.add_argument("--stack-offset-output",
                         help="If present, write a .json file containing "
                              "the calculated stack offsets and scores")
@@ -102,18 +114,111 @@ def parse_args(args=sys.argv[1:]):
                         help="Allow for loose, per-Y interpretation of "
                         "x-offsets",
                         action="store_true")
-    return parser.parse_args(args)
+    parser.add_argument("--adaptive-rounds",
+                        help="If more than 1, align in up to this many "
+                             "rounds, each one picking its decimation, "
+                             "search windows and z sampling from the "
+                             "score surfaces of the previous round.",
+                        default=1,
+                        type=int)
+    parser.add_argument("--min-sharpness",
+                        help="A peak whose score is better than the best "
+                             "score away from it by at least this much is "
+                             "unambiguous and is only refined on its own "
+                             "z plane.",
+                        type=float)
+    parser.add_argument("--low-confidence-z-skip",
+                        help="In adaptive rounds, align one plane out of "
+                             "every low-confidence-z-skip planes for pairs "
+                             "that scored below threshold.",
+                        type=int)
+    opts = parser.parse_args(args)
+    if opts.tile_size % 16 != 0:
+        parser.error("--tile-size must be a multiple of 16")
+    return opts
 
 
 scanner = None
+z_stacks = None
+
+
+def init_writer(the_scanner, the_z_stacks):
+    """Install the scanner and the per-plane stack index once per writer process
+
+    :param the_scanner: the aligned and rebased scanner
+    :param the_z_stacks: a dictionary of z to the stacks intersecting plane z
+    """
+    global scanner, z_stacks
+    scanner = the_scanner
+    z_stacks = the_z_stacks
+
+
+def index_stacks_by_z(volume):
+    """Find the stacks intersecting each plane of the volume
+
+    :param volume: the VExtent of the stitched volume
+    :returns: a dictionary of z to the list of stacks that contain plane z
+    """
+    result = dict([(z, []) for z in range(volume.z0, volume.z1)])
+    for stack in scanner.flattened_stacks():
+        for z in range(max(stack.z0, volume.z0), min(stack.z1, volume.z1)):
+            result[z].append(stack)
+    return result
 
 
-def do_one_plane(z, path, compress, width, height):
+def do_one_plane(z, path, compress, width, height, tile_size=0):
+    stacks = None if z_stacks is None else z_stacks[z]
     plane = scanner.imread(VExtent(0, width,
                                    0, height,
-                                   z, z + 1), np.uint16)
-    tifffile.imsave(path, plane.reshape(plane.shape[1], plane.shape[2]),
-                    compress=compress)
+                                   z, z + 1), np.uint16, stacks=stacks)
+    kwargs = {}
+    if compress > 0:
+        kwargs["compression"] = ("ADOBE_DEFLATE", compress)
+    if tile_size > 0:
+        kwargs["tile"] = (tile_size, tile_size)
+    tifffile.imwrite(path, plane.reshape(plane.shape[1], plane.shape[2]),
+                     **kwargs)
+
+
+def write_planes(output_pattern, compress, tile_size, n_io_cores, n_in_flight):
+    """Write the stitched volume one plane per file in z order
+
+    At most n_in_flight planes are queued at any time so memory use stays
+    flat regardless of the depth of the volume. The scanner and the per-plane
+    stack index are handed to each writer process once, when it starts, and
+    tasks only carry the plane's z and path.
+
+    :param output_pattern: the output file name pattern, e.g. img_%04d.tiff
+    :param compress: the deflate compression level, 0 for none
+    :param tile_size: the tile size for tiled tiffs, 0 for striped
+    :param n_io_cores: the number of writer processes
+    :param n_in_flight: the maximum number of queued planes
+    """
+    volume = scanner.volume
+    width = volume.x1
+    height = volume.y1
+    the_z_stacks = index_stacks_by_z(volume)
+    in_flight = collections.deque()
+    done_paths = set()
+    bar = tqdm.tqdm(total=volume.z1 - volume.z0)
+    with multiprocessing.Pool(n_io_cores,
+                              initializer=init_writer,
+                              initargs=(scanner, the_z_stacks)) as pool:
+        for z in range(volume.z0, volume.z1):
+            path = output_pattern % z
+            path_dir = os.path.dirname(path)
+            if path_dir and path_dir not in done_paths:
+                os.makedirs(path_dir, exist_ok=True)
+                done_paths.add(path_dir)
+            if len(in_flight) >= n_in_flight:
+                in_flight.popleft().get()
+                bar.update()
+            in_flight.append(pool.apply_async(
+                do_one_plane, (z, path, compress, width, height, tile_size)))
+        while len(in_flight) > 0:
+            in_flight.popleft().get()
+            bar.update()
+    bar.close()
 
 
 def dump_round(fd):
@@ -158,12 +263,18 @@ def main(args=sys.argv[1:]):
                       drift=drift,
                       min_support=opts.min_support,
                       n_cores=opts.n_cores,
-                      loose_x=opts.loose_x)
+                      loose_x=opts.loose_x,
+                      min_sharpness=opts.min_sharpness,
+                      low_confidence_z_skip=opts.low_confidence_z_skip)
     if opts.stack_offset_input:
         with open(opts.stack_offset_input) as fd:
             load_round(fd)
+    elif opts.adaptive_rounds > 1:
+        scanner.align_adaptively(threshold=opts.threshold,
+                                 max_rounds=opts.adaptive_rounds)
     else:
         scanner.align_all_stacks()
+    scanner.close_pool()
     if opts.stack_offset_output:
         with open(opts.stack_offset_output, "w") as fd:
             dump_round(fd)
@@ -173,22 +284,11 @@ def main(args=sys.argv[1:]):
         stacks = [stack.as_dict() for stack in scanner.stacks[0]]
         with open(opts.stacks, "w") as fd:
             json.dump(stacks, fd, indent=2)
-    width = scanner.volume.x1
-    height = scanner.volume.y1
-    futures = []
-    done_paths = set()
+    n_in_flight = opts.n_in_flight or 2 * opts.n_io_cores
     logging.info("Writing output images")
-    with multiprocessing.Pool(opts.n_io_cores) as pool:
-        for z in range(scanner.volume.z0, scanner.volume.z1):
-            path = opts.output_pattern % z
-            path_dir = os.path.dirname(path)
-            if path_dir not in done_paths and not os.path.exists(path_dir):
-                os.mkdir(path_dir)
-                done_paths.add(path_dir)
-            futures.append(pool.apply_async(
-                do_one_plane, (z, path, opts.compression, width, height)))
-        for future in tqdm.tqdm(futures):
-            future.get()
+    write_planes(opts.output_pattern, opts.compression, opts.tile_size,
+                 opts.n_io_cores, n_in_flight)
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -357,6 +357,11 @@ class TSVStack(TSVStackBase):
         self.__paths = None
         self.suffix: str = glob_re(ordering_pattern, Path(root_dir)).__next__().suffix
 
+    @property
+    def z_indices(self):
+        """The z indices of the slices kept from the Z_RANGES attribute"""
+        return self.__idxs_to_keep
+
     @property
     def paths(self):
         """The paths to the individual slices"""
@@ -572,20 +577,22 @@ class TSVVolumeBase:
         """
         return sum(self.stacks, [])
 
-    def imread(self, volume, dtype):
+    def imread(self, volume, dtype, stacks=None):
         """Read the given volume
 
         volume:
             a VExtent delimiting the volume to read
         dtype:
             the numpy dtype of the array to be returned
+        stacks:
+            if not None, only these stacks are considered instead of scanning all flattened stacks.
 
         returns:
             the array corresponding to the volume (with zeros for data outside the array).
         """
 
         intersections = []
-        for stack in self.flattened_stacks():
+        for stack in self.flattened_stacks() if stacks is None else stacks:
             if stack.intersects(volume):
                 intersections.append((stack, stack.intersection(volume)))
 